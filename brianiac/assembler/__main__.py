@@ -26,27 +26,30 @@ def split_bytecode(bytecode):
     return bytecode[0::2], bytecode[1::2]
 
 
+def assemble(text):
+    lexer = Lexer().get_lexer()
+    lines = [re.sub(r"^([^;]*);.*$", r"\1", line) for line in text.split("\n")]
+    tokens = lexer.lex("\n".join(lines))
+    pg = Parser()
+    pg.bnf()
+    parser = pg.get_parser()
+    return parser.parse(tokens)
+
+
 @click.command()
 @click.argument("source", type=str)
 @click.argument("destination", type=str)
 @click.option("--split", is_flag=True, help="Splits file into high and low byte banks")
-def main(source, destination, split):
+@click.option("--symbols", is_flag=True, help="Writes the symbol table next to the destination as a .sym file")
+def main(source, destination, split, symbols):
     """
     Brianiac 16bit Assembler
     """
 
     filename, ext = os.path.splitext(destination)
 
-    lexer = Lexer().get_lexer()
     with open(source) as f:
-        lines = []
-        for line in f:
-            lines.append(re.sub(r"^([^;]*);.*(\n?)$", r"\1\2", line))
-        tokens = lexer.lex("".join(lines))
-        pg = Parser()
-        pg.bnf()
-        parser = pg.get_parser()
-        result = parser.parse(tokens)
+        result = assemble(f.read())
         if split:
             hi, lo = split_bytecode(result.eval())
             with open(f"{filename}_hi{ext}", "wb") as w:
@@ -56,6 +59,10 @@ def main(source, destination, split):
         else:
             with open(f"{filename}{ext}", "wb") as w:
                 w.write(result.eval())
+        if symbols:
+            with open(f"{filename}.sym", "w") as w:
+                for label, value in sorted(result.labels.items(), key=lambda item: item[1]):
+                    w.write(f"0x{value:04X} {label}\n")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,78 @@
+# Copyright 2022 Brian Johnson
+#
+# This file is part of brianiac
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, see <http://www.gnu.org/licenses/>.
+
+import click
+import json
+import sys
+from brianiac.benchmark.runner import DEFAULT_INSTRUCTIONS, compare, run_benchmarks, workload_names
+
+
+def format_rate(result):
+    if result["unit"] == "instructions/s":
+        return f"{result['rate'] / 1e6:8.3f} MIPS"
+    return f"{result['rate']:8.0f} lines/s"
+
+
+@click.command()
+@click.argument("workloads", nargs=-1)
+@click.option("--instructions", type=int, default=DEFAULT_INSTRUCTIONS,
+              help="Instructions executed by each emulator workload")
+@click.option("--repeat", type=int, default=3, help="Runs of each workload, the fastest of which is reported")
+@click.option("--interpret", is_flag=True, help="Runs the emulator workloads without block translation")
+@click.option("--save", type=click.File("w"), help="Writes the results as JSON to this file")
+@click.option("--baseline", type=click.File("r"), help="Compares against results written with --save")
+@click.option("--tolerance", type=float, default=0.05,
+              help="Fraction a workload may slow down against the baseline before it counts as a regression")
+@click.option("--list", "show", is_flag=True, help="Lists the workloads and exits")
+def main(workloads, instructions, repeat, interpret, save, baseline, tolerance, show):
+    """
+    Brianiac emulator and assembler benchmarks
+    """
+
+    available = workload_names(interpret)
+    if show:
+        for name in available:
+            click.echo(name)
+        return
+    names = [name for name in available if not workloads or name in workloads or name.split("/")[0] in workloads]
+    unknown = [name for name in workloads if name not in available and name not in {n.split("/")[0] for n in available}]
+    if unknown:
+        raise click.BadParameter(f"unknown workload {', '.join(unknown)}", param_hint="WORKLOADS")
+
+    current = run_benchmarks(names, instructions, repeat)
+    if save:
+        json.dump(current, save, indent=2)
+
+    if baseline is None:
+        for name, result in current["results"].items():
+            click.echo(f"{name:<24} {format_rate(result)}  {result['peak_kib'] / 1024:7.1f} MiB")
+        return
+
+    rows, regressions, missing = compare(current, json.load(baseline), tolerance)
+    for name, result, previous, change in rows:
+        flag = "  SLOWER" if change < -tolerance else ""
+        click.echo(f"{name:<24} {format_rate(result)}  baseline {format_rate(previous)}  {100 * change:+6.1f}%  "
+                   f"{result['peak_kib'] / 1024:7.1f} MiB (was {previous['peak_kib'] / 1024:.1f}){flag}")
+    for name in missing:
+        click.echo(f"{name:<24} {format_rate(current['results'][name])}  not in baseline")
+    if not rows:
+        raise click.ClickException("no workload was found in the baseline, so nothing was compared")
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == "__main__":
+    main()
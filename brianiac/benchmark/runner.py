@@ -0,0 +1,110 @@
+# Copyright 2022 Brian Johnson
+#
+# This file is part of brianiac
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, see <http://www.gnu.org/licenses/>.
+
+import contextlib
+import multiprocessing
+import os
+import platform
+import resource
+import tempfile
+import time
+from brianiac.assembler.__main__ import assemble
+from brianiac.benchmark.workloads import ASSEMBLER, EMULATOR, generate_source
+from brianiac.emulator.cpu import CPU
+from brianiac.emulator.memorymap import DEFAULT_MEMORY_MAP, populate
+from brianiac.emulator.serial import Serial
+
+DEFAULT_INSTRUCTIONS = 2000000
+
+
+def workload_names(interpret=False):
+    prefix = "interpreter" if interpret else "emulator"
+    return [f"{prefix}/{name}" for name in EMULATOR] + [f"assembler/{name}" for name in ASSEMBLER]
+
+
+def _peak_kib():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def _quietly(function):
+    # Program.eval() prints a listing the way brianiac-asm does, which is part
+    # of what is being measured but should not reach the terminal.
+    with open(os.devnull, "w") as null, contextlib.redirect_stdout(null):
+        return function()
+
+
+def run_emulator(name, instructions, translate=True):
+    rom = _quietly(lambda: assemble(EMULATOR[name]).eval())
+    with tempfile.NamedTemporaryFile(suffix=".rom") as romfile, open(os.devnull, "wb") as null:
+        romfile.write(rom)
+        romfile.flush()
+        serial = Serial(None, null.fileno())
+        cpu = CPU(translate=translate)
+        populate(cpu, DEFAULT_MEMORY_MAP, romfile.name, serial)
+        start = time.perf_counter()
+        cpu.run(instructions)
+        serial.flush()
+        elapsed = time.perf_counter() - start
+    return {"count": cpu.instructions, "seconds": elapsed, "rate": cpu.instructions / elapsed,
+            "unit": "instructions/s", "peak_kib": _peak_kib()}
+
+
+def run_assembler(name):
+    text = generate_source(ASSEMBLER[name])
+    lines = text.count("\n")
+    start = time.perf_counter()
+    _quietly(lambda: assemble(text).eval())
+    elapsed = time.perf_counter() - start
+    return {"count": lines, "seconds": elapsed, "rate": lines / elapsed, "unit": "lines/s", "peak_kib": _peak_kib()}
+
+
+def run_workload(name, instructions=DEFAULT_INSTRUCTIONS):
+    group, workload = name.split("/")
+    if group == "assembler":
+        return run_assembler(workload)
+    return run_emulator(workload, instructions, group == "emulator")
+
+
+def _run_workload(args):
+    return run_workload(*args)
+
+
+# Every run gets a freshly spawned worker so that the peak resident size is
+# that of the workload alone and no caches carry over between repeats. The
+# fastest of the repeats is kept.
+def run_benchmarks(names, instructions=DEFAULT_INSTRUCTIONS, repeat=3):
+    context = multiprocessing.get_context("spawn")
+    results = {}
+    with context.Pool(1, maxtasksperchild=1) as pool:
+        for name in names:
+            runs = [pool.apply(_run_workload, ((name, instructions),)) for _ in range(repeat)]
+            results[name] = max(runs, key=lambda run: run["rate"])
+    return {"python": platform.python_version(), "machine": platform.machine(), "results": results}
+
+
+def compare(current, baseline, tolerance):
+    """Pairs up workloads in both runs and returns the pairs, the ones slower than tolerance and the unpaired."""
+    rows = []
+    missing = []
+    for name, result in current["results"].items():
+        previous = baseline["results"].get(name)
+        if previous is None:
+            missing.append(name)
+            continue
+        change = result["rate"] / previous["rate"] - 1
+        rows.append((name, result, previous, change))
+    return rows, [row for row in rows if row[3] < -tolerance], missing
@@ -0,0 +1,168 @@
+# Copyright 2022 Brian Johnson
+#
+# This file is part of brianiac
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, see <http://www.gnu.org/licenses/>.
+
+import random
+
+# Emulator workloads loop forever and are stopped by an instruction limit, so
+# every run executes the same number of instructions.
+ALU = """
+mov r1, 0
+mov r2, 0x1234
+loop:
+add r1, r2
+xor r2, r1
+shl r2
+sub r1, 3
+and r3, r1
+or r3, r2
+test r3, 0x00ff
+shr r3
+not r4
+cp r1, 0x7fff
+bnz loop
+bra loop
+"""
+
+MEMCPY = """
+source equ 0x2000
+target equ 0x6000
+start:
+mov r1, source
+mov r2, target
+mov r3, 0x0800
+copy:
+ldw r0, @r1
+stw @r2, r0
+ldb r4, @r1
+stb @r2, r4
+and r0, r0
+add r1, 2
+add r2, 2
+sub r3, 1
+bnz copy
+bra start
+"""
+
+SERIAL = """
+serialdata equ 0xf001
+start:
+mov r1, message
+next:
+ldb r0, @r1
+cp r0, 0
+bz start
+stb serialdata, r0
+and r0, r0
+add r1, 1
+bra next
+message:
+defb 0x54, 0x68, 0x65, 0x20, 0x71, 0x75, 0x69, 0x63, 0x6b, 0x20, 0x62, 0x72, 0x6f, 0x77, 0x6e, 0x20
+defb 0x66, 0x6f, 0x78, 0x0d, 0x0a, 0x00
+"""
+
+# Recursive Fibonacci with the return address and arguments saved on the
+# stack the way printstring in asm/demo.asm does it.
+CALLS = """
+mov r14, 0xf000
+main:
+mov r1, 15
+call fib
+bra main
+fib:
+cp r1, 2
+bc small
+sub r14, 2
+stw @r14, r15
+sub r14, 2
+stw @r14, r1
+sub r1, 1
+call fib
+ldw r1, @r14
+and r1, r1
+sub r14, 2
+stw @r14, r0
+sub r1, 2
+call fib
+ldw r2, @r14
+and r2, r2
+add r14, 2
+add r0, r2
+add r14, 2
+ldw r15, @r14
+add r14, 2
+ret
+small:
+mov r0, r1
+ret
+"""
+
+EMULATOR = {
+    "alu": ALU,
+    "memcpy": MEMCPY,
+    "serial": SERIAL,
+    "calls": CALLS,
+}
+
+ASSEMBLER = {
+    "small": 2000,
+    "large": 12000,
+}
+
+REGISTER_FORMS = ("add", "sub", "and", "or", "xor", "cp", "test")
+UNARY_FORMS = ("not", "shr", "shl")
+BRANCH_FORMS = ("bra", "bz", "bnz", "bc", "bnc", "call")
+
+
+def generate_source(lines, seed=0):
+    """Returns assembler source of about the given number of lines using every statement form."""
+    rng = random.Random(seed)
+    out = [f"konst{index} equ 0x{rng.randrange(0x10000):04x} ; constant {index}" for index in range(64)]
+    labels = max(1, lines // 16)
+    label = 0
+    while len(out) < lines:
+        if len(out) % 16 == 0 and label < labels:
+            out.append(f"target{label}:")
+            label += 1
+            continue
+        n, m = rng.randrange(16), rng.randrange(16)
+        kind = rng.randrange(10)
+        if kind < 3:
+            operand = rng.choice((f"r{m}", f"0x{rng.randrange(0x10000):04x}", str(rng.randrange(1000)),
+                                  f"konst{rng.randrange(64)}"))
+            out.append(f"{rng.choice(REGISTER_FORMS)} r{n}, {operand}")
+        elif kind == 3:
+            out.append(f"{rng.choice(UNARY_FORMS)} r{n}")
+        elif kind == 4:
+            operand = rng.choice((f"@r{m}", f"konst{rng.randrange(64)}"))
+            out.append(f"{rng.choice(('ldw', 'ldb'))} r{n}, {operand}    ; load")
+        elif kind == 5:
+            operand = rng.choice((f"@r{n}", f"konst{rng.randrange(64)}"))
+            out.append(f"{rng.choice(('stw', 'stb'))} {operand}, r{m}")
+        elif kind == 6:
+            out.append(f"mov r{n}, {rng.choice((f'r{m}', f'0b{rng.randrange(256):b}', f'0o{rng.randrange(512):o}'))}")
+        elif kind == 7:
+            out.append(f"{rng.choice(BRANCH_FORMS)} target{rng.randrange(labels)}")
+        elif kind == 8:
+            values = ", ".join(f"0x{rng.randrange(256):02x}" for _ in range(rng.randrange(2, 10, 2)))
+            out.append(f"defb {values}")
+        else:
+            out.append("ret" if rng.randrange(2) else "")
+    while label < labels:
+        out.append(f"target{label}:")
+        label += 1
+    out.append("ret")
+    return "\n".join(out) + "\n"
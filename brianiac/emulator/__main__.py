@@ -16,8 +16,25 @@
 # along with this program; if not, see <http://www.gnu.org/licenses/>.
 
 import click
+import contextlib
+import json
+import os
+import sys
+import time
 from click_shell import shell
+from brianiac.emulator.cpu import StopReason
 from brianiac.emulator.debugger import Debugger
+from brianiac.emulator.disassembler import source
+from brianiac.emulator.fleet import run_fleet
+from brianiac.emulator.gdbstub import GdbServer, listen
+from brianiac.emulator.hardware import Hardware, Lockstep
+from brianiac.emulator.logisim import CircuitError
+from brianiac.emulator import memorymap
+from brianiac.emulator.serial import Serial
+from brianiac.emulator.snapshot import SnapshotError
+from brianiac.emulator.symbols import SymbolTable
+from brianiac.emulator.trace import TraceReader, TraceError
+from brianiac.emulator.timing import Throttle
 
 
 class BasedIntParamType(click.ParamType):
@@ -39,6 +56,30 @@ class BasedIntParamType(click.ParamType):
 
 BASED_INT = BasedIntParamType()
 
+EXIT_CODES = {
+    StopReason.HALT: 0,
+    StopReason.LIMIT: 2,
+    StopReason.INVALID: 3,
+    StopReason.FAULT: 4,
+    StopReason.INTERRUPT: 130,
+}
+
+
+def load_memory_map(ctx, param, value):
+    if value is None:
+        return None
+    try:
+        return memorymap.load(value)
+    except ValueError as e:
+        raise click.BadParameter(str(e), ctx, param)
+
+
+class EmulatorGroup(click.Group):
+    def parse_args(self, ctx, args):
+        if args and args[0] not in self.commands and not args[0].startswith("-"):
+            args = ["debug"] + args
+        return super().parse_args(ctx, args)
+
 
 @shell(prompt=">>")
 @click.pass_context
@@ -95,12 +136,28 @@ def list(ctx, **kwargs):
 @cli.command()
 @click.argument("start", type=BASED_INT)
 @click.argument("end", required=False, type=BASED_INT)
+@click.option("--output", type=click.Path(dir_okay=False), help="Saves the raw bytes to a file instead")
 @click.pass_context
 def memory(ctx, **kwargs):
     """Dumps the memory range given by START, END"""
     if kwargs['end'] is None:
         kwargs['end'] = kwargs['start'] + 256
-    ctx.obj.memory_dump(kwargs['start'], kwargs['end'])
+    if kwargs['output']:
+        ctx.obj.save_memory(kwargs['output'], kwargs['start'], kwargs['end'])
+    else:
+        ctx.obj.memory_dump(kwargs['start'], kwargs['end'])
+
+
+@cli.command()
+@click.argument("file", type=click.Path(exists=True, dir_okay=False))
+@click.argument("start", type=BASED_INT)
+@click.pass_context
+def poke(ctx, file, start):
+    """Writes the contents of FILE into memory starting at the address START."""
+    try:
+        ctx.obj.load_memory(file, start)
+    except ValueError as e:
+        raise click.ClickException(str(e))
 
 
 @cli.command(name="break")
@@ -118,13 +175,285 @@ def breakpoint(ctx, **kwargs):
             ctx.obj.set_breakpoint(kwargs['address'])
 
 
-@click.command()
-@click.argument('rom')
-def main(rom):
+@cli.command()
+@click.argument("start", required=False, type=BASED_INT)
+@click.argument("end", required=False, type=BASED_INT)
+@click.option("--read", "kind", flag_value="read", help="Stop when the range is read")
+@click.option("--write", "kind", flag_value="write", default=True, help="Stop when the range is written (default)")
+@click.option("--access", "kind", flag_value="access", help="Stop when the range is read or written")
+@click.option("--delete", is_flag=True, help="Delete watchpoint")
+@click.pass_context
+def watch(ctx, start, end, kind, delete):
+    """Set, Delete, and List watchpoints on the address START or the range START to END."""
+    if start is None:
+        ctx.obj.list_watchpoints()
+    elif delete:
+        ctx.obj.del_watchpoint(start, end)
+    else:
+        ctx.obj.set_watchpoint(start, end, kind)
+
+
+@cli.command()
+@click.argument("state", type=click.Choice(["on", "off"]), default="on")
+@click.pass_context
+def record(ctx, state):
+    """Turns recording of execution history for reverse execution on or off."""
+    ctx.obj.record(state == "on")
+
+
+@cli.command()
+@click.pass_context
+def rstep(ctx):
+    """Undoes the last executed instruction."""
+    ctx.obj.reverse_step()
+
+
+@cli.command()
+@click.pass_context
+def rcontinue(ctx):
+    """Runs backwards until a breakpoint or the start of recorded history."""
+    ctx.obj.reverse_continue()
+
+
+@cli.command()
+@click.argument("instruction", type=BASED_INT)
+@click.pass_context
+def goto(ctx, instruction):
+    """Moves forwards or backwards to the given instruction count (IC)."""
+    ctx.obj.goto(instruction)
+
+
+@cli.command()
+@click.argument("file", type=click.Path(dir_okay=False))
+@click.pass_context
+def save(ctx, file):
+    """Saves registers, flags, RAM and device state to FILE."""
+    ctx.obj.save_snapshot(file)
+
+
+@cli.command()
+@click.argument("file", type=click.Path(exists=True, dir_okay=False))
+@click.pass_context
+def load(ctx, file):
+    """Restores machine state from a snapshot FILE written by save."""
+    try:
+        ctx.obj.load_snapshot(file)
+    except SnapshotError as e:
+        raise click.ClickException(str(e))
+
+
+@cli.command()
+@click.argument("frequency", type=BASED_INT, required=False)
+@click.pass_context
+def clock(ctx, frequency):
+    """Paces execution to FREQUENCY Hz of the real board's clock (0 runs unthrottled)."""
+    ctx.obj.clock(frequency)
+
+
+@cli.command()
+@click.option("--reset", is_flag=True, help="Clears the counters after showing them")
+@click.pass_context
+def stats(ctx, reset):
+    """Shows performance counters: instructions by class, branches and memory traffic."""
+    ctx.obj.stats()
+    if reset:
+        ctx.obj.cpu.counters.reset()
+
+
+@cli.command()
+@click.argument("state", type=click.Choice(["on", "off", "report"]), default="report")
+@click.pass_context
+def profile(ctx, state):
+    """Turns the subroutine profiler on or off, or reports the counts gathered so far."""
+    if state == "report":
+        ctx.obj.profile_report()
+    else:
+        ctx.obj.profile(state == "on")
+
+
+@cli.command()
+@click.argument("file", type=click.Path(dir_okay=False), required=False)
+@click.pass_context
+def trace(ctx, file):
+    """Writes a binary trace of every executed instruction to FILE, or stops tracing."""
+    ctx.obj.trace(file)
+
+
+@click.group(cls=EmulatorGroup)
+def main():
     """Brianiac CPU emulator/debugger"""
-    debugger = Debugger(rom)
+
+
+@main.command()
+@click.argument('rom')
+@click.option("--symbols", type=click.Path(exists=True, dir_okay=False),
+              help="Symbol file written by the assembler (default: ROM with a .sym extension)")
+@click.option("--clock", type=BASED_INT, help="Paces execution to this clock frequency in Hz")
+@click.option("--memory-map", type=click.Path(exists=True, dir_okay=False), callback=load_memory_map,
+              help="File of START END TYPE lines replacing the default memory map")
+def debug(rom, symbols, clock, memory_map):
+    """Starts the interactive debugger with ROM loaded (default)."""
+    debugger = Debugger(rom, symbols=symbols, memory_map=memory_map)
+    if clock:
+        debugger.cpu.throttle = Throttle(clock)
     cli.invoke(click.Context(cli, info_name=cli.name, obj=debugger))
 
 
+@main.command()
+@click.argument('rom')
+@click.option("--listen", "address", default="localhost:1234",
+              help="host:port or Unix socket path to wait for the debugger on")
+@click.option("--symbols", type=click.Path(exists=True, dir_okay=False),
+              help="Symbol file written by the assembler (default: ROM with a .sym extension)")
+@click.option("--memory-map", type=click.Path(exists=True, dir_okay=False), callback=load_memory_map,
+              help="File of START END TYPE lines replacing the default memory map")
+def gdb(rom, address, symbols, memory_map):
+    """Serves ROM to a debugger over the GDB remote serial protocol."""
+    debugger = Debugger(rom, symbols=symbols, memory_map=memory_map)
+    server = listen(address)
+    click.echo(f"Waiting for GDB on {address}", err=True)
+    with server:
+        GdbServer(debugger.cpu, debugger.watchpoints).serve(server)
+
+
+@main.command(name="run")
+@click.argument('rom')
+@click.option("--max-instructions", type=BASED_INT, help="Stop after executing this many instructions")
+@click.option("--stdin", type=click.File("rb"), help="File fed to the serial port as input")
+@click.option("--stdout", type=click.File("wb"), default="-", help="File receiving serial port output")
+@click.option("--trace", type=click.Path(dir_okay=False), help="Writes a binary execution trace to this file")
+@click.option("--profile", is_flag=True, help="Prints a subroutine profile when the run stops")
+@click.option("--stats", is_flag=True, help="Prints performance counters when the run stops")
+@click.option("--symbols", type=click.Path(exists=True, dir_okay=False),
+              help="Symbol file written by the assembler (default: ROM with a .sym extension)")
+@click.option("--clock", type=BASED_INT, help="Paces execution to this clock frequency in Hz")
+@click.option("--memory-map", type=click.Path(exists=True, dir_okay=False), callback=load_memory_map,
+              help="File of START END TYPE lines replacing the default memory map")
+def batch(rom, max_instructions, stdin, stdout, trace, profile, stats, symbols, clock, memory_map):
+    """Runs ROM without the debugger shell and exits with a status giving the stop reason."""
+    serial = Serial(stdin.fileno() if stdin else None, stdout.fileno())
+    debugger = Debugger(rom, serial, symbols, memory_map)
+    if trace:
+        debugger.trace(trace)
+    if clock:
+        debugger.cpu.throttle = Throttle(clock)
+    if profile:
+        debugger.profile(True)
+    reason = debugger.cpu.run(max_instructions)
+    serial.flush()
+    if trace:
+        debugger.tracer.close()
+    if profile:
+        click.echo(debugger.profiler.report(debugger.symbols), err=True)
+    if stats:
+        with contextlib.redirect_stdout(sys.stderr):
+            debugger.stats()
+    click.echo(f"{reason.name.lower()}: {debugger.cpu.instructions} instructions, {debugger.cpu.cycles} cycles, "
+               f"PC 0x{debugger.cpu.registers.pc:04X}", err=True)
+    sys.exit(EXIT_CODES[reason])
+
+
+@main.command()
+@click.argument('rom')
+@click.argument('inputs', type=click.Path(exists=True, file_okay=False))
+@click.option("--max-instructions", type=BASED_INT, help="Instruction limit for each run")
+@click.option("--jobs", type=int, help="Number of worker processes (default: one per CPU)")
+@click.option("--output", type=click.Path(file_okay=False), help="Directory receiving the serial output of each run")
+@click.option("--summary", type=click.File("w"), help="Writes all results as JSON to this file")
+def fleet(rom, inputs, max_instructions, jobs, output, summary):
+    """Runs ROM once for every serial input file in INPUTS across a pool of processes."""
+    paths = sorted(os.path.join(inputs, name) for name in os.listdir(inputs)
+                   if os.path.isfile(os.path.join(inputs, name)))
+    results = run_fleet(rom, paths, max_instructions, jobs)
+    if output:
+        os.makedirs(output, exist_ok=True)
+        for result in results:
+            if "output" in result:
+                with open(os.path.join(output, f"{result['input']}.out"), "wb") as f:
+                    f.write(result["output"].encode("latin-1"))
+    if summary:
+        json.dump(results, summary, indent=2)
+    for result in results:
+        click.echo(f"{result['input']:<32} {result['reason']:<10} {result.get('instructions', 0):>12}")
+    counts = {}
+    for result in results:
+        counts[result["reason"]] = counts.get(result["reason"], 0) + 1
+    click.echo(", ".join(f"{count} {reason}" for reason, count in sorted(counts.items())))
+    sys.exit(0 if counts.keys() <= {"halt"} else 1)
+
+
+@main.command(name="trace")
+@click.argument('file', type=click.Path(exists=True, dir_okay=False))
+@click.option("--pc", type=BASED_INT, nargs=2, help="Only instructions with a PC in this inclusive range")
+@click.option("--address", type=BASED_INT, nargs=2, help="Only loads and stores to this inclusive address range")
+@click.option("--stats", is_flag=True, help="Prints aggregate counts instead of the instructions")
+@click.option("--top", type=int, default=10, help="Number of entries in each statistics table")
+def analyze(file, pc, address, stats, top):
+    """Prints or summarises a trace FILE written by the trace command or run --trace."""
+    pcs = range(pc[0], pc[1] + 1) if pc else None
+    addresses = range(address[0], address[1] + 1) if address else None
+    try:
+        reader = TraceReader(file)
+    except TraceError as e:
+        raise click.ClickException(str(e))
+    with reader:
+        if not stats:
+            for record in reader.records(pcs, addresses):
+                click.echo(str(record))
+            return
+        result = reader.statistics(pcs, addresses)
+        click.echo(f"Instructions: {result['instructions']}")
+        click.echo("Hottest PCs:")
+        for key, count in result["pcs"].most_common(top):
+            click.echo(f"  {key:04X} {count:>12}")
+        click.echo("Opcodes:")
+        for key, count in result["opcodes"].most_common():
+            click.echo(f"  {key:<4} {count:>12}")
+        for title, counts in (("Reads:", result["reads"]), ("Writes:", result["writes"])):
+            click.echo(title)
+            for key, count in counts.most_common(top):
+                click.echo(f"  {key:04X} {count:>12}")
+
+
+@main.command(name="disasm")
+@click.argument('rom', type=click.Path(exists=True, dir_okay=False))
+@click.option("--symbols", type=click.Path(exists=True, dir_okay=False),
+              help="Symbol file written by the assembler (default: ROM with a .sym extension)")
+@click.option("--output", type=click.File("w"), default="-", help="File receiving the assembler source")
+def disassemble(rom, symbols, output):
+    """Disassembles ROM into source that the assembler turns back into the same image."""
+    table = SymbolTable.for_rom(rom) if symbols is None else SymbolTable.load(symbols)
+    with open(rom, "rb") as f:
+        data = f.read()
+    output.write(source(data, table))
+
+
+@main.command()
+@click.argument('rom')
+@click.option("--circuit", type=click.Path(exists=True, dir_okay=False), default="logisim/brianiac.circ",
+              help="Logisim project containing the CPU circuit")
+@click.option("--max-instructions", type=BASED_INT, default=100000, help="Number of instructions to compare")
+@click.option("--stdin", type=click.File("rb"), help="File fed to the serial port as input")
+@click.option("--stdout", type=click.File("wb"), default="-", help="File receiving serial port output")
+def lockstep(rom, circuit, max_instructions, stdin, stdout):
+    """Runs ROM on the emulator and on the CPU circuit side by side until their state differs."""
+    serial = Serial(stdin.fileno() if stdin else None, stdout.fileno())
+    debugger = Debugger(rom, serial)
+    try:
+        hardware = Hardware.load(circuit)
+    except CircuitError as e:
+        raise click.ClickException(str(e))
+    checker = Lockstep(debugger.cpu, hardware)
+    start = time.perf_counter()
+    divergence = checker.run(max_instructions)
+    elapsed = time.perf_counter() - start
+    serial.flush()
+    if divergence is not None:
+        click.echo(str(divergence))
+        sys.exit(1)
+    click.echo(f"agree: {checker.instructions} instructions, {hardware.cycles} cycles, "
+               f"{hardware.cycles / max(elapsed, 1e-9):.0f} cycles/s")
+
+
 if __name__ == "__main__":
     main()
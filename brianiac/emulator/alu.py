@@ -18,31 +18,49 @@
 from brianiac.emulator.decoder import Opcode, DecodeError
 
 
+def flags(func, rn, rm, r):
+    status = 0
+    if r == 0:
+        status |= 2
+    if r & 0x8000:
+        status |= 4
+    if func in (0, 1, 8):
+        if r > 0xffff or r < 0:
+            status |= 1
+        if rn & 0x8000 == rm & 0x8000 and r & 0x8000 != rn & 0x8000:
+            status |= 8
+    return status
+
+
 class ALU(object):
     def __init__(self):
+        self._operations = [None] * 16
+        for func, name in Opcode.instruction_map[0b001].items():
+            self._operations[func] = getattr(self, name)
         self.reset()
 
     def reset(self):
         self.status = 0
 
+    @property
+    def status(self):
+        if self.pending is not None:
+            self._status = flags(*self.pending)
+            self.pending = None
+        return self._status
+
+    @status.setter
+    def status(self, value):
+        self._status = value
+        self.pending = None
+
     def execute(self, func, rn, rm):
-        status = 0
-        op = Opcode.instruction_map[0b001].get(func, None)
-        if op is None:
+        function = self._operations[func]
+        if function is None:
             raise DecodeError("Invalid ALU operation")
-        function = getattr(self, op)
         r = function(rn & 0xffff, rm & 0xffff)
-        if r == 0:
-            status |= 2
-        if r & 0x8000:
-            status |= 4
-        if func in (0, 1, 8):
-            if r > 0xffff or r < 0:
-                status |= 1
-            if rn & 0x8000 == rm & 0x8000 and r & 0x8000 != rn & 0x8000:
-                status |= 8
-        self.status = status
-        return r & 0xffff, status
+        self.pending = (func, rn, rm, r)
+        return r & 0xffff
 
     def ADD(self, rn, rm):
         r = rn + rm + (self.status & 1)
@@ -0,0 +1,131 @@
+# Copyright 2022 Brian Johnson
+#
+# This file is part of brianiac
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, see <http://www.gnu.org/licenses/>.
+
+from collections import Counter
+from brianiac.emulator.decoder import decode_table
+
+CLASSES = {
+    "NOP": "nop",
+    "ADD": "alu", "SUB": "alu", "AND": "alu", "OR": "alu", "XOR": "alu",
+    "NOT": "alu", "SHR": "alu", "SHL": "alu", "CP": "alu", "TEST": "alu",
+    "BRA": "branch", "BZ": "branch", "BNZ": "branch", "BC": "branch", "BNC": "branch",
+    "CALL": "call", "RET": "call",
+    "MOV": "move",
+    "LDW": "load", "LDB": "load",
+    "STW": "store", "STB": "store",
+}
+CONDITIONAL = ("BZ", "BNZ", "BC", "BNC")
+
+
+# The hot paths only ever bump a list slot: the interpreter counts executed
+# opcode words and taken conditional branches, translated blocks count their
+# own runs and taken exits, and loads/stores count the page they touch. All
+# per-class and per-device numbers are derived from those when read, which
+# keeps the counters cheap enough to leave on. Only pages shared by several
+# devices count accesses per device range, in the CPU's dispatcher for them.
+class Counters(object):
+    def __init__(self, cpu):
+        self.cpu = cpu
+        self.executed = [0] * 0x10000
+        self.taken = [0]
+        self.pages = len(cpu._read8)
+        self.reads = [0] * self.pages
+        self.writes = [0] * self.pages
+        self.device_reads = Counter()
+        self.device_writes = Counter()
+
+    def retire(self, block):
+        runs, taken = block.counts
+        for word in block.words:
+            self.executed[word] += runs
+        self.taken[0] += taken
+
+    def unretire(self, words):
+        """Takes back one run of words a block counted on entry but left without executing."""
+        for word in words:
+            self.executed[word] -= 1
+
+    def reset(self):
+        self.executed[:] = [0] * 0x10000
+        self.taken[0] = 0
+        self.reads[:] = [0] * self.pages
+        self.writes[:] = [0] * self.pages
+        self.device_reads.clear()
+        self.device_writes.clear()
+        if self.cpu.translator is not None:
+            for block in self.cpu.translator.blocks.values():
+                block.counts[:] = [0, 0]
+
+    def _regions(self, page):
+        size = 0x10000 // self.pages
+        start = page * size
+        return [r for r in self.cpu.memory_map if r.start < start + size and r.stop > start]
+
+    def shared(self, page):
+        """True if the page is not all one device, so its accesses are counted per device range."""
+        size = 0x10000 // self.pages
+        regions = self._regions(page)
+        return bool(regions) and not (len(regions) == 1 and regions[0].start <= page * size and
+                                      regions[0].stop >= (page + 1) * size)
+
+    def _device_name(self, r):
+        if r is None:
+            return "unmapped"
+        return f"{type(self.cpu.memory_map[r]).__name__} {r.start:04X}-{r.stop - 1:04X}"
+
+    def snapshot(self):
+        names = decode_table().names
+        executed = Counter()
+        for word, count in enumerate(self.executed):
+            if count:
+                executed[word] = count
+        taken = self.taken[0]
+        if self.cpu.translator is not None:
+            for block in self.cpu.translator.blocks.values():
+                runs, block_taken = block.counts
+                if runs:
+                    for word in block.words:
+                        executed[word] += runs
+                    taken += block_taken
+        opcodes = Counter()
+        for word, count in executed.items():
+            if names[word] is not None:
+                opcodes[names[word]] += count
+        classes = Counter()
+        for name, count in opcodes.items():
+            classes[CLASSES[name]] += count
+        conditional = sum(opcodes[name] for name in CONDITIONAL)
+        pages = {"reads": Counter(), "writes": Counter()}
+        devices = {"reads": Counter(), "writes": Counter()}
+        for kind, counts, device_counts in (("reads", self.reads, self.device_reads),
+                                            ("writes", self.writes, self.device_writes)):
+            for page, count in enumerate(counts):
+                if count:
+                    pages[kind][page] = count
+                    if not self.shared(page):
+                        regions = self._regions(page)
+                        devices[kind][self._device_name(regions[0] if regions else None)] += count
+            for r, count in device_counts.items():
+                devices[kind][self._device_name(r)] += count
+        return {
+            "instructions": sum(opcodes.values()),
+            "classes": classes,
+            "opcodes": opcodes,
+            "branches": {"taken": taken, "not_taken": conditional - taken},
+            "pages": pages,
+            "devices": devices,
+        }
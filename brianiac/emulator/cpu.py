@@ -17,26 +17,101 @@
 
 from brianiac.emulator.alu import ALU
 from brianiac.emulator.registers import Registers
-from brianiac.emulator.decoder import Opcode
+from brianiac.emulator.decoder import Opcode, DecodeError, decode_table
+from brianiac.emulator.translator import Translator
+from brianiac.emulator.counters import Counters
+from brianiac.emulator.device import Device
+from brianiac.emulator.timing import CYCLES_PER_INSTRUCTION
+from contextlib import contextmanager
+from enum import Enum
 import signal
+import sys
+import threading
+
+
+PAGE_SHIFT = 8
+PAGE_SIZE = 1 << PAGE_SHIFT
+PAGE_COUNT = 0x10000 >> PAGE_SHIFT
 
 
 class MemoryAccessError(Exception):
     pass
 
 
+class StopReason(Enum):
+    LIMIT = 1
+    BREAKPOINT = 2
+    INTERRUPT = 3
+    HALT = 4
+    INVALID = 5
+    WATCHPOINT = 6
+    FAULT = 7
+
+
+def _unmapped_read8(offset):
+    return 0xff
+
+
+def _unmapped_read16(offset):
+    return 0xffff
+
+
+def _unmapped_write(offset, value):
+    pass
+
+
 class CPU(object):
-    def __init__(self):
-        self.registers = Registers()
+    _dispatch = None
+
+    def __init__(self, translate=False):
         self.alu = ALU()
+        self.registers = Registers(self.alu)
         self.memory_map = {}
+        self._read_hooks = {}
+        self._write_hooks = {}
+        self._read8 = [(_unmapped_read8, 0)] * PAGE_COUNT
+        self._read16 = [(_unmapped_read16, 0)] * PAGE_COUNT
+        self._peek8 = list(self._read8)
+        self._peek16 = list(self._read16)
+        self._write8 = [(_unmapped_write, 0)] * PAGE_COUNT
+        self._write16 = [(_unmapped_write, 0)] * PAGE_COUNT
+        if CPU._dispatch is None:
+            CPU._dispatch = CPU._build_dispatch()
+        self.counters = Counters(self)
+        self.translator = Translator(self) if translate else None
+        self.instructions = 0
+        self.interrupted = False
+        self.stop_request = None
+        self.observers = []
+        self.throttle = None
+
+    @staticmethod
+    def _build_dispatch():
+        table = decode_table()
+        invalid = (CPU.INVALID, Opcode(0))
+        dispatch = []
+        for opcode, name in zip(table.opcodes, table.names):
+            if name is None:
+                dispatch.append(invalid)
+            elif opcode._grp == 0b001:
+                dispatch.append((CPU.ALU, opcode))
+            else:
+                dispatch.append((getattr(CPU, name), opcode))
+        return dispatch
+
+    @property
+    def cycles(self):
+        return self.instructions * CYCLES_PER_INSTRUCTION
 
     def reset(self):
         self.registers.reset()
-        self.ALU.reset()
+        self.alu.reset()
 
 #   Memory Map Functions
     def map(self, start, end, device):
+        if not isinstance(device, Device):
+            raise TypeError(f"{type(device).__name__} is not a Device")
+
         def overlap(start1, end1, start2, end2):
             return end1 >= start2 and end2 >= start1
 
@@ -46,69 +121,420 @@ class CPU(object):
 
         r = range(start, end+1)
         self.memory_map[r] = device
-
-    def _lookup_memory_handler(self, address):
-        for r in self.memory_map:
+        for page in range(start >> PAGE_SHIFT, (end >> PAGE_SHIFT) + 1):
+            self._map_page(page)
+
+    def _map_page(self, page):
+        start = page << PAGE_SHIFT
+        end = start + PAGE_SIZE
+        regions = [(r, d) for r, d in self.memory_map.items() if r.start < end and r.stop > start]
+        whole = len(regions) == 1 and regions[0][0].start <= start and regions[0][0].stop >= end
+        counters = self.counters
+        for table, peek, name, default, counts in (
+                (self._read8, self._peek8, "readu8", _unmapped_read8, counters.device_reads),
+                (self._read16, self._peek16, "readu16", _unmapped_read16, counters.device_reads),
+                (self._write8, None, "writeu8", _unmapped_write, counters.device_writes),
+                (self._write16, None, "writeu16", _unmapped_write, counters.device_writes)):
+            if not regions:
+                table[page] = (default, 0)
+            elif whole:
+                r, device = regions[0]
+                table[page] = (self._handler(device, name) or default, r.start)
+            else:
+                table[page] = (self._partial_page(regions, name, default, counts), 0)
+            if peek is not None:
+                peek[page] = table[page] if whole or not regions else (self._partial_page(regions, name, default), 0)
+        hooks = self._read_hooks.get(page)
+        if hooks:
+            for table, size in ((self._read8, 1), (self._read16, 2)):
+                table[page] = (self._hooked_read(tuple(hooks), size, *table[page]), table[page][1])
+        hooks = self._write_hooks.get(page)
+        if hooks:
+            for table, size in ((self._write8, 1), (self._write16, 2)):
+                table[page] = (self._hooked_write(tuple(hooks), size, *table[page]), table[page][1])
+
+    @staticmethod
+    def _hooked_read(hooks, size, handler, base):
+        def read(offset):
+            value = handler(offset)
+            for hook in hooks:
+                hook(base + offset, size, value)
+            return value
+        return read
+
+    @staticmethod
+    def _hooked_write(hooks, size, handler, base):
+        def write(offset, value):
+            for hook in hooks:
+                hook(base + offset, size, value)
+            handler(offset, value)
+        return write
+
+    def _add_hook(self, hooks, page, hook):
+        hooks.setdefault(page, []).append(hook)
+        self._map_page(page)
+
+    def _remove_hook(self, hooks, page, hook):
+        page_hooks = hooks.get(page, [])
+        if hook in page_hooks:
+            page_hooks.remove(hook)
+            if not page_hooks:
+                del hooks[page]
+            self._map_page(page)
+
+    def add_read_hook(self, page, hook):
+        self._add_hook(self._read_hooks, page, hook)
+
+    def remove_read_hook(self, page, hook):
+        self._remove_hook(self._read_hooks, page, hook)
+
+    def add_write_hook(self, page, hook):
+        self._add_hook(self._write_hooks, page, hook)
+
+    def remove_write_hook(self, page, hook):
+        self._remove_hook(self._write_hooks, page, hook)
+
+    def writable(self, page):
+        start = page << PAGE_SHIFT
+        end = start + PAGE_SIZE
+        for r, device in self.memory_map.items():
+            if r.start < end and r.stop > start:
+                if not device.read_only:
+                    return True
+        return False
+
+    @staticmethod
+    def _handler(device, name):
+        if (16 if name.endswith("16") else 8) not in device.widths:
+            return None
+        if device.read_only and name.startswith("write"):
+            return None
+        return getattr(device, name)
+
+    @staticmethod
+    def _partial_page(regions, name, default, counts=None):
+        # Page counters cannot tell apart devices sharing a page, so their
+        # accesses are counted here by range, with None for the gaps.
+        handlers = [(r, CPU._handler(device, name)) for r, device in regions]
+
+        def access(address, *args):
+            for r, handler in handlers:
+                if address in r:
+                    if counts is not None:
+                        counts[r] += 1
+                    if handler is None:
+                        return default(address, *args)
+                    return handler(address - r.start, *args)
+            if counts is not None:
+                counts[None] += 1
+            return default(address, *args)
+        return access
+
+    def device_at(self, address):
+        for r, device in self.memory_map.items():
             if address in r:
-                return (self.memory_map[r], address - r.start)
+                return (device, address - r.start)
         return (None, 0)
 
     def readu8(self, address):
-        handler, offset = self._lookup_memory_handler(address)
-        if handler and hasattr(handler, "readu8"):
-            return handler.readu8(offset)
-        return 0xff
+        handler, base = self._read8[address >> PAGE_SHIFT]
+        return handler(address - base)
 
     def readu16(self, address):
-        handler, offset = self._lookup_memory_handler(address)
-        if offset % 2 != 0:
+        handler, base = self._read16[address >> PAGE_SHIFT]
+        offset = address - base
+        if offset & 1:
+            raise MemoryAccessError(f"offset 0x{offset:02x} is not word aligned")
+        return handler(offset)
+
+    def peeku8(self, address):
+        handler, base = self._peek8[address >> PAGE_SHIFT]
+        return handler(address - base)
+
+    def peeku16(self, address):
+        handler, base = self._peek16[address >> PAGE_SHIFT]
+        offset = address - base
+        if offset & 1:
             raise MemoryAccessError(f"offset 0x{offset:02x} is not word aligned")
-        if handler and hasattr(handler, "readu16"):
-            return handler.readu16(offset)
-        return 0xffff
+        return handler(offset)
 
     def writeu8(self, address, value):
-        handler, offset = self._lookup_memory_handler(address)
-        if handler and hasattr(handler, "writeu8"):
-            handler.writeu8(offset, value)
+        handler, base = self._write8[address >> PAGE_SHIFT]
+        handler(address - base, value)
 
     def writeu16(self, address, value):
-        handler, offset = self._lookup_memory_handler(address)
-        if offset % 2 != 0:
+        handler, base = self._write16[address >> PAGE_SHIFT]
+        offset = address - base
+        if offset & 1:
             raise MemoryAccessError(f"offset 0x{offset:02x} is not word aligned")
-        if handler and hasattr(handler, "writeu16"):
-            handler.writeu16(offset, value)
+        handler(offset, value)
+
+    def _regions(self, address, length):
+        if address < 0 or length < 0 or address + length > 0x10000:
+            raise ValueError(f"block 0x{address:04X}+0x{length:X} is outside the address space")
+        end = address + length
+        regions = sorted(self.memory_map.items(), key=lambda item: item[0].start)
+        while address < end:
+            for r, device in regions:
+                if address in r:
+                    stop = min(end, r.stop)
+                    yield address, stop, device, address - r.start
+                    break
+                if r.start > address:
+                    stop = min(end, r.start)
+                    yield address, stop, None, 0
+                    break
+            else:
+                stop = end
+                yield address, stop, None, 0
+            address = stop
+
+    def read_block(self, address, length):
+        data = bytearray()
+        for start, stop, device, offset in self._regions(address, length):
+            if device is None:
+                data += b"\xff" * (stop - start)
+            elif device.buffered:
+                with device.buffer(offset, stop - start) as view:
+                    data += view
+            else:
+                data += bytes(self.peeku8(a) for a in range(start, stop))
+        return bytes(data)
+
+    def write_block(self, address, data):
+        with memoryview(data) as source:
+            for start, stop, device, offset in self._regions(address, len(source)):
+                if device is None or device.read_only:
+                    continue
+                while start < stop:
+                    page_stop = min(stop, ((start >> PAGE_SHIFT) + 1) << PAGE_SHIFT)
+                    chunk = source[start - address:page_stop - address]
+                    if device.buffered and (start >> PAGE_SHIFT) not in self._write_hooks:
+                        with device.buffer(offset, len(chunk)) as view:
+                            view[:] = chunk
+                    else:
+                        for index, value in enumerate(chunk):
+                            self.writeu8(start + index, value)
+                    offset += len(chunk)
+                    start = page_stop
 
 #   CPU Cycle Functions
     def fetch(self):
-        data = self.readu16(self.registers.pc)
-        self.registers.pc += 2
+        data = self.peeku16(self.registers.pc)
+        self.registers.pc = (self.registers.pc + 2) & 0xffff
         return data
 
     def decode(self, inst):
-        op = Opcode(inst)
+        handler, op = self._dispatch[inst & 0xffff]
         if op.immediate:
-            self.registers.immediate = self.readu16(self.registers.pc)
-            self.registers.pc += 2
-        return op
+            self.registers.immediate = self.peeku16(self.registers.pc)
+            self.registers.pc = (self.registers.pc + 2) & 0xffff
+        return handler, op
 
-    def execute(self, opcode):
-        if opcode._grp == 0b001:
-            self.ALU(opcode)
-        else:
-            func = getattr(self, opcode.instruction)
-            func(opcode)
+    def execute(self, decoded):
+        handler, op = decoded
+        handler(self, op)
 
     def step(self):
+        pc = self.registers.pc
         try:
             signal.pthread_sigmask(signal.SIG_BLOCK, [signal.SIGINT])
-            inst = self.fetch()
-            opcode = self.decode(inst)
-            self.execute(opcode)
+            if self.observers:
+                self._step_observed()
+            else:
+                word = self.fetch()
+                self.counters.executed[word] += 1
+                self.execute(self.decode(word))
+            self.instructions += 1
+        except MemoryAccessError:
+            self.registers.pc = pc
+            raise
         finally:
             signal.pthread_sigmask(signal.SIG_UNBLOCK, [signal.SIGINT])
 
+    def request_stop(self, reason):
+        self.stop_request = reason
+        self.interrupted = True
+
+    @contextmanager
+    def interruptible(self):
+        self.interrupted = False
+        self.stop_request = None
+        previous = None
+        if threading.current_thread() is threading.main_thread():
+            previous = signal.signal(signal.SIGINT, self._interrupt)
+        try:
+            yield
+        finally:
+            if previous is not None:
+                signal.signal(signal.SIGINT, previous)
+
+    def run(self, max_instructions=None, stop_pcs=()):
+        limit = sys.maxsize if max_instructions is None else max_instructions
+        with self.interruptible():
+            try:
+                if self.throttle is not None:
+                    reason = self._run_throttled(limit, stop_pcs)
+                else:
+                    reason = self._run(limit, stop_pcs)
+            except DecodeError:
+                return StopReason.INVALID
+            except MemoryAccessError:
+                return StopReason.FAULT
+        if reason == StopReason.INTERRUPT and self.stop_request is not None:
+            return self.stop_request
+        return reason
+
+    def _run(self, limit, stop_pcs):
+        if self.observers:
+            return self._run_observed(limit, stop_pcs)
+        if self.translator is not None:
+            return self._run_blocks(limit, stop_pcs)
+        return self._run_steps(limit, stop_pcs)
+
+    def _run_throttled(self, limit, stop_pcs):
+        throttle = self.throttle
+        throttle.begin(self.cycles)
+        start = self.instructions
+        while True:
+            remaining = limit - (self.instructions - start)
+            chunk = min(remaining, throttle.slice())
+            reason = self._run(chunk, stop_pcs)
+            if reason != StopReason.LIMIT or chunk == remaining:
+                return reason
+            throttle.pace(self.cycles)
+
+    def _interrupt(self, signum, frame):
+        self.interrupted = True
+
+    def _run_steps(self, limit, stop_pcs):
+        regs = self.registers
+        dispatch = self._dispatch
+        peeku16 = self.peeku16
+        executed = self.counters.executed
+        count = 0
+        pc = regs.pc
+        try:
+            while True:
+                pc = regs.pc
+                if count and pc in stop_pcs:
+                    return StopReason.BREAKPOINT
+                if count >= limit:
+                    return StopReason.LIMIT
+                if self.interrupted:
+                    return StopReason.INTERRUPT
+                word = peeku16(pc)
+                executed[word] += 1
+                handler, op = dispatch[word]
+                next_pc = (pc + 2) & 0xffff
+                if op.immediate:
+                    regs.immediate = peeku16(next_pc)
+                    next_pc = (next_pc + 2) & 0xffff
+                regs.pc = next_pc
+                handler(self, op)
+                self.instructions += 1
+                count += 1
+        except MemoryAccessError:
+            regs.pc = pc
+            raise
+
+    def _step_observed(self):
+        table = decode_table()
+        pc = self.registers.pc
+        word = self.peeku16(pc)
+        name = table.names[word]
+        if name is None:
+            raise DecodeError(f"Invalid instruction 0x{word:04X}")
+        opcode = table.opcodes[word]
+        imm = None
+        if opcode.immediate:
+            imm = self.peeku16((pc + 2) & 0xffff)
+        for observer in self.observers:
+            observer.before(pc, name, opcode, imm)
+        self.counters.executed[word] += 1
+        self.execute(self.decode(self.fetch()))
+        for observer in self.observers:
+            observer.after(pc, name, opcode, imm)
+
+    def _run_observed(self, limit, stop_pcs):
+        regs = self.registers
+        # Observers have to see every instruction, so idle loops are never
+        # skipped here, but they still wait on the device and halt when they
+        # can never exit.
+        translator = self.translator if self.translator is not None else Translator(self)
+        count = 0
+        while True:
+            pc = regs.pc
+            if count and pc in stop_pcs:
+                return StopReason.BREAKPOINT
+            if count >= limit:
+                return StopReason.LIMIT
+            if self.interrupted:
+                return StopReason.INTERRUPT
+            try:
+                self._step_observed()
+            except MemoryAccessError:
+                regs.pc = pc
+                raise
+            self.instructions += 1
+            count += 1
+            if regs.pc <= pc and regs.pc not in stop_pcs:
+                idle, end = translator.idle_at(regs.pc)
+                if idle is not None and end == pc and idle(0) is None:
+                    return StopReason.HALT
+
+    def _run_blocks(self, limit, stop_pcs):
+        regs = self.registers
+        translator = self.translator
+        translator.set_boundaries(stop_pcs)
+        blocks = translator.blocks
+        executed = self.counters.executed
+        count = 0
+        while True:
+            pc = regs.pc
+            if count and pc in stop_pcs:
+                return StopReason.BREAKPOINT
+            if count >= limit:
+                return StopReason.LIMIT
+            if self.interrupted:
+                return StopReason.INTERRUPT
+            block = blocks.get(pc) or translator.translate(pc)
+            if block is None or limit - count < block.count:
+                word = self.fetch()
+                executed[word] += 1
+                try:
+                    self.execute(self.decode(word))
+                except MemoryAccessError:
+                    regs.pc = pc
+                    raise
+                self.instructions += 1
+                count += 1
+            else:
+                # A block counts all its instructions when it starts, so the
+                # ones skipped by an early exit or a fault are taken back.
+                start = self.instructions
+                try:
+                    ran = block.function(self)
+                except MemoryAccessError:
+                    ran = self.instructions - start
+                    regs.pc = block.address(ran)
+                    self.counters.unretire(block.words[ran + 1:])
+                    raise
+                if ran < block.count:
+                    self.counters.unretire(block.words[ran:])
+                count += ran
+                if block.idle is not None and regs.pc == pc:
+                    skipped = block.idle(limit - count)
+                    if skipped is None:
+                        return StopReason.HALT
+                    count += skipped
+
 #   Instructions
+    def INVALID(self, opcode):
+        self.registers.pc = (self.registers.pc - 2) & 0xffff
+        word = self.peeku16(self.registers.pc)
+        raise DecodeError(f"Invalid instruction 0x{word:04X}")
+
     def NOP(self, opcode):
         pass
 
@@ -118,8 +544,7 @@ class CPU(object):
         else:
             src = self.registers.get(opcode.rm)
         rn = self.registers.get(opcode.rn)
-        val, status = self.alu.execute(opcode._func, rn, src)
-        self.registers.status = status
+        val = self.alu.execute(opcode._func, rn, src)
         if opcode._func not in (0b1000, 0b1001):
             self.registers.set(opcode.rn, val)
 
@@ -135,6 +560,7 @@ class CPU(object):
             src = self.registers.immediate
         else:
             src = self.registers.get(opcode.rm)
+        self.counters.reads[src >> PAGE_SHIFT] += 1
         data = self.readu16(src)
         self.registers.set(opcode.rn, data)
 
@@ -143,6 +569,7 @@ class CPU(object):
             src = self.registers.immediate
         else:
             src = self.registers.get(opcode.rm)
+        self.counters.reads[src >> PAGE_SHIFT] += 1
         data = self.readu8(src)
         self.registers.set(opcode.rn, data)
 
@@ -152,6 +579,7 @@ class CPU(object):
         else:
             dst = self.registers.get(opcode.rn)
         data = self.registers.get(opcode.rm)
+        self.counters.writes[dst >> PAGE_SHIFT] += 1
         self.writeu16(dst, data & 0xffff)
 
     def STB(self, opcode):
@@ -160,6 +588,7 @@ class CPU(object):
         else:
             dst = self.registers.get(opcode.rn)
         data = self.registers.get(opcode.rm)
+        self.counters.writes[dst >> PAGE_SHIFT] += 1
         self.writeu8(dst, data & 0xff)
 
     def BRA(self, opcode):
@@ -170,7 +599,8 @@ class CPU(object):
         self.registers.pc = dst
 
     def BZ(self, opcode):
-        if self.registers.status & 2:
+        if self.alu.status & 2:
+            self.counters.taken[0] += 1
             if opcode.immediate:
                 dst = self.registers.immediate
             else:
@@ -178,7 +608,8 @@ class CPU(object):
             self.registers.pc = dst
 
     def BNZ(self, opcode):
-        if not (self.registers.status & 2):
+        if not (self.alu.status & 2):
+            self.counters.taken[0] += 1
             if opcode.immediate:
                 dst = self.registers.immediate
             else:
@@ -186,7 +617,8 @@ class CPU(object):
             self.registers.pc = dst
 
     def BC(self, opcode):
-        if self.registers.status & 1:
+        if self.alu.status & 1:
+            self.counters.taken[0] += 1
             if opcode.immediate:
                 dst = self.registers.immediate
             else:
@@ -194,7 +626,8 @@ class CPU(object):
             self.registers.pc = dst
 
     def BNC(self, opcode):
-        if not (self.registers.status & 1):
+        if not (self.alu.status & 1):
+            self.counters.taken[0] += 1
             if opcode.immediate:
                 dst = self.registers.immediate
             else:
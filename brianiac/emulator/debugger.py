@@ -15,73 +15,71 @@
 # You should have received a copy of the GNU General Public License
 # along with this program; if not, see <http://www.gnu.org/licenses/>.
 
-from brianiac.emulator.rom import ROM
-from brianiac.emulator.ram import RAM
+from brianiac.emulator.memorymap import DEFAULT_MEMORY_MAP, populate
 from brianiac.emulator.serial import Serial
-from brianiac.emulator.cpu import CPU
-from brianiac.emulator.decoder import Opcode, DecodeError
+from brianiac.emulator.cpu import CPU, MemoryAccessError, StopReason
+from brianiac.emulator.decoder import Opcode, DecodeError, decode_table
+from brianiac.emulator.disassembler import Disassembler, Instruction, format_data, format_instruction, operand_text
+from brianiac.emulator.history import History
+from brianiac.emulator.trace import Tracer
+from brianiac.emulator.profiler import Profiler
+from brianiac.emulator.symbols import SymbolTable
+from brianiac.emulator.timing import Throttle
+from brianiac.emulator.watchpoints import Watchpoints, KINDS
+from brianiac.emulator import snapshot
 
 
 class Debugger(object):
-    def __init__(self, romfile):
-        self.breakpoints = []
-        self.cpu = CPU()
-        self.cpu.map(0x0000, 0x1fff, ROM(0x2000, romfile))
-        self.cpu.map(0x2000, 0xefff, RAM(0xD000))
-        self.cpu.map(0xf000, 0xf001, Serial())
+    def __init__(self, romfile, serial=None, symbols=None, memory_map=None):
+        self.breakpoints = set()
+        self.history = None
+        self.tracer = None
+        self.profiler = None
+        self.symbols = SymbolTable.for_rom(romfile) if symbols is None else SymbolTable.load(symbols)
+        self.cpu = CPU(translate=True)
+        self.watchpoints = Watchpoints(self.cpu)
+        self.disassembler = Disassembler(self.cpu, self.symbols)
+        self.serial = Serial() if serial is None else serial
+        populate(self.cpu, DEFAULT_MEMORY_MAP if memory_map is None else memory_map, romfile, self.serial)
 
     def disassemble(self, pc=None):
         if pc is None:
             pc = self.cpu.registers.pc
-        op = Opcode(self.cpu.readu16(pc))
+        op = Opcode(self.cpu.peeku16(pc))
         try:
             name = op.instruction
         except DecodeError:
-            return f"DEFW 0x{op.word:04X}"
+            return format_data(self.cpu.read_block(pc, 2))
         imm = None
         if op.immediate:
-            imm = self.cpu.readu16(pc + 2)
-        if name in ("ADD", "SUB", "AND", "OR", "XOR", "CP", "TEST"):
-            if imm is None:
-                return f"{name} R{op.rn}, R{op.rm}"
-            else:
-                return f"{name} R{op.rn}, 0x{imm:04X}"
-        elif name in ("NOT", "SHL", "SHR"):
-            return f"{name} R{op.rn}"
-        elif name in ("LDB", "LDW", "MOV"):
-            at = "" if name == "MOV" else "@"
-            if imm is None:
-                return f"{name} R{op.rn}, {at}R{op.rm}"
-            else:
-                return f"{name} R{op.rn}, 0x{imm:04X}"
-        elif name in ("STB", "STW"):
-            if imm is None:
-                return f"{name} @R{op.rn}, R{op.rm}"
-            else:
-                return f"{name} 0x{imm:04X}, R{op.rm}"
-        elif name in ("BRA", "BZ", "BNZ", "BC", "BNC", "CALL"):
-            if imm is None:
-                return f"{name} @R{op.rm}"
-            else:
-                return f"{name} 0x{imm:04X}"
-        else:
-            return name
+            imm = self.cpu.peeku16(pc + 2)
+        entry = Instruction(pc, 4 if op.immediate else 2, op.word, imm)
+        return format_instruction(name, op, imm, operand_text(entry, self.symbols))
 
     def set_breakpoint(self, address):
-        if address not in self.breakpoints:
-            self.breakpoints.append(address)
+        self.breakpoints.add(address)
 
     def del_breakpoint(self, address):
-        if address in self.breakpoints:
-            self.breakpoints.remove(address)
+        self.breakpoints.discard(address)
+
+    def set_watchpoint(self, start, end=None, kind="write"):
+        self.watchpoints.add(start, end, KINDS[kind])
+
+    def del_watchpoint(self, start, end=None):
+        if not self.watchpoints.remove(start, end):
+            print("No such watchpoint")
+
+    def list_watchpoints(self):
+        for idx, watchpoint in enumerate(self.watchpoints):
+            print(f"{idx}: {watchpoint}")
 
     def list_breakpoints(self):
-        for idx, val in enumerate(self.breakpoints):
+        for idx, val in enumerate(sorted(self.breakpoints)):
             print(f"{idx}: {val:04X}")
 
     def registers(self):
         print(f" PC: {self.cpu.registers.pc:04X}  {self.disassemble()}")
-        print(f" ST: {self.cpu.registers.status:04X}")
+        print(f" ST: {self.cpu.registers.status:04X}  IC: {self.cpu.instructions}  CYC: {self.cpu.cycles}")
         for index in range(0, 16):
             if index < 10:
                 regstr = f" R{index}: {self.cpu.registers.get(index):04X}"
@@ -97,66 +95,187 @@ class Debugger(object):
             pc = self.cpu.registers.pc
         if count is None:
             count = 16
-        for _ in range(0, count):
-            instruction = self.disassemble(pc)
-            print(f"{pc:04X}: {instruction}")
-            if "0x" in instruction and "DEFW" not in instruction:
-                pc += 4
-            else:
-                pc += 2
+        for address, label, text in self.disassembler.listing(pc, count):
+            if label is not None:
+                print(f"{label}:")
+            print(f"{address:04X}: {text}")
 
     def step(self):
-        self.cpu.step()
+        self._step()
         self.registers()
 
-    def next(self):
-        def opcode_name():
-            pc = self.cpu.registers.pc
-            op = Opcode(self.cpu.readu16(pc))
-            try:
-                return op.instruction
-            except DecodeError:
-                return None
-
-        if opcode_name() == "CALL":
-            depth = 0
+    def _step(self):
+        try:
             self.cpu.step()
-            while (name := opcode_name()) != "RET" or depth != 0:
-                if (self.cpu.registers.pc in self.breakpoints):
+        except DecodeError:
+            self._report(StopReason.INVALID)
+        except MemoryAccessError:
+            self._report(StopReason.FAULT)
+        else:
+            self._report_watchpoint()
+
+    def next(self):
+        pc = self.cpu.registers.pc
+        word = self.cpu.peeku16(pc)
+        table = decode_table()
+        if table.names[word] == "CALL":
+            ret = (pc + (4 if table.opcodes[word].immediate else 2)) & 0xffff
+            sp = self.cpu.registers.get(14)
+            stop_pcs = self.breakpoints | {ret}
+            while True:
+                reason = self.cpu.run(stop_pcs=stop_pcs)
+                if reason != StopReason.BREAKPOINT or self.cpu.registers.pc != ret or self.cpu.registers.get(14) >= sp:
                     break
-                if name == "CALL":
-                    depth += 1
-                if name == "RET":
-                    depth -= 1
-                self.cpu.step()
-            if self.cpu.registers.pc not in self.breakpoints:
-                self.cpu.step()
+            self._report(reason)
         else:
-            self.cpu.step()
+            self._step()
         self.registers()
 
     def reset(self):
         self.cpu.reset()
+        self._restart_history()
         self.run()
 
     def run(self):
-        self.cpu.step()
-        while True:
-            if (self.cpu.registers.pc in self.breakpoints):
-                break
-            self.cpu.step()
+        self._report(self.cpu.run(stop_pcs=self.breakpoints))
+        self.registers()
+
+    def _report(self, reason):
+        if reason == StopReason.INTERRUPT:
+            print("Interrupted")
+        elif reason == StopReason.INVALID:
+            print("Invalid instruction")
+        elif reason == StopReason.FAULT:
+            print("Memory fault")
+        elif reason == StopReason.HALT:
+            print("Halted")
+        self._report_watchpoint()
+
+    def _report_watchpoint(self):
+        if self.watchpoints.hit is not None:
+            print(self.watchpoints.hit)
+            self.watchpoints.hit = None
+
+    def _restart_history(self):
+        # Undo records and checkpoints only make sense against the state they
+        # were taken from, so anything that replaces that state starts over.
+        if self.history is not None:
+            self.record(False)
+            self.record(True)
+
+    def record(self, enable):
+        if enable and self.history is None:
+            self.history = History(self.cpu)
+            self.cpu.observers.append(self.history)
+        elif not enable and self.history is not None:
+            self.cpu.observers.remove(self.history)
+            self.history = None
+
+    def trace(self, path=None):
+        if self.tracer is not None:
+            self.cpu.observers.remove(self.tracer)
+            self.tracer.close()
+            print(f"Wrote {self.tracer.count} instructions to {self.tracer.path}")
+            self.tracer = None
+        if path is not None:
+            self.tracer = Tracer(self.cpu, path)
+            self.cpu.observers.append(self.tracer)
+
+    def profile(self, enable):
+        if enable and self.profiler is None:
+            self.profiler = Profiler(self.cpu)
+            self.cpu.observers.append(self.profiler)
+        elif not enable and self.profiler is not None:
+            self.cpu.observers.remove(self.profiler)
+            self.profile_report()
+            self.profiler = None
+
+    def profile_report(self):
+        if self.profiler is None:
+            print("Profiling is not enabled")
+        else:
+            print(self.profiler.report(self.symbols))
+
+    def clock(self, frequency=None):
+        if frequency is not None:
+            self.cpu.throttle = Throttle(frequency) if frequency else None
+        if self.cpu.throttle is None:
+            print("Clock: unthrottled")
+        else:
+            print(f"Clock: {self.cpu.throttle.frequency} Hz")
+
+    def stats(self):
+        counters = self.cpu.counters.snapshot()
+        total = max(counters["instructions"], 1)
+        print(f"Instructions: {counters['instructions']}")
+        for name, count in counters["classes"].most_common():
+            print(f"  {name:<8} {count:>12} {100 * count / total:>6.1f}%")
+        branches = counters["branches"]
+        print(f"Conditional branches: {branches['taken']} taken, {branches['not_taken']} not taken")
+        print("Opcodes:")
+        for name, count in counters["opcodes"].most_common():
+            print(f"  {name:<8} {count:>12}")
+        for kind in ("reads", "writes"):
+            print(f"Memory {kind}:")
+            for device, count in counters["devices"][kind].most_common():
+                print(f"  {device:<24} {count:>12}")
+            for page, count in sorted(counters["pages"][kind].items()):
+                print(f"    page {page:02X}00 {count:>12}")
+
+    def reverse_step(self):
+        if self.history is None or not self.history.reverse_step():
+            print("No recorded history")
+        self.registers()
+
+    def reverse_continue(self):
+        if self.history is None:
+            print("No recorded history")
+        else:
+            reason = self.history.reverse_continue(self.breakpoints)
+            if reason == StopReason.LIMIT:
+                print("Reached start of recorded history")
+            else:
+                self._report(reason)
+        self.registers()
+
+    def goto(self, instruction):
+        if self.history is None:
+            print("No recorded history")
+        else:
+            try:
+                self._report(self.history.goto(instruction))
+            except ValueError as e:
+                print(e)
+            self.disassembler.flush()
+        self.registers()
+
+    def save_snapshot(self, path):
+        snapshot.save(self.cpu, path)
+
+    def load_snapshot(self, path):
+        snapshot.load(self.cpu, path)
+        self._restart_history()
+        self.disassembler.flush()
         self.registers()
 
     def memory_dump(self, start, end):
         def get_char(byte):
             return chr(byte) if byte >= 32 and byte < 127 else '.'
 
-        for idx in range(0, end - start, 16):
-            print(f"{start+idx:04X}:", end='')
-            len = min(end-(start+idx), 16)
-            ascii = ""
-            for address in range(start+idx, start+idx+len):
-                data = self.cpu.readu8(address)
-                ascii = ascii + get_char(data)
-                print(f" {data:02X}", end='')
-            print(f"{'   '*(16-len)} {ascii}")
+        end = min(end, 0x10000)
+        block = self.cpu.read_block(start, max(end - start, 0))
+        for idx in range(0, len(block), 16):
+            line = block[idx:idx+16]
+            ascii = "".join(get_char(data) for data in line)
+            hex = "".join(f" {data:02X}" for data in line)
+            print(f"{start+idx:04X}:{hex}{'   '*(16-len(line))} {ascii}")
+
+    def save_memory(self, path, start, end):
+        with open(path, "wb") as f:
+            f.write(self.cpu.read_block(start, min(end, 0x10000) - start))
+
+    def load_memory(self, path, start):
+        with open(path, "rb") as f:
+            data = f.read()
+        self.cpu.write_block(start, data)
+        print(f"Loaded {len(data)} bytes at {start:04X}")
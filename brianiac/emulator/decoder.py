@@ -20,6 +20,8 @@ class DecodeError(Exception):
 
 
 class Opcode(object):
+    __slots__ = ("word", "_grp", "immediate", "_func", "rn", "rm")
+
     instruction_map = {
             0b000: "NOP",
             0b001: {
@@ -72,3 +74,30 @@ class Opcode(object):
                 raise DecodeError("Invalid instruction")
             return inst
         return grp
+
+
+class DecodeTable(object):
+    __slots__ = ("opcodes", "names")
+
+    def __init__(self):
+        self.opcodes = [None] * 0x10000
+        self.names = [None] * 0x10000
+        for grp, entry in Opcode.instruction_map.items():
+            for func in range(16):
+                name = entry.get(func, None) if isinstance(entry, dict) else entry
+                if name is None:
+                    continue
+                base = (grp << 13) | (func << 9)
+                for word in range(base, base + 0x200):
+                    self.opcodes[word] = Opcode(word)
+                    self.names[word] = name
+
+
+_decode_table = None
+
+
+def decode_table():
+    global _decode_table
+    if _decode_table is None:
+        _decode_table = DecodeTable()
+    return _decode_table
@@ -0,0 +1,76 @@
+# Copyright 2022 Brian Johnson
+#
+# This file is part of brianiac
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, see <http://www.gnu.org/licenses/>.
+
+# Base class for everything that can be mapped into the CPU address space.
+# Offsets passed to the access methods are relative to the start of the
+# mapping. A device declares what it supports with class attributes, which
+# the CPU reads once when it builds its page tables:
+#   widths     access sizes in bits the device responds to; a 16 bit access
+#              to a device without 16 reads as 0xFFFF and writes nothing
+#   read_only  writes are dropped without reaching the device and the pages
+#              are not watched for self-modifying code
+#   buffered   buffer(offset, length) returns a memoryview of the backing
+#              store, which bulk transfers, snapshots and history use
+#              directly instead of going byte by byte
+#   wait       wait(offset, timeout) blocks for up to timeout seconds until a
+#              read at offset could return something new, and returns False
+#              if it never will; translated loops that only poll the device
+#              sleep in it instead of spinning
+#   next_change
+#              next_change(offset, size, cycles) returns the first cycle
+#              count after cycles at which a read at offset could return
+#              something other than it did at cycles, or None if it never
+#              will; translated loops that only poll the device skip ahead
+#              to that cycle instead of spinning. Reads at such offsets must
+#              not have side effects
+#   read_effects
+#              offsets whose reads change the device, such as one that takes
+#              a byte off a queue; history cannot undo those, so it treats
+#              loads from them like stores to a device
+# The default 16 bit accessors are two big-endian byte accesses, so a device
+# only has to override them when it decodes words itself. A device with state
+# of its own returns it as bytes from snapshot() and takes it back in
+# restore(); the default has none to save.
+class Device(object):
+    widths = (8, 16)
+    read_only = False
+    buffered = False
+    wait = None
+    next_change = None
+    read_effects = ()
+
+    def readu8(self, offset):
+        return 0xff
+
+    def readu16(self, offset):
+        return (self.readu8(offset) << 8) | self.readu8(offset + 1)
+
+    def writeu8(self, offset, value):
+        pass
+
+    def writeu16(self, offset, value):
+        self.writeu8(offset, (value >> 8) & 0xff)
+        self.writeu8(offset + 1, value & 0xff)
+
+    def buffer(self, offset, length):
+        raise NotImplementedError(f"{type(self).__name__} has no backing buffer")
+
+    def snapshot(self):
+        return None
+
+    def restore(self, data):
+        raise NotImplementedError(f"{type(self).__name__} has no saved state")
@@ -0,0 +1,345 @@
+# Copyright 2022 Brian Johnson
+#
+# This file is part of brianiac
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, see <http://www.gnu.org/licenses/>.
+
+import bisect
+import re
+import sys
+from array import array
+from brianiac.emulator.decoder import decode_table
+from brianiac.emulator.symbols import SymbolTable
+
+PAGE_SHIFT = 8
+DATA_BYTES_PER_LINE = 8
+FILL_THRESHOLD = 16
+
+ALU_BINARY = ("ADD", "SUB", "AND", "OR", "XOR", "CP", "TEST")
+ALU_UNARY = ("NOT", "SHR", "SHL")
+BRANCHES = ("BRA", "BZ", "BNZ", "BC", "BNC", "CALL")
+
+_sizes = None
+_code = re.compile(b"[^\x00]")
+
+
+def _canonical(name, opcode):
+    # Operand fields the assembler fills in for each form, so that only words
+    # it could have produced are listed as instructions.
+    n, m, immediate = opcode.rn, opcode.rm, opcode.immediate
+    if name in ALU_BINARY or name in ("LDW", "LDB", "MOV"):
+        return not immediate or m == 0
+    if name in ALU_UNARY:
+        return not immediate and m == 0
+    if name in ("STW", "STB"):
+        return not immediate or n == 0
+    if name == "CALL":
+        return n == 15 and (not immediate or m == 0)
+    if name in BRANCHES:
+        return n == 0 and (not immediate or m == 0)
+    if name == "RET":
+        return not immediate and n == 0 and m == 15
+    return False
+
+
+def instruction_sizes():
+    """Maps every instruction word to its size in bytes, or 0 if it is data."""
+    global _sizes
+    if _sizes is None:
+        table = decode_table()
+        _sizes = bytes((4 if opcode.immediate else 2) if name is not None and _canonical(name, opcode) else 0
+                       for name, opcode in zip(table.names, table.opcodes))
+    return _sizes
+
+
+class Instruction(object):
+    __slots__ = ("address", "size", "word", "imm", "name", "opcode", "data")
+
+    def __init__(self, address, size, word=None, imm=None, data=None):
+        self.address = address
+        self.size = size
+        self.word = word
+        self.imm = imm
+        self.data = data
+        table = decode_table()
+        self.name = None if word is None else table.names[word]
+        self.opcode = None if word is None else table.opcodes[word]
+
+    @property
+    def end(self):
+        return self.address + self.size
+
+    @property
+    def target(self):
+        if self.name in BRANCHES and self.imm is not None:
+            return self.imm
+        return None
+
+
+def sweep(data, origin=0, final=True):
+    """Linear sweep over an image, returning instructions and data runs.
+
+    Instruction sizes are looked up for the whole word array at once and runs
+    of data words are skipped with a single search. With final False a
+    trailing instruction that is missing its immediate is left unconsumed so
+    a later call can continue from the returned end address.
+    """
+    count = len(data) // 2
+    words = array("H", bytes(data[:count * 2]))
+    if sys.byteorder == "little":
+        words.byteswap()
+    sizes = bytes(map(instruction_sizes().__getitem__, words))
+    entries = []
+    index = 0
+    while index < count:
+        size = sizes[index]
+        address = origin + index * 2
+        if size == 0:
+            match = _code.search(sizes, index)
+            stop = match.start() if match else count
+            entries.append(Instruction(address, (stop - index) * 2, data=bytes(data[index * 2:stop * 2])))
+            index = stop
+        elif size == 4:
+            if index + 1 >= count:
+                if not final:
+                    break
+                entries.append(Instruction(address, 2, data=bytes(data[index * 2:index * 2 + 2])))
+                index += 1
+            else:
+                entries.append(Instruction(address, 4, words[index], words[index + 1]))
+                index += 2
+        else:
+            entries.append(Instruction(address, 2, words[index]))
+            index += 1
+    end = origin + index * 2
+    if final and len(data) & 1:
+        entries.append(Instruction(end, 1, data=bytes(data[-1:])))
+        end += 1
+    return entries, end
+
+
+def format_instruction(name, opcode, imm, operand=None):
+    if operand is None and imm is not None:
+        operand = f"0x{imm:04x}"
+    n, m = opcode.rn, opcode.rm
+    mnemonic = name.lower()
+    if name in ALU_BINARY:
+        return f"{mnemonic} r{n}, {operand if imm is not None else f'r{m}'}"
+    if name in ALU_UNARY:
+        return f"{mnemonic} r{n}"
+    if name in ("LDW", "LDB"):
+        return f"{mnemonic} r{n}, {operand if imm is not None else f'@r{m}'}"
+    if name == "MOV":
+        return f"{mnemonic} r{n}, {operand if imm is not None else f'r{m}'}"
+    if name in ("STW", "STB"):
+        return f"{mnemonic} {operand if imm is not None else f'@r{n}'}, r{m}"
+    if name in BRANCHES:
+        return f"{mnemonic} {operand if imm is not None else f'@r{m}'}"
+    return mnemonic
+
+
+def format_data(data):
+    if len(data) >= FILL_THRESHOLD and data.count(data[0]) == len(data):
+        return f"defn 0x{data[0]:02x}, 0x{len(data):04x}"
+    return "defb " + ", ".join(f"0x{byte:02x}" for byte in data)
+
+
+def data_lines(entry, start=None):
+    """Splits a data run into (address, bytes) pieces of at most one listing line."""
+    offset = 0 if start is None else start - entry.address
+    data = entry.data
+    if len(data) - offset >= FILL_THRESHOLD and data.count(data[offset], offset) == len(data) - offset:
+        yield entry.address + offset, data[offset:]
+        return
+    for index in range(offset, len(data), DATA_BYTES_PER_LINE):
+        yield entry.address + index, data[index:index + DATA_BYTES_PER_LINE]
+
+
+def operand_text(entry, symbols, labels=None):
+    if entry.imm is None:
+        return None
+    if entry.name in BRANCHES:
+        name = symbols.name(entry.imm)
+        if name is None and labels is not None:
+            name = labels.get(entry.imm)
+        return name
+    if entry.name in ("LDW", "LDB", "STW", "STB"):
+        return symbols.name(entry.imm)
+    return None
+
+
+def source(data, symbols=None):
+    """Returns assembler source that re-assembles to exactly the bytes of data."""
+    symbols = symbols or SymbolTable()
+    entries, end = sweep(data)
+    boundaries = set()
+    for entry in entries:
+        if entry.name is None:
+            boundaries.update(range(entry.address, entry.end))
+        else:
+            boundaries.add(entry.address)
+    labels = {}
+    for entry in entries:
+        target = entry.target
+        if target is not None and target in boundaries and symbols.name(target) is None:
+            labels[target] = f"l{target:04x}"
+    for address, name in symbols.addresses.items():
+        if address in boundaries:
+            labels[address] = name
+
+    lines = []
+    used = {symbols.name(entry.imm) for entry in entries if operand_text(entry, symbols) is not None}
+    for name in sorted(used, key=symbols.lookup):
+        if symbols.lookup(name) not in boundaries or labels.get(symbols.lookup(name)) != name:
+            lines.append(f"{name} equ 0x{symbols.lookup(name):04x}")
+    if lines:
+        lines.append("")
+    for entry in entries:
+        if entry.name is None:
+            cuts = sorted(address for address in labels if entry.address <= address < entry.end)
+            starts = [entry.address] + [address for address in cuts if address != entry.address]
+            for index, start in enumerate(starts):
+                stop = starts[index + 1] if index + 1 < len(starts) else entry.end
+                if start in labels:
+                    lines.append(f"{labels[start]}:")
+                piece = Instruction(start, stop - start, data=entry.data[start - entry.address:stop - entry.address])
+                for address, chunk in data_lines(piece):
+                    lines.append(f"    {format_data(chunk):<40}; {address:04X}")
+        else:
+            if entry.address in labels:
+                lines.append(f"{labels[entry.address]}:")
+            text = format_instruction(entry.name, entry.opcode, entry.imm, operand_text(entry, symbols, labels))
+            lines.append(f"    {text:<40}; {entry.address:04X}")
+    return "\n".join(lines) + "\n"
+
+
+class _Region(object):
+    __slots__ = ("start", "stop", "entries", "addresses", "swept", "hooked")
+
+    def __init__(self, start, stop):
+        self.start = start
+        self.stop = stop
+        self.entries = []
+        self.addresses = []
+        self.swept = start
+        self.hooked = set()
+
+
+# Listings are swept lazily per mapped region and kept until the code changes.
+# Only swept pages that can be written get a write hook, and the hook removes
+# itself along with the rest of the region's listing from that page onward,
+# so ordinary RAM traffic goes back to the fast path after the first write.
+class Disassembler(object):
+    def __init__(self, cpu, symbols=None):
+        self.cpu = cpu
+        self.symbols = symbols or SymbolTable()
+        self._regions = {}
+
+    def flush(self):
+        for region in list(self._regions.values()):
+            self._truncate(region, region.start)
+        self._regions = {}
+
+    def _region(self, address):
+        for r in self.cpu.memory_map:
+            if address in r:
+                region = self._regions.get(r.start)
+                if region is None:
+                    region = self._regions[r.start] = _Region(r.start, r.stop)
+                return region
+        return None
+
+    def _extend(self, region, until):
+        if region.swept >= min(until, region.stop):
+            return
+        stop = min(region.stop, ((until >> PAGE_SHIFT) + 1) << PAGE_SHIFT)
+        data = self.cpu.read_block(region.swept, min(region.stop, stop + 2) - region.swept)
+        final = stop + 2 >= region.stop
+        entries, end = sweep(data[:region.stop - region.swept] if final else data, region.swept, final)
+        for entry in entries:
+            if not final and entry.end > stop:
+                if entry.name is not None or entry.address >= stop:
+                    break
+                entry = Instruction(entry.address, stop - entry.address, data=entry.data[:stop - entry.address])
+            region.entries.append(entry)
+            region.addresses.append(entry.address)
+            region.swept = entry.end
+        for page in range(region.start >> PAGE_SHIFT, ((region.swept - 1) >> PAGE_SHIFT) + 1):
+            if page not in region.hooked and self.cpu.writable(page):
+                region.hooked.add(page)
+                self.cpu.add_write_hook(page, self._written)
+
+    def _truncate(self, region, address):
+        index = bisect.bisect_right(region.addresses, address) - 1
+        if index >= 0 and region.entries[index].end > address:
+            address = region.entries[index].address
+        else:
+            index += 1
+        del region.entries[index:]
+        del region.addresses[index:]
+        region.swept = max(region.start, min(region.swept, address))
+        for page in [page for page in region.hooked if (page + 1) << PAGE_SHIFT > address]:
+            region.hooked.discard(page)
+            self.cpu.remove_write_hook(page, self._written)
+
+    def _written(self, address, size=1, value=None):
+        region = self._region(address)
+        if region is not None:
+            self._truncate(region, (address >> PAGE_SHIFT) << PAGE_SHIFT)
+
+    def _entry(self, address):
+        region = self._region(address)
+        if region is None:
+            return None
+        self._extend(region, address + 4)
+        index = bisect.bisect_right(region.addresses, address) - 1
+        if index < 0:
+            return None
+        entry = region.entries[index]
+        if entry.name is not None and entry.address != address:
+            return None
+        if entry.end <= address:
+            return None
+        return entry
+
+    def instructions(self, address):
+        """Yields listing entries from address, following the cached sweep where it agrees."""
+        while address < 0x10000:
+            entry = self._entry(address)
+            if entry is None:
+                data = self.cpu.read_block(address, min(4, 0x10000 - address))
+                entry = sweep(data, address)[0][0]
+                if entry.name is None:
+                    entry = Instruction(address, 2, data=data[:2])
+            yield entry
+            address = entry.end
+
+    def listing(self, address, count):
+        lines = []
+        for entry in self.instructions(address):
+            if entry.name is None:
+                for start, chunk in data_lines(entry, address):
+                    lines.append((start, self._label(start), format_data(chunk)))
+                    if len(lines) >= count:
+                        return lines
+            else:
+                text = format_instruction(entry.name, entry.opcode, entry.imm, operand_text(entry, self.symbols))
+                lines.append((entry.address, self._label(entry.address), text))
+                if len(lines) >= count:
+                    return lines
+            address = entry.end
+        return lines
+
+    def _label(self, address):
+        return self.symbols.name(address)
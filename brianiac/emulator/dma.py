@@ -0,0 +1,118 @@
+# Copyright 2022 Brian Johnson
+#
+# This file is part of brianiac
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, see <http://www.gnu.org/licenses/>.
+
+import struct
+from brianiac.emulator.device import Device
+
+SOURCE = 0
+TARGET = 1
+LENGTH = 2
+FILL = 3
+CONTROL = 4
+
+COPY = 1
+FILL_BYTES = 2
+ERROR = 0x80
+
+_state = struct.Struct(">4HB")
+
+
+# Block copy and fill engine. The registers are big-endian words:
+#   +0 SRC   source address for a copy
+#   +2 DST   destination address
+#   +4 LEN   number of bytes
+#   +6 FILL  the low byte is the value stored by a fill
+#   +8 CTRL  writing 1 copies, writing 2 fills; reads 0 when the last
+#            command completed and 0x80 when it was rejected or stopped at
+#            the top of the address space
+# A command runs to completion inside the store that starts it. SRC and DST
+# are left just past the bytes transferred and LEN holds what was not done,
+# so firmware can carry on from there. A copy gives the same result as a
+# forward byte loop, including when the destination overlaps the source.
+# Memory is read without side effects and written through the CPU write
+# path, so watchpoints and the translator see the stores.
+class DMA(Device):
+    def __init__(self, cpu):
+        self.cpu = cpu
+        self.registers = [0] * CONTROL
+        self.status = 0
+        self.transferred = 0
+
+    def readu16(self, offset):
+        index = offset >> 1
+        if index == CONTROL:
+            return self.status
+        if index < CONTROL:
+            return self.registers[index]
+        return 0
+
+    def readu8(self, offset):
+        value = self.readu16(offset & ~1)
+        return value & 0xff if offset & 1 else value >> 8
+
+    def writeu16(self, offset, value):
+        index = offset >> 1
+        if index == CONTROL:
+            self.start(value & 0xff)
+        elif index < CONTROL:
+            self.registers[index] = value & 0xffff
+
+    def writeu8(self, offset, value):
+        index = offset >> 1
+        if index == CONTROL:
+            if offset & 1:
+                self.start(value & 0xff)
+        elif index < CONTROL:
+            current = self.registers[index]
+            if offset & 1:
+                self.registers[index] = (current & 0xff00) | (value & 0xff)
+            else:
+                self.registers[index] = (current & 0x00ff) | ((value & 0xff) << 8)
+
+    def start(self, command):
+        source, target, length, fill = self.registers
+        if command not in (COPY, FILL_BYTES):
+            self.status = ERROR
+            return
+        count = min(length, 0x10000 - target)
+        if command == COPY:
+            count = min(count, 0x10000 - source)
+            self._copy(source, target, count)
+            self.registers[SOURCE] = (source + count) & 0xffff
+        else:
+            self.cpu.write_block(target, bytes((fill & 0xff,)) * count)
+        self.registers[TARGET] = (target + count) & 0xffff
+        self.registers[LENGTH] = length - count
+        self.transferred += count
+        self.status = ERROR if count < length else 0
+
+    def snapshot(self):
+        return _state.pack(*self.registers, self.status)
+
+    def restore(self, data):
+        values = _state.unpack(data)
+        self.registers[:] = values[:CONTROL]
+        self.status = values[CONTROL]
+
+    def _copy(self, source, target, count):
+        distance = target - source
+        if 0 < distance < count:
+            pattern = self.cpu.read_block(source, distance)
+            data = (pattern * (count // distance + 1))[:count]
+        else:
+            data = self.cpu.read_block(source, count)
+        self.cpu.write_block(target, data)
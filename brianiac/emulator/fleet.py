@@ -0,0 +1,52 @@
+# Copyright 2022 Brian Johnson
+#
+# This file is part of brianiac
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, see <http://www.gnu.org/licenses/>.
+
+import multiprocessing
+import os
+import tempfile
+from brianiac.emulator.debugger import Debugger
+from brianiac.emulator.serial import Serial
+
+
+def run_case(rom, input_path, max_instructions=None):
+    result = {"input": os.path.basename(input_path)}
+    try:
+        with open(input_path, "rb") as stdin, tempfile.TemporaryFile() as stdout:
+            serial = Serial(stdin.fileno(), stdout.fileno())
+            debugger = Debugger(rom, serial)
+            reason = debugger.cpu.run(max_instructions)
+            serial.flush()
+            stdout.seek(0)
+            result.update(reason=reason.name.lower(),
+                          instructions=debugger.cpu.instructions,
+                          cycles=debugger.cpu.cycles,
+                          pc=debugger.cpu.registers.pc,
+                          output=stdout.read().decode("latin-1"))
+    except Exception as e:
+        result.update(reason="error", error=str(e))
+    return result
+
+
+def _run_case(args):
+    return run_case(*args)
+
+
+def run_fleet(rom, inputs, max_instructions=None, jobs=None):
+    cases = [(rom, path, max_instructions) for path in inputs]
+    with multiprocessing.Pool(jobs) as pool:
+        results = list(pool.imap_unordered(_run_case, cases))
+    return sorted(results, key=lambda result: result["input"])
@@ -0,0 +1,387 @@
+# Copyright 2022 Brian Johnson
+#
+# This file is part of brianiac
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, see <http://www.gnu.org/licenses/>.
+
+import os
+import select
+import socket
+import threading
+from brianiac.emulator.cpu import MemoryAccessError, StopReason
+from brianiac.emulator.decoder import DecodeError
+from brianiac.emulator.watchpoints import READ, WRITE, ACCESS
+
+PACKET_SIZE = 0x4000
+INTERRUPT = 0x03
+SIGINT = 2
+SIGILL = 4
+SIGTRAP = 5
+SIGBUS = 10
+
+WATCH_KINDS = {"2": WRITE, "3": READ, "4": ACCESS}
+WATCH_NAMES = {WRITE: "watch", READ: "rwatch", ACCESS: "awatch"}
+
+# Registers go over the wire in this order as 16 bit big-endian values.
+REGISTER_NAMES = [f"r{index}" for index in range(16)] + ["pc", "st"]
+REGISTER_TYPES = {"r14": "data_ptr", "r15": "code_ptr", "pc": "code_ptr"}
+
+TARGET_XML = "".join(
+    ['<?xml version="1.0"?>\n<!DOCTYPE target SYSTEM "gdb-target.dtd">\n<target version="1.0">\n',
+     '  <feature name="org.brianiac.core">\n'] +
+    [f'    <reg name="{name}" bitsize="16" type="{REGISTER_TYPES.get(name, "uint16")}" regnum="{index}"/>\n'
+     for index, name in enumerate(REGISTER_NAMES)] +
+    ["  </feature>\n</target>\n"])
+
+
+class ProtocolError(Exception):
+    pass
+
+
+def checksum(data):
+    return sum(data) & 0xff
+
+
+def escape(data):
+    out = bytearray()
+    for byte in data:
+        if byte in b"#$}*":
+            out += bytes((0x7d, byte ^ 0x20))
+        else:
+            out.append(byte)
+    return bytes(out)
+
+
+def unescape(data):
+    out = bytearray()
+    iterator = iter(data)
+    for byte in iterator:
+        out.append(next(iterator) ^ 0x20 if byte == 0x7d else byte)
+    return bytes(out)
+
+
+def listen(address):
+    """Returns a listening socket for "host:port", ":port", or a Unix socket path."""
+    host, sep, port = address.rpartition(":")
+    if sep and port.isdigit():
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        server.bind((host or "localhost", int(port)))
+    else:
+        if os.path.exists(address):
+            os.unlink(address)
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(address)
+    server.listen(1)
+    return server
+
+
+class Connection(object):
+    def __init__(self, sock):
+        self.sock = sock
+        self.ack = True
+        self._buffer = bytearray()
+
+    def _fill(self):
+        data = self.sock.recv(PACKET_SIZE)
+        if not data:
+            raise EOFError("connection closed")
+        self._buffer += data
+
+    def read_packet(self):
+        """Returns the next packet payload, or None for an out of band interrupt."""
+        while True:
+            while not self._buffer:
+                self._fill()
+            byte = self._buffer[0]
+            if byte == INTERRUPT:
+                del self._buffer[0]
+                return None
+            if byte != ord("$"):
+                del self._buffer[0]
+                continue
+            while True:
+                end = self._buffer.find(b"#")
+                if end >= 0 and len(self._buffer) >= end + 3:
+                    break
+                self._fill()
+            payload = bytes(self._buffer[1:end])
+            expected = self._buffer[end + 1:end + 3]
+            del self._buffer[:end + 3]
+            if self.ack:
+                try:
+                    valid = int(expected, 16) == checksum(payload)
+                except ValueError:
+                    valid = False
+                if not valid:
+                    self.sock.sendall(b"-")
+                    continue
+                self.sock.sendall(b"+")
+            return payload
+
+    def send(self, payload):
+        if isinstance(payload, str):
+            payload = payload.encode("latin-1")
+        self.sock.sendall(b"$" + payload + b"#" + f"{checksum(payload):02x}".encode())
+        if self.ack:
+            while True:
+                while not self._buffer:
+                    self._fill()
+                byte = self._buffer.pop(0)
+                if byte == ord("+"):
+                    return
+                if byte == ord("-"):
+                    self.sock.sendall(b"$" + payload + b"#" + f"{checksum(payload):02x}".encode())
+
+    def watch_interrupt(self, cpu):
+        """Starts a thread that stops cpu when the client sends an interrupt; call the result to stop watching."""
+        done = threading.Event()
+
+        def watch():
+            while not done.is_set():
+                ready, _, _ = select.select([self.sock], [], [], 0.05)
+                if ready and not done.is_set():
+                    data = self.sock.recv(PACKET_SIZE)
+                    if not data:
+                        cpu.request_stop(StopReason.INTERRUPT)
+                        return
+                    if INTERRUPT in data:
+                        cpu.request_stop(StopReason.INTERRUPT)
+                        data = data.replace(bytes((INTERRUPT,)), b"")
+                    self._buffer += data
+
+        thread = threading.Thread(target=watch, name="gdb-interrupt", daemon=True)
+        thread.start()
+
+        def stop():
+            done.set()
+            thread.join()
+        return stop
+
+
+# One client is served at a time. Between stops the target runs through
+# CPU.run with the breakpoints as stop addresses, so translated blocks and the
+# fast memory paths are used exactly as in an ordinary run.
+class GdbServer(object):
+    def __init__(self, cpu, watchpoints=None):
+        self.cpu = cpu
+        self.watchpoints = watchpoints
+        self.breakpoints = set()
+        self.connection = None
+        self.last_stop = f"S{SIGTRAP:02x}"
+
+    def serve(self, server):
+        while True:
+            sock, _ = server.accept()
+            with sock:
+                self.connection = Connection(sock)
+                try:
+                    if not self._session():
+                        return
+                except (EOFError, ConnectionError):
+                    pass
+                finally:
+                    self.connection = None
+
+    def _session(self):
+        while True:
+            packet = self.connection.read_packet()
+            if packet is None:
+                continue
+            if not packet:
+                self.connection.send("")
+                continue
+            command, data = chr(packet[0]), packet[1:]
+            if command == "k":
+                return False
+            if command == "D":
+                self.connection.send("OK")
+                return True
+            try:
+                reply = self.handle(command, data)
+            except (ValueError, IndexError, ProtocolError):
+                reply = "E01"
+            if reply is not None:
+                self.connection.send(reply)
+
+    def handle(self, command, data):
+        """Returns the reply to a packet, "" if it is not supported or None if it was already sent."""
+        if command == "?":
+            return self.last_stop
+        handler = getattr(self, f"_packet_{command}", None) if command.isalpha() else None
+        if handler is None:
+            return ""
+        return handler(data)
+
+    def _register(self, index):
+        regs = self.cpu.registers
+        if index < 16:
+            return regs.get(index)
+        if index == 16:
+            return regs.pc
+        if index == 17:
+            return regs.status
+        raise ProtocolError(f"no register {index}")
+
+    def _set_register(self, index, value):
+        regs = self.cpu.registers
+        value &= 0xffff
+        if index < 16:
+            regs.set(index, value)
+        elif index == 16:
+            regs.pc = value
+        elif index == 17:
+            regs.status = value
+        else:
+            raise ProtocolError(f"no register {index}")
+
+    def _packet_g(self, data):
+        return "".join(f"{self._register(index):04x}" for index in range(len(REGISTER_NAMES)))
+
+    def _packet_G(self, data):
+        text = data.decode()
+        for index in range(min(len(REGISTER_NAMES), len(text) // 4)):
+            self._set_register(index, int(text[index * 4:index * 4 + 4], 16))
+        return "OK"
+
+    def _packet_p(self, data):
+        return f"{self._register(int(data, 16)):04x}"
+
+    def _packet_P(self, data):
+        index, value = data.decode().split("=")
+        self._set_register(int(index, 16), int(value, 16))
+        return "OK"
+
+    def _range(self, text):
+        address, length = (int(field, 16) for field in text.split(","))
+        if address > 0xffff:
+            raise ProtocolError("address out of range")
+        return address, min(length, 0x10000 - address, PACKET_SIZE // 2)
+
+    def _packet_m(self, data):
+        address, length = self._range(data.decode())
+        return self.cpu.read_block(address, length).hex()
+
+    def _packet_M(self, data):
+        header, _, payload = data.partition(b":")
+        address, length = self._range(header.decode())
+        self.cpu.write_block(address, bytes.fromhex(payload.decode())[:length])
+        return "OK"
+
+    def _packet_X(self, data):
+        header, _, payload = data.partition(b":")
+        address, length = self._range(header.decode())
+        if length:
+            self.cpu.write_block(address, unescape(payload)[:length])
+        return "OK"
+
+    def _packet_Z(self, data):
+        return self._point(data.decode(), True)
+
+    def _packet_z(self, data):
+        return self._point(data.decode(), False)
+
+    def _point(self, text, insert):
+        kind, address, length = text.split(";")[0].split(",")
+        address = int(address, 16)
+        if kind in ("0", "1"):
+            (self.breakpoints.add if insert else self.breakpoints.discard)(address)
+            return "OK"
+        if kind in WATCH_KINDS and self.watchpoints is not None:
+            end = address + max(int(length, 16), 1) - 1
+            if insert:
+                self.watchpoints.add(address, end, WATCH_KINDS[kind])
+            else:
+                self.watchpoints.remove(address, end)
+            return "OK"
+        return ""
+
+    def _resume(self, data):
+        if data:
+            self.cpu.registers.pc = int(data.decode().split(";")[0], 16) & 0xffff
+
+    def _packet_c(self, data):
+        self._resume(data)
+        stop = self.connection.watch_interrupt(self.cpu)
+        try:
+            reason = self.cpu.run(stop_pcs=self.breakpoints)
+        finally:
+            stop()
+        return self._stopped(reason)
+
+    def _packet_s(self, data):
+        self._resume(data)
+        try:
+            self.cpu.step()
+        except DecodeError:
+            return self._stopped(StopReason.INVALID)
+        except MemoryAccessError:
+            return self._stopped(StopReason.FAULT)
+        if self.watchpoints is not None and self.watchpoints.hit is not None:
+            return self._stopped(StopReason.WATCHPOINT)
+        return self._stopped(StopReason.BREAKPOINT)
+
+    def _stopped(self, reason):
+        if reason == StopReason.HALT:
+            self.last_stop = "W00"
+        elif reason == StopReason.INVALID:
+            self.last_stop = f"S{SIGILL:02x}"
+        elif reason == StopReason.INTERRUPT:
+            self.last_stop = f"S{SIGINT:02x}"
+        elif reason == StopReason.FAULT:
+            # The CPU leaves PC on the access that faulted, so gdb shows the
+            # instruction responsible.
+            self.last_stop = f"S{SIGBUS:02x}"
+        elif reason == StopReason.WATCHPOINT and self.watchpoints.hit is not None:
+            hit = self.watchpoints.hit
+            self.watchpoints.hit = None
+            self.last_stop = f"T{SIGTRAP:02x}{WATCH_NAMES[hit.watchpoint.kind]}:{hit.address:x};"
+        else:
+            self.last_stop = f"S{SIGTRAP:02x}"
+        return self.last_stop
+
+    def _packet_H(self, data):
+        return "OK"
+
+    def _packet_T(self, data):
+        return "OK"
+
+    def _packet_q(self, data):
+        text = data.decode()
+        if text.startswith("Supported"):
+            features = [f"PacketSize={PACKET_SIZE:x}", "QStartNoAckMode+", "qXfer:features:read+"]
+            return ";".join(features)
+        if text == "Attached":
+            return "1"
+        if text == "C":
+            return "QC1"
+        if text == "fThreadInfo":
+            return "m1"
+        if text == "sThreadInfo":
+            return "l"
+        if text.startswith("Xfer:features:read:"):
+            annex, _, span = text[len("Xfer:features:read:"):].partition(":")
+            if annex != "target.xml":
+                return "E00"
+            offset, length = (int(field, 16) for field in span.split(","))
+            chunk = TARGET_XML[offset:offset + length].encode()
+            return (b"l" if offset + length >= len(TARGET_XML) else b"m") + escape(chunk)
+        return ""
+
+    def _packet_Q(self, data):
+        if data == b"StartNoAckMode":
+            self.connection.send("OK")
+            self.connection.ack = False
+            return None
+        return ""
@@ -0,0 +1,563 @@
+# Copyright 2022 Brian Johnson
+#
+# This file is part of brianiac
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, see <http://www.gnu.org/licenses/>.
+
+from brianiac.emulator.cpu import PAGE_COUNT, PAGE_SHIFT, PAGE_SIZE, MemoryAccessError
+from brianiac.emulator.decoder import DecodeError
+from brianiac.emulator.logisim import CircuitError, Netlist, read_project
+from brianiac.emulator.timing import CYCLES_PER_INSTRUCTION
+
+SEQUENTIAL = ("Register", "Counter")
+MAX_SETTLE = 8
+
+# Values an input takes when nothing drives it, following Logisim: enables
+# and counter enables float high, everything else reads as zero. Gate inputs
+# that are not connected are left out of the gate altogether.
+FLOATING = {
+    ("Register", "enable"): 1,
+    ("Counter", "count"): 1,
+    ("Decoder", "enable"): 1,
+    ("Multiplexer", "enable"): 1,
+    ("Demultiplexer", "enable"): 1,
+}
+
+GATE_OPERATORS = {
+    "AND Gate": " & ", "NAND Gate": " & ",
+    "OR Gate": " | ", "NOR Gate": " | ",
+    "XOR Gate": " ^ ", "XNOR Gate": " ^ ",
+}
+
+
+def _mask(width):
+    return (1 << width) - 1
+
+
+def _signed(value, width):
+    return value - ((value >> (width - 1) & 1) << width)
+
+
+def _exactly_one(values, mask):
+    seen = once = 0
+    for value in values:
+        once = (once & ~value) | (value & ~seen)
+        seen |= value
+    return once & mask
+
+
+class _Node(object):
+    __slots__ = ("primitive", "inputs", "outputs", "level")
+
+    def __init__(self, primitive, inputs, outputs):
+        self.primitive = primitive
+        self.inputs = inputs
+        self.outputs = outputs
+        self.level = 0
+
+
+# The netlist is compiled into three functions. evaluate() settles all of the
+# combinational logic in level order as straight-line code on Python ints,
+# one int per bus, and returns what every register and counter sees on its
+# inputs. edge() clocks those samples into the state list and clear() applies
+# asynchronous clears. Memory sits outside the circuit: the DATAin pin is
+# driven by a read callback on the ADDR pin, like the asynchronous RAM and
+# ROM on the main sheet.
+class Compiler(object):
+    def __init__(self, netlist, inputs=("CLK", "RESET"), memory=("ADDR", "DATAin")):
+        self.netlist = netlist
+        self.inputs = inputs
+        self.memory = memory
+        self.drivers = {}
+        self.widths = {}
+        self.nodes = []
+        self.sequential = []
+        self.outputs = [label for label, (pin, bits) in sorted(netlist.pins.items())
+                        if pin.attr("output") == "true"]
+        self.samples = []
+        self.lines = []
+
+    def _drive(self, var, bits):
+        self.widths[var] = len(bits)
+        for position, bit in enumerate(bits):
+            if bit in self.drivers:
+                raise CircuitError(f"bit {bit} has more than one driver")
+            self.drivers[bit] = (var, position)
+
+    def expression(self, bits):
+        runs = []
+        for position, bit in enumerate(bits):
+            driver = self.drivers.get(bit)
+            if driver is None:
+                continue
+            var, source = driver
+            if runs and runs[-1][0] == var and runs[-1][1] + runs[-1][3] == source \
+                    and runs[-1][2] + runs[-1][3] == position:
+                runs[-1][3] += 1
+            else:
+                runs.append([var, source, position, 1])
+        if not runs:
+            return "0"
+        parts = []
+        for var, source, position, length in runs:
+            term = var if source == 0 else f"({var} >> {source})"
+            if source + length < self.widths[var]:
+                term = f"({term} & 0x{_mask(length):x})"
+            if position:
+                term = f"({term} << {position})"
+            parts.append(term)
+        return parts[0] if len(parts) == 1 else "(" + " | ".join(parts) + ")"
+
+    def _driven(self, bits):
+        return any(bit in self.drivers for bit in bits)
+
+    def _input(self, node, key):
+        primitive = node.primitive
+        bits = primitive.ports[key]
+        if not self._driven(bits):
+            return str(FLOATING.get((primitive.component.name, key), 0))
+        return self.expression(bits)
+
+    def build(self):
+        netlist = self.netlist
+        for label in self.inputs:
+            self._drive(label.lower(), netlist.pins[label][1])
+        address, data = self.memory
+        self._drive("data", netlist.pins[data][1])
+        for index, primitive in enumerate(netlist.primitives):
+            name = primitive.component.name
+            outputs = {key: f"v{index}_{key}" for key in sorted(primitive.outputs)}
+            for key, var in outputs.items():
+                self._drive(var, primitive.ports[key])
+            node = _Node(primitive, [b for k, bits in primitive.ports.items() if k not in primitive.outputs
+                                     for b in bits], outputs)
+            if name in SEQUENTIAL:
+                self.sequential.append(node)
+            else:
+                self.nodes.append(node)
+        clock = self.inputs[0].lower()
+        for node in self.sequential:
+            if [self.drivers.get(bit) for bit in node.primitive.ports["clock"]] != [(clock, 0)]:
+                raise CircuitError(f"{node.primitive.name}: only storage clocked directly by "
+                                   f"{self.inputs[0]} is supported")
+        self._levelize()
+        return self._generate()
+
+    def _levelize(self):
+        producer = {}
+        for node in self.nodes:
+            for var in node.outputs.values():
+                producer[var] = node
+        address_bits = self.netlist.pins[self.memory[0]][1]
+        reader = _Node(None, address_bits, {"data": "data"})
+        producer["data"] = reader
+        order = []
+        state = {}
+
+        def visit(node):
+            mark = state.get(id(node))
+            if mark == 1:
+                return
+            if mark == 0:
+                where = node.primitive.name if node.primitive is not None else "memory"
+                raise CircuitError(f"combinational loop through {where}")
+            state[id(node)] = 0
+            level = 0
+            for bit in node.inputs:
+                driver = self.drivers.get(bit)
+                if driver is not None and driver[0] in producer:
+                    dependency = producer[driver[0]]
+                    visit(dependency)
+                    level = max(level, dependency.level + 1)
+            node.level = level
+            state[id(node)] = 1
+            order.append(node)
+
+        for node in self.nodes + [reader]:
+            visit(node)
+        self.order = sorted(order, key=lambda node: node.level)
+
+    def _emit(self, line):
+        self.lines.append("    " + line)
+
+    def _combinational(self, node):
+        if node.primitive is None:
+            address = self.expression(self.netlist.pins[self.memory[0]][1])
+            self._emit(f"data = read({address})")
+            return
+        primitive = node.primitive
+        c = primitive.component
+        name = c.name
+        out = node.outputs
+        width = c.int("width", 1)
+        mask = f"0x{_mask(width):x}"
+        value = lambda key: self._input(node, key)  # noqa: E731
+        if name == "Constant":
+            self._emit(f"{out['io']} = 0x{c.int('value', 1) & _mask(width):x}")
+        elif name in GATE_OPERATORS:
+            terms = []
+            for key in sorted((k for k in primitive.ports if k.startswith("in")), key=lambda k: int(k[2:])):
+                if not self._driven(primitive.ports[key]):
+                    continue
+                term = self.expression(primitive.ports[key])
+                if c.attr(f"negate{key[2:]}") == "true":
+                    term = f"(~{term} & {mask})"
+                terms.append(term)
+            if name in ("XOR Gate", "XNOR Gate") and len(terms) > 2 and c.attr("xor") != "odd":
+                result = f"one(({', '.join(terms)},), {mask})"
+            else:
+                result = GATE_OPERATORS[name].join(terms) or "0"
+            if name in ("NAND Gate", "NOR Gate", "XNOR Gate"):
+                result = f"~({result}) & {mask}"
+            self._emit(f"{out['out']} = {result}")
+        elif name == "NOT Gate":
+            self._emit(f"{out['out']} = ~{value('in')} & {mask}")
+        elif name == "Controlled Buffer":
+            self._emit(f"{out['out']} = {value('in')} if {value('control')} else 0")
+        elif name == "Multiplexer":
+            count = 1 << c.int("select", 1)
+            choices = ", ".join(value(f"in{i}") for i in range(count))
+            result = f"({choices})[{value('select')}]"
+            if "enable" in primitive.ports:
+                result = f"{result} if {value('enable')} else 0"
+            self._emit(f"{out['out']} = {result}")
+        elif name == "Demultiplexer":
+            select = value("select")
+            source = value("out")
+            enable = f" and {value('enable')}" if "enable" in primitive.ports else ""
+            for key, var in out.items():
+                self._emit(f"{var} = {source} if {select} == {key[2:]}{enable} else 0")
+        elif name == "Decoder":
+            select = value("select")
+            enable = f" and {value('enable')}" if "enable" in primitive.ports else ""
+            for key, var in out.items():
+                self._emit(f"{var} = 1 if {select} == {key[3:]}{enable} else 0")
+        elif name in ("Adder", "Subtractor"):
+            operator = "+" if name == "Adder" else "-"
+            full = f"{value('a')} {operator} {value('b')} {operator} {value('cin')}"
+            if "cout" in out:
+                self._emit(f"t = {full}")
+                self._emit(f"{out['out']} = t & {mask}")
+                carry = f"t >> {width} & 1" if name == "Adder" else "1 if t < 0 else 0"
+                self._emit(f"{out['cout']} = {carry}")
+            else:
+                self._emit(f"{out['out']} = ({full}) & {mask}")
+        elif name == "Comparator":
+            a, b = value("a"), value("b")
+            if c.attr("mode") != "unsigned":
+                a, b = f"signed({a}, {width})", f"signed({b}, {width})"
+            self._emit(f"a, b = {a}, {b}")
+            for key, operator in (("gt", ">"), ("eq", "=="), ("lt", "<")):
+                if key in out:
+                    self._emit(f"{out[key]} = 1 if a {operator} b else 0")
+        elif name == "Shifter":
+            data, shift = value("in"), value("shift")
+            kind = c.attr("shift", "ll")
+            if kind == "ll":
+                result = f"({data} << {shift}) & {mask}"
+            elif kind == "lr":
+                result = f"{data} >> {shift}"
+            elif kind == "ar":
+                result = f"(signed({data}, {width}) >> {shift}) & {mask}"
+            elif kind == "rl":
+                result = f"(({data} << {shift}) | ({data} >> ({width} - {shift}))) & {mask}"
+            else:
+                result = f"(({data} >> {shift}) | ({data} << ({width} - {shift}))) & {mask}"
+            self._emit(f"{out['out']} = {result}")
+        elif name == "Bit Extender":
+            source_width = c.int("in_width", 8)
+            fill = f"0x{_mask(c.int('out_width', 16)) & ~_mask(source_width):x}"
+            data = value("in")
+            kind = c.attr("type", "sign")
+            if kind == "zero":
+                result = data
+            elif kind == "one":
+                result = f"{data} | {fill}"
+            elif kind == "input":
+                result = f"{data} | ({fill} if {value('extend')} else 0)"
+            else:
+                result = f"{data} | ({fill} if {data} >> {source_width - 1} & 1 else 0)"
+            self._emit(f"{out['out']} = {result}")
+        else:
+            raise CircuitError(f"cannot simulate {primitive.name}")
+
+    def _sample(self, node, key):
+        index = len(self.samples)
+        self.samples.append((node, key))
+        return index, self._input(node, key)
+
+    def _generate(self):
+        self.lines = ["def evaluate(s, clk, reset, read):"]
+        self.slots = {}
+        for slot, node in enumerate(self.sequential):
+            self.slots[node.primitive.name] = slot
+            for key, var in node.outputs.items():
+                if key == "q":
+                    self._emit(f"{var} = s[{slot}]")
+        for node in self.sequential:
+            if "carry" in node.outputs:
+                slot = self.slots[node.primitive.name]
+                maximum = node.primitive.component.int("max", _mask(node.primitive.component.int("width", 1)))
+                self._emit(f"{node.outputs['carry']} = 1 if s[{slot}] == {maximum} else 0")
+        level = None
+        for node in self.order:
+            if node.level != level:
+                level = node.level
+                self._emit(f"# level {level}")
+            self._combinational(node)
+        returned = []
+        edge = ["def edge(s, p, rising):"]
+        clear = ["def clear(s, p):", "    changed = False"]
+        for node in self.sequential:
+            slot = self.slots[node.primitive.name]
+            c = node.primitive.component
+            trigger = c.attr("trigger", "rising")
+            if trigger not in ("rising", "falling"):
+                raise CircuitError(f"{node.primitive.name}: {trigger} triggered storage is not supported")
+            samples = {key: self._sample(node, key)
+                       for key in ("d", "enable", "clear", "load", "count") if key in node.primitive.ports}
+            returned.extend(expr for index, expr in samples.values())
+            indices = {key: index for key, (index, expr) in samples.items()}
+            condition = "rising" if trigger == "rising" else "not rising"
+            clear += [f"    if p[{indices['clear']}] and s[{slot}]:",
+                      f"        s[{slot}] = 0",
+                      "        changed = True"]
+            if c.name == "Register":
+                edge.append(f"    if {condition} and p[{indices['enable']}] and not p[{indices['clear']}]:")
+                edge.append(f"        s[{slot}] = p[{indices['d']}]")
+            else:
+                maximum = c.int("max", _mask(c.int("width", 1)))
+                load, count = f"p[{indices['load']}]", f"p[{indices['count']}]"
+                edge.append(f"    if {condition} and not p[{indices['clear']}]:")
+                edge.append(f"        if {load} and {count}:")
+                edge.append(f"            s[{slot}] = p[{indices['d']}]")
+                edge.append(f"        elif {count}:")
+                edge.append(f"            s[{slot}] = s[{slot}] + 1 if s[{slot}] < {maximum} else 0")
+                edge.append(f"        elif {load}:")
+                edge.append(f"            s[{slot}] = s[{slot}] - 1 if s[{slot}] > 0 else {maximum}")
+        self.pin_samples = {}
+        for label in self.outputs:
+            self.pin_samples[label] = len(returned)
+            returned.append(self.expression(self.netlist.pins[label][1]))
+        self._emit("return (" + ", ".join(returned) + ",)")
+        edge.append("    pass")
+        clear.append("    return changed")
+        return "\n".join(self.lines + [""] + edge + [""] + clear) + "\n"
+
+
+class Hardware(object):
+    def __init__(self, netlist, read=None):
+        compiler = Compiler(netlist)
+        self.source = compiler.build()
+        namespace = {"signed": _signed, "one": _exactly_one}
+        exec(compile(self.source, f"<{netlist.top}>", "exec"), namespace)
+        self._evaluate = namespace["evaluate"]
+        self._edge = namespace["edge"]
+        self._clear = namespace["clear"]
+        self.slots = compiler.slots
+        self.pin_samples = compiler.pin_samples
+        self.levels = compiler.order[-1].level + 1 if compiler.order else 0
+        self.state = [0] * len(compiler.sequential)
+        self.read = read or (lambda address: 0)
+        self.clk = 0
+        self.reset_line = 0
+        self.cycles = 0
+        self.samples = None
+        self.settle()
+
+    @classmethod
+    def load(cls, path, top="CPU", read=None):
+        return cls(Netlist(read_project(path), top), read)
+
+    def settle(self):
+        for _ in range(MAX_SETTLE):
+            self.samples = self._evaluate(self.state, self.clk, self.reset_line, self.read)
+            if not self._clear(self.state, self.samples):
+                return
+        raise CircuitError("clear lines did not settle")
+
+    def pin(self, label):
+        return self.samples[self.pin_samples[label]]
+
+    def register(self, name):
+        return self.state[self.slots[name]]
+
+    def set_clock(self, value):
+        if value != self.clk:
+            self._edge(self.state, self.samples, value == 1)
+            self.clk = value
+            self.settle()
+
+    def tick(self):
+        self.set_clock(1)
+        self.set_clock(0)
+        self.cycles += 1
+
+    def reset(self):
+        self.reset_line = 1
+        self.settle()
+        self.reset_line = 0
+        self.settle()
+        self.cycles = 0
+
+
+class Divergence(object):
+    def __init__(self, instructions, cycles, pc, differences):
+        self.instructions = instructions
+        self.cycles = cycles
+        self.pc = pc
+        self.differences = differences
+
+    def __str__(self):
+        lines = [f"Divergence after {self.instructions} instructions ({self.cycles} cycles), "
+                 f"instruction at {self.pc:04X}:"]
+        for name, emulator, hardware in self.differences:
+            lines.append(f"  {name:<8} emulator {emulator}  hardware {hardware}")
+        return "\n".join(lines)
+
+
+# Each instruction is run on the emulator first and then on the circuit for
+# one full T0-T3 sequence, and the architectural state and the bytes written
+# are compared. The circuit reads memory as it was before the instruction:
+# bytes the emulator stored are put back from the values its write hooks saw
+# beforehand, and devices that cannot be peeked answer with whatever their
+# reads returned to the emulator. The circuit's own writes are only collected.
+class Lockstep(object):
+    def __init__(self, cpu, hardware):
+        self.cpu = cpu
+        self.hardware = hardware
+        self.hardware.read = self._read
+        self.instructions = 0
+        self._written = []
+        self._before = {}
+        self._devices = {}
+        self._names = self._register_names()
+        for page in range(PAGE_COUNT):
+            if cpu.writable(page):
+                cpu.add_write_hook(page, self._emulator_write)
+            if self._unbuffered(page):
+                cpu.add_read_hook(page, self._emulator_read)
+        hardware.reset()
+
+    def _unbuffered(self, page):
+        start = page << PAGE_SHIFT
+        return any(r.start < start + PAGE_SIZE and r.stop > start and not device.buffered
+                   for r, device in self.cpu.memory_map.items())
+
+    def _register_names(self):
+        names = {}
+        for name in self.hardware.slots:
+            parts = name.split("/")
+            if parts[0].startswith("RegisterFile(") and parts[-1].startswith("R"):
+                names[parts[-1]] = name
+            elif parts[0].startswith("PC(") and len(parts) == 2:
+                names["PC"] = name
+            elif parts == ["STR"]:
+                names["ST"] = name
+        missing = ({f"R{i}" for i in range(16)} | {"PC", "ST"}) - set(names)
+        if missing:
+            raise CircuitError(f"cannot find the {', '.join(sorted(missing))} registers in the circuit")
+        return names
+
+    @staticmethod
+    def _bytes(address, size, value):
+        if size == 2:
+            return ((address, value >> 8), (address + 1, value & 0xff))
+        return ((address, value),)
+
+    def _emulator_write(self, address, size, value):
+        for address, value in self._bytes(address, size, value):
+            self._before.setdefault(address, self.cpu.peeku8(address))
+            self._written.append((address, value))
+
+    def _emulator_read(self, address, size, value):
+        for address, value in self._bytes(address, size, value):
+            self._devices.setdefault(address, value)
+
+    def _read_byte(self, address):
+        if address in self._before:
+            return self._before[address]
+        if address in self._devices:
+            return self._devices[address]
+        return self.cpu.peeku8(address)
+
+    def _read(self, address):
+        address &= 0xfffe
+        if not self._before and not self._devices:
+            return self.cpu.peeku16(address)
+        return (self._read_byte(address) << 8) | self._read_byte(address + 1)
+
+    def _state(self):
+        regs = self.cpu.registers
+        state = {f"R{i}": regs.r[i] for i in range(16)}
+        state["PC"] = regs.pc
+        state["ST"] = regs.status & 0xf
+        return state
+
+    def _hardware_writes(self, written):
+        # The main sheet splits memory into an even and an odd byte bank. A low
+        # readwrite line writes both, unless HWR or LWR marks a byte store
+        # that leaves the even or odd bank alone. RAM latches on the rising
+        # edge, so this is sampled just before each tick.
+        hardware = self.hardware
+        if hardware.pin("readwrite"):
+            return
+        address, value = hardware.pin("ADDR"), hardware.pin("DATAout")
+        if not hardware.pin("HWR"):
+            written.add((address & 0xfffe, value >> 8))
+        if not hardware.pin("LWR"):
+            written.add((address | 1, value & 0xff))
+
+    def step(self):
+        pc = self.cpu.registers.pc
+        self._written = []
+        self._before = {}
+        self._devices = {}
+        # The emulator rejects an undefined opcode or an unaligned word access
+        # while the circuit executes whatever its control logic makes of it,
+        # so that always diverges, but the circuit is still run to show what
+        # it did.
+        differences = []
+        try:
+            self.cpu.step()
+            self.instructions += 1
+        except DecodeError:
+            differences.append(("opcode", f"invalid {self.cpu.peeku16(pc):04X}", "executed"))
+        except MemoryAccessError as e:
+            differences.append(("access", str(e), "executed"))
+        written = set()
+        for _ in range(CYCLES_PER_INSTRUCTION):
+            self._hardware_writes(written)
+            self.hardware.tick()
+        hardware = {name: self.hardware.register(slot) for name, slot in self._names.items()}
+        hardware["ST"] &= 0xf
+        differences += [(name, f"{value:04X}", f"{hardware[name]:04X}")
+                        for name, value in self._state().items() if hardware[name] != value]
+        emulator_writes = set(self._written)
+        if emulator_writes != written:
+            differences.append(("writes", self._format(emulator_writes), self._format(written)))
+        if differences:
+            return Divergence(self.instructions, self.hardware.cycles, pc, differences)
+        return None
+
+    @staticmethod
+    def _format(writes):
+        return " ".join(f"[{address:04X}]={value:02X}" for address, value in sorted(writes)) or "none"
+
+    def run(self, max_instructions):
+        while self.instructions < max_instructions:
+            divergence = self.step()
+            if divergence is not None:
+                return divergence
+        return None
@@ -0,0 +1,159 @@
+# Copyright 2022 Brian Johnson
+#
+# This file is part of brianiac
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, see <http://www.gnu.org/licenses/>.
+
+from array import array
+from collections import deque
+from brianiac.emulator import snapshot
+from brianiac.emulator.cpu import StopReason
+
+HISTORY_SIZE = 1 << 20
+CHECKPOINT_INTERVAL = 100000
+CHECKPOINT_COUNT = 32
+
+# Each undo record packs everything one instruction changed into 64 bits:
+#   bits  0-15  PC before the instruction
+#   bits 16-31  previous register or memory value
+#   bits 32-47  register index or memory address
+#   bits 48-49  what the value belongs to (KIND_*)
+#   bit  50     previous status is present
+#   bits 51-54  previous status
+KIND_NONE = 0
+KIND_REGISTER = 1
+KIND_WORD = 2
+KIND_BYTE = 3
+HAS_STATUS = 1 << 50
+
+# Stores to anything but plain memory can have effects the log cannot undo,
+# such as a DMA transfer or a change to a timer, and so can loads from device
+# registers with read effects, such as the serial data register, so the log
+# is cut there and a checkpoint taken straight after. Reverse steps stop at
+# the access, and going back across it restores a checkpoint and runs
+# forward instead.
+
+
+class History(object):
+    def __init__(self, cpu, size=HISTORY_SIZE, interval=CHECKPOINT_INTERVAL):
+        self.cpu = cpu
+        self.size = size
+        self.interval = interval
+        self.log = array("Q", bytes(8 * size))
+        self.head = 0
+        self.count = 0
+        self.checkpoints = deque(maxlen=CHECKPOINT_COUNT)
+        self._barrier = False
+        self._checkpoint_due = False
+        self.checkpoint()
+
+    def _memory(self, address):
+        device, offset = self.cpu.device_at(address)
+        return device if device is not None and device.buffered else None
+
+    def before(self, pc, name, opcode, imm):
+        cpu = self.cpu
+        regs = cpu.registers
+        if self._checkpoint_due or cpu.instructions % self.interval == 0:
+            self._checkpoint_due = False
+            self.checkpoint()
+        record = pc
+        if opcode._grp == 0b001:
+            record |= HAS_STATUS | (cpu.alu.status << 51)
+            if name not in ("CP", "TEST"):
+                record |= (KIND_REGISTER << 48) | (opcode.rn << 32) | (regs.r[opcode.rn] << 16)
+        elif name in ("MOV", "LDW", "LDB"):
+            record |= (KIND_REGISTER << 48) | (opcode.rn << 32) | (regs.r[opcode.rn] << 16)
+            if name != "MOV":
+                address = imm if imm is not None else regs.r[opcode.rm]
+                device, offset = cpu.device_at(address)
+                size = 2 if name == "LDW" else 1
+                if device is not None and any(offset <= effect < offset + size for effect in device.read_effects):
+                    self._barrier = True
+        elif name == "CALL":
+            record |= (KIND_REGISTER << 48) | (15 << 32) | (regs.r[15] << 16)
+        elif name in ("STW", "STB"):
+            address = imm if imm is not None else regs.r[opcode.rn]
+            if self._memory(address) is not None:
+                if name == "STW":
+                    record |= (KIND_WORD << 48) | (address << 32) | (cpu.peeku16(address) << 16)
+                else:
+                    record |= (KIND_BYTE << 48) | (address << 32) | (cpu.peeku8(address) << 16)
+            elif cpu.device_at(address)[0] is not None:
+                self._barrier = True
+        self._pending = record
+
+    def after(self, pc, name, opcode, imm):
+        if self._barrier:
+            self._barrier = False
+            self._checkpoint_due = True
+            self.count = 0
+            return
+        self.log[self.head] = self._pending
+        self.head = (self.head + 1) % self.size
+        self.count = min(self.count + 1, self.size)
+
+    def reverse_step(self):
+        if not self.count:
+            return False
+        self.head = (self.head - 1) % self.size
+        self.count -= 1
+        record = self.log[self.head]
+        cpu = self.cpu
+        kind = (record >> 48) & 3
+        value = (record >> 16) & 0xffff
+        where = (record >> 32) & 0xffff
+        if kind == KIND_REGISTER:
+            cpu.registers.r[where] = value
+        elif kind == KIND_WORD:
+            cpu.writeu16(where, value)
+        elif kind == KIND_BYTE:
+            cpu.writeu8(where, value)
+        if record & HAS_STATUS:
+            cpu.registers.status = (record >> 51) & 0xf
+        cpu.registers.pc = record & 0xffff
+        cpu.instructions -= 1
+        while self.checkpoints and self.checkpoints[-1][0] > cpu.instructions:
+            self.checkpoints.pop()
+        return True
+
+    def reverse_continue(self, stop_pcs=()):
+        cpu = self.cpu
+        with cpu.interruptible():
+            while self.reverse_step():
+                if cpu.registers.pc in stop_pcs:
+                    return StopReason.BREAKPOINT
+                if cpu.interrupted:
+                    return cpu.stop_request or StopReason.INTERRUPT
+        return StopReason.LIMIT
+
+    def checkpoint(self):
+        if not self.checkpoints or self.checkpoints[-1][0] != self.cpu.instructions:
+            self.checkpoints.append((self.cpu.instructions, snapshot.dumps(self.cpu)))
+
+    def goto(self, instruction):
+        cpu = self.cpu
+        if instruction >= cpu.instructions:
+            return cpu.run(instruction - cpu.instructions)
+        if cpu.instructions - instruction <= self.count:
+            while cpu.instructions > instruction:
+                self.reverse_step()
+            return StopReason.LIMIT
+        while self.checkpoints and self.checkpoints[-1][0] > instruction:
+            self.checkpoints.pop()
+        if not self.checkpoints:
+            raise ValueError(f"instruction {instruction} is older than the recorded history")
+        snapshot.loads(cpu, self.checkpoints[-1][1])
+        self.count = 0
+        return cpu.run(instruction - cpu.instructions)
@@ -0,0 +1,484 @@
+# Copyright 2022 Brian Johnson
+#
+# This file is part of brianiac
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, see <http://www.gnu.org/licenses/>.
+
+import re
+import xml.etree.ElementTree as ElementTree
+
+GATES = ("AND Gate", "OR Gate", "XOR Gate", "NAND Gate", "NOR Gate", "XNOR Gate")
+NEGATED_OUTPUT = ("NAND Gate", "NOR Gate", "XNOR Gate")
+XOR_GATES = ("XOR Gate", "XNOR Gate")
+
+# Pitch and anchor of the generated box that Logisim-evolution draws for a
+# subcircuit without a custom appearance: inputs down the west edge, outputs
+# down the east edge, each sorted top to bottom, anchored on the first output.
+SUBCIRCUIT_PITCH = 20
+
+
+class CircuitError(Exception):
+    pass
+
+
+class Component(object):
+    __slots__ = ("name", "loc", "attrs", "library")
+
+    def __init__(self, name, loc, attrs, library=None):
+        self.name = name
+        self.loc = loc
+        self.attrs = attrs
+        self.library = library
+
+    def attr(self, name, default=None):
+        return self.attrs.get(name, default)
+
+    def int(self, name, default):
+        value = self.attrs.get(name)
+        return default if value is None else int(value, 0)
+
+    def __str__(self):
+        label = self.attrs.get("label")
+        where = f"({self.loc[0]},{self.loc[1]})"
+        return f"{self.name} {label} {where}" if label else f"{self.name} {where}"
+
+
+class Circuit(object):
+    def __init__(self, name, wires, components):
+        self.name = name
+        self.wires = wires
+        self.components = components
+
+    def pins(self):
+        return [c for c in self.components if c.name == "Pin"]
+
+
+class Port(object):
+    __slots__ = ("name", "loc", "width", "output")
+
+    def __init__(self, name, loc, width, output=False):
+        self.name = name
+        self.loc = loc
+        self.width = width
+        self.output = output
+
+
+def _location(text):
+    x, y = re.match(r"\((-?\d+),\s*(-?\d+)\)", text).groups()
+    return int(x), int(y)
+
+
+def read_project(path):
+    """Reads every circuit of a Logisim-evolution project file."""
+    try:
+        root = ElementTree.parse(path).getroot()
+    except (OSError, ElementTree.ParseError) as e:
+        raise CircuitError(f"{path}: {e}")
+    circuits = {}
+    for element in root.findall("circuit"):
+        wires = [(_location(w.get("from")), _location(w.get("to"))) for w in element.findall("wire")]
+        components = []
+        for c in element.findall("comp"):
+            attrs = {a.get("name"): a.get("val") for a in c.findall("a")}
+            components.append(Component(c.get("name"), _location(c.get("loc")), attrs, c.get("lib")))
+        circuits[element.get("name")] = Circuit(element.get("name"), wires, components)
+    return circuits
+
+
+def _translate(loc, facing, forward, right=0):
+    # Moves forward along facing and then right of it, like Location.translate.
+    dx, dy = {"east": (1, 0), "west": (-1, 0), "north": (0, -1), "south": (0, 1)}[facing]
+    return loc[0] + dx * forward - dy * right, loc[1] + dy * forward + dx * right
+
+
+def _reverse(facing):
+    return {"east": "west", "west": "east", "north": "south", "south": "north"}[facing]
+
+
+def _gate_ports(c):
+    inputs = c.int("inputs", 2)
+    size = c.int("size", 50)
+    width = c.int("width", 1)
+    facing = c.attr("facing", "east")
+    axis = size + (10 if c.name in XOR_GATES else 0) + (10 if c.name in NEGATED_OUTPUT else 0)
+    if inputs <= 3:
+        if size < 40:
+            start, dist, lower = -5, 10, 10
+        elif size < 60 or inputs <= 2:
+            start, dist, lower = -10, 20, 20
+        else:
+            start, dist, lower = -15, 30, 30
+    elif inputs == 4 and size >= 60:
+        start, dist, lower = -5, 20, 0
+    else:
+        start, dist, lower = -5, 10, 10
+    ports = [Port("out", (0, 0), width, True)]
+    for index in range(inputs):
+        if inputs & 1:
+            offset = start * (inputs - 1) + dist * index
+        else:
+            offset = start * inputs + dist * index + (lower if index >= inputs // 2 else 0)
+        dx = -axis - (10 if c.attr(f"negate{index}") == "true" else 0)
+        loc = {"east": (dx, offset), "west": (-dx, offset),
+               "north": (offset, -dx), "south": (offset, dx)}[facing]
+        ports.append(Port(f"in{index}", loc, width))
+    return ports
+
+
+def _plexer_ports(c, width, demux=False):
+    facing = c.attr("facing", "east")
+    select = c.int("select", 1)
+    count = 1 << select
+    sign = -1 if c.attr("selloc") == "tr" else 1
+    if count == 2:
+        offsets = {"west": ((30, -10), (30, 10), (20, sign * 20)),
+                   "north": ((-10, 30), (10, 30), (sign * -20, 20)),
+                   "south": ((-10, -30), (10, -30), (sign * -20, -20)),
+                   "east": ((-30, -10), (-30, 10), (-20, sign * 20))}[facing]
+        ends, sel = list(offsets[:2]), offsets[2]
+    else:
+        x = y = -(count // 2) * 10
+        dx = dy = 10
+        if facing == "west":
+            x, dx, sel = 40, 0, (20, sign * (y + 10 * count))
+        elif facing == "north":
+            y, dy, sel = 40, 0, (sign * x, 20)
+        elif facing == "south":
+            y, dy, sel = -40, 0, (sign * x, -20)
+        else:
+            x, dx, sel = -40, 0, (-20, sign * (y + 10 * count))
+        ends = [(x + dx * i, y + dy * i) for i in range(count)]
+    if demux:
+        if facing in ("east", "west"):
+            ends, sel = [(-x, y) for x, y in ends], (-sel[0], sel[1])
+        else:
+            ends, sel = [(x, -y) for x, y in ends], (sel[0], -sel[1])
+    ports = [Port(f"in{i}", loc, width, demux) for i, loc in enumerate(ends)]
+    ports.append(Port("select", sel, select))
+    if c.attr("enable") == "true":
+        ports.append(Port("enable", _translate(sel, facing, 10 if not demux else -10), 1))
+    ports.append(Port("out", (0, 0), width, not demux))
+    return ports
+
+
+def _decoder_ports(c):
+    facing = c.attr("facing", "east")
+    select = c.int("select", 1)
+    count = 1 << select
+    top = c.attr("selloc") == "tr"
+    if count == 2:
+        if facing in ("north", "south"):
+            y = -10 if facing == "north" else 10
+            ends = [(-30, y), (-10, y)] if top else [(10, y), (30, y)]
+        else:
+            x = -10 if facing == "west" else 10
+            ends = [(x, 10), (x, 30)] if top else [(x, -30), (x, -10)]
+    else:
+        if facing in ("north", "south"):
+            y = -20 if facing == "north" else 20
+            ends = [((-10 * count if top else 10) + 10 * i, y) for i in range(count)]
+        else:
+            x = -20 if facing == "west" else 20
+            ends = [(x, (10 if top else -10 * count) + 10 * i) for i in range(count)]
+    ports = [Port(f"out{i}", loc, 1, True) for i, loc in enumerate(ends)]
+    ports.append(Port("select", (0, 0), select))
+    if c.attr("enable", "true") == "true":
+        ports.append(Port("enable", _translate((0, 0), _reverse(facing), 10), 1))
+    return ports
+
+
+def splitter_ends(c):
+    """Returns the bit indices of the combined end carried by each split end."""
+    incoming = c.int("incoming", 2)
+    fanout = c.int("fanout", 2)
+    ends = [[] for _ in range(fanout)]
+    for bit in range(incoming):
+        # An attribute left at its default sends bit i to end i, or to the
+        # last end once i runs past the fanout.
+        value = c.attr(f"bit{bit}", str(min(bit, fanout - 1)))
+        if value != "none":
+            ends[int(value)].append(bit)
+    return ends
+
+
+def _splitter_ports(c):
+    facing = c.attr("facing", "east")
+    fanout = c.int("fanout", 2)
+    spacing = c.int("spacing", 1)
+    appear = c.attr("appear", "left")
+    justify = {"center": 0, "legacy": 0, "right": 1}.get(appear, -1)
+    if facing in ("north", "south"):
+        m = 1 if facing == "north" else -1
+        if justify == 0:
+            dx = 10 * spacing * ((fanout + 1) // 2 - 1)
+        else:
+            dx = -10 if m * justify < 0 else 10 * spacing * fanout
+        dy, ddx, ddy = -m * 20, -10 * spacing, 0
+    else:
+        m = -1 if facing == "west" else 1
+        dx = m * 20
+        if justify == 0:
+            dy = -10 * spacing * (fanout // 2)
+        else:
+            dy = 10 if m * justify > 0 else -10 * spacing * fanout
+        ddx, ddy = 0, 10 * spacing
+    ends = splitter_ends(c)
+    ports = [Port("combined", (0, 0), c.int("incoming", 2))]
+    for index, bits in enumerate(ends):
+        ports.append(Port(f"end{index}", (dx + ddx * index, dy + ddy * index), len(bits)))
+    return ports
+
+
+def _subcircuit_ports(c, circuits):
+    circuit = circuits[c.name]
+    inputs = sorted((p for p in circuit.pins() if p.attr("output") != "true"), key=lambda p: (p.loc[1], p.loc[0]))
+    outputs = sorted((p for p in circuit.pins() if p.attr("output") == "true"), key=lambda p: (p.loc[1], p.loc[0]))
+    width = c.int("width", 0)
+    ports = [Port(p.attr("label"), (0, SUBCIRCUIT_PITCH * i), p.int("width", 1), True) for i, p in enumerate(outputs)]
+    ports += [Port(p.attr("label"), (width, SUBCIRCUIT_PITCH * i), p.int("width", 1)) for i, p in enumerate(inputs)]
+    return ports
+
+
+def ports(c, circuits):
+    """Port locations relative to the component, with their widths and directions."""
+    name = c.name
+    width = c.int("width", 1)
+    if name in circuits:
+        return _subcircuit_ports(c, circuits)
+    if name in GATES:
+        return _gate_ports(c)
+    if name == "NOT Gate":
+        size = 20 if c.attr("size") == "20" else 30
+        return [Port("out", (0, 0), width, True),
+                Port("in", _translate((0, 0), _reverse(c.attr("facing", "east")), size), width)]
+    if name == "Controlled Buffer":
+        facing = c.attr("facing", "east")
+        side = 10 if c.attr("control") == "left" else -10
+        return [Port("out", (0, 0), width, True),
+                Port("in", _translate((0, 0), _reverse(facing), 20), width),
+                Port("control", _translate((0, 0), _reverse(facing), 10, side), 1)]
+    if name == "Multiplexer":
+        return _plexer_ports(c, width)
+    if name == "Demultiplexer":
+        return _plexer_ports(c, width, demux=True)
+    if name == "Decoder":
+        return _decoder_ports(c)
+    if name == "Splitter":
+        return _splitter_ports(c)
+    if name in ("Pin", "Tunnel", "Probe", "Constant", "Clock"):
+        return [Port("io", (0, 0), width, name in ("Constant", "Clock"))]
+    if name in ("Adder", "Subtractor"):
+        return [Port("a", (-40, -10), width), Port("b", (-40, 10), width), Port("out", (0, 0), width, True),
+                Port("cin", (-20, -20), 1), Port("cout", (-20, 20), 1, True)]
+    if name == "Comparator":
+        return [Port("a", (-40, -10), width), Port("b", (-40, 10), width),
+                Port("gt", (0, -10), 1, True), Port("eq", (0, 0), 1, True), Port("lt", (0, 10), 1, True)]
+    if name == "Shifter":
+        return [Port("in", (-40, -10), width), Port("shift", (-40, 10), max(1, (width - 1).bit_length())),
+                Port("out", (0, 0), width, True)]
+    if name == "Bit Extender":
+        result = [Port("in", (-40, 0), c.int("in_width", 8)), Port("out", (0, 0), c.int("out_width", 16), True)]
+        if c.attr("type") == "input":
+            result.append(Port("extend", (-20, 20), 1))
+        return result
+    if name == "Register":
+        if c.attr("appearance") == "classic":
+            offsets = {"q": (20, 0), "d": (-30, 0), "clock": (-20, 20), "clear": (0, 20), "enable": (-30, 10)}
+        else:
+            offsets = {"q": (60, 30), "d": (0, 30), "clock": (0, 70), "clear": (30, 90), "enable": (0, 50)}
+        return [Port(key, loc, width if key in ("q", "d") else 1, key == "q") for key, loc in offsets.items()]
+    if name == "Counter":
+        if c.attr("appearance") == "classic":
+            offsets = {"q": (0, 0), "d": (-30, 0), "clock": (-20, 20), "clear": (-10, 20),
+                       "load": (-30, -10), "count": (-30, 10), "carry": (0, 10)}
+        else:
+            offsets = {"q": (180, 110), "d": (0, 110), "clock": (0, 80), "clear": (0, 20),
+                       "load": (0, 30), "count": (0, 40), "carry": (180, 100)}
+        return [Port(key, loc, width if key in ("q", "d") else 1, key in ("q", "carry"))
+                for key, loc in offsets.items()]
+    raise CircuitError(f"unsupported component {c}")
+
+
+class Primitive(object):
+    __slots__ = ("component", "path", "ports", "outputs")
+
+    def __init__(self, component, path, ports, outputs):
+        self.component = component
+        self.path = path
+        self.ports = ports
+        self.outputs = outputs
+
+    @property
+    def name(self):
+        label = self.component.attr("label")
+        where = label if label else f"{self.component.name}({self.component.loc[0]},{self.component.loc[1]})"
+        return "/".join(self.path + (where,))
+
+
+# Flattening works on single bits: every wire net of every circuit instance
+# gets one id per bit, and tunnels, splitters and subcircuit pins merge ids
+# instead of becoming components. What is left are the logic primitives, each
+# with the list of bit ids on every port.
+class Netlist(object):
+    def __init__(self, circuits, top):
+        if top not in circuits:
+            raise CircuitError(f"no circuit named {top}")
+        self.circuits = circuits
+        self.top = top
+        self._parent = []
+        self.primitives = []
+        self.pins = {}
+        self._subcircuit_widths = {}
+        pins = self._flatten(circuits[top], ())
+        for component, bits in pins:
+            self.pins[component.attr("label")] = (component, bits)
+        self._resolve()
+
+    def _new(self, width):
+        start = len(self._parent)
+        self._parent.extend(range(start, start + width))
+        return list(range(start, start + width))
+
+    def _find(self, bit):
+        parent = self._parent
+        while parent[bit] != bit:
+            parent[bit] = parent[parent[bit]]
+            bit = parent[bit]
+        return bit
+
+    def _union(self, a, b):
+        if len(a) != len(b):
+            raise CircuitError(f"width mismatch between {len(a)} and {len(b)} bit connections")
+        for x, y in zip(a, b):
+            x, y = self._find(x), self._find(y)
+            if x != y:
+                self._parent[x] = y
+
+    def _subcircuit_width(self, component, points):
+        # The box width depends on label lengths and fonts, so take the first
+        # one that puts every input pin on a wire of this instance.
+        key = (component.name, component.loc)
+        if key not in self._subcircuit_widths:
+            for width in range(-20, -400, -10):
+                c = Component(component.name, component.loc, dict(component.attrs, width=str(width)))
+                inputs = [p for p in _subcircuit_ports(c, self.circuits) if not p.output]
+                if all((component.loc[0] + p.loc[0], component.loc[1] + p.loc[1]) in points for p in inputs):
+                    self._subcircuit_widths[key] = width
+                    break
+            else:
+                raise CircuitError(f"cannot place the pins of {component}")
+        return self._subcircuit_widths[key]
+
+    def _flatten(self, circuit, path):
+        points = {}
+
+        def point(loc):
+            if loc not in points:
+                points[loc] = len(points)
+            return points[loc]
+
+        union = {}
+
+        def find(p):
+            while union.setdefault(p, p) != p:
+                union[p] = union[union[p]]
+                p = union[p]
+            return p
+
+        def join(a, b):
+            a, b = find(a), find(b)
+            if a != b:
+                union[a] = b
+
+        for start, end in circuit.wires:
+            join(point(start), point(end))
+        ends = set(points)
+        for start, end in circuit.wires:
+            for loc in ends:
+                if start[0] == end[0] == loc[0] and min(start[1], end[1]) < loc[1] < max(start[1], end[1]):
+                    join(point(loc), point(start))
+                elif start[1] == end[1] == loc[1] and min(start[0], end[0]) < loc[0] < max(start[0], end[0]):
+                    join(point(loc), point(start))
+
+        placed = []
+        for component in circuit.components:
+            if component.name == "Text":
+                continue
+            if component.name in self.circuits:
+                c = Component(component.name, component.loc,
+                              dict(component.attrs, width=str(self._subcircuit_width(component, ends))))
+            else:
+                c = component
+            located = []
+            for port in ports(c, self.circuits):
+                loc = (component.loc[0] + port.loc[0], component.loc[1] + port.loc[1])
+                located.append((port, find(point(loc))))
+            placed.append((component, located))
+
+        tunnels = {}
+        for component, located in placed:
+            if component.name == "Tunnel":
+                label = component.attr("label")
+                if label in tunnels:
+                    join(located[0][1], tunnels[label])
+                else:
+                    tunnels[label] = located[0][1]
+
+        widths = {}
+        for component, located in placed:
+            if component.name == "Probe":
+                continue
+            for port, net in located:
+                net = find(net)
+                if port.width and widths.setdefault(net, port.width) != port.width:
+                    raise CircuitError(f"{'/'.join(path + (circuit.name,))}: {component} connects a "
+                                       f"{port.width} bit port to a {widths[net]} bit net")
+        bits = {net: self._new(width) for net, width in widths.items()}
+
+        def net_bits(net, width):
+            net = find(net)
+            if net not in bits:
+                bits[net] = self._new(width)
+            return bits[net]
+
+        pins = []
+        for component, located in placed:
+            name = component.name
+            if name in ("Tunnel", "Probe"):
+                continue
+            if name == "Pin":
+                port, net = located[0]
+                pins.append((component, net_bits(net, port.width)))
+            elif name == "Splitter":
+                combined = net_bits(located[0][1], located[0][0].width)
+                for (port, net), indices in zip(located[1:], splitter_ends(component)):
+                    if indices:
+                        self._union(net_bits(net, port.width), [combined[i] for i in indices])
+            elif name in self.circuits:
+                prefix = path + (f"{name}({component.loc[0]},{component.loc[1]})",)
+                inner = dict((p.attr("label"), b) for p, b in self._flatten(self.circuits[name], prefix))
+                for port, net in located:
+                    self._union(net_bits(net, port.width), inner[port.name])
+            else:
+                self.primitives.append(Primitive(component, path,
+                                                 {port.name: net_bits(net, port.width) for port, net in located},
+                                                 {port.name for port, net in located if port.output}))
+        return pins
+
+    def _resolve(self):
+        for primitive in self.primitives:
+            for key, bits in primitive.ports.items():
+                primitive.ports[key] = [self._find(bit) for bit in bits]
+        for label, (component, bits) in self.pins.items():
+            self.pins[label] = (component, [self._find(bit) for bit in bits])
@@ -0,0 +1,73 @@
+# Copyright 2022 Brian Johnson
+#
+# This file is part of brianiac
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, see <http://www.gnu.org/licenses/>.
+
+from brianiac.emulator.dma import DMA
+from brianiac.emulator.ram import RAM
+from brianiac.emulator.rom import ROM
+from brianiac.emulator.timer import Timer
+
+# Device types a memory map can name. Each factory is called with the CPU,
+# the size of the mapping, the ROM image path and the serial port, and
+# returns the Device to map. Other device types can be added to this table
+# before a map is populated.
+DEVICES = {
+    "rom": lambda cpu, size, romfile, serial: ROM(size, romfile),
+    "ram": lambda cpu, size, romfile, serial: RAM(size),
+    "serial": lambda cpu, size, romfile, serial: serial,
+    "dma": lambda cpu, size, romfile, serial: DMA(cpu),
+    "timer": lambda cpu, size, romfile, serial: Timer(cpu),
+}
+
+DEFAULT_MEMORY_MAP = (
+    (0x0000, 0x1fff, "rom"),
+    (0x2000, 0xefff, "ram"),
+    (0xf000, 0xf001, "serial"),
+    (0xf010, 0xf01f, "dma"),
+    (0xf020, 0xf027, "timer"),
+)
+
+
+def load(path):
+    """Reads a memory map file with one "START END TYPE" line per mapping and ; comments."""
+    memory_map = []
+    lines = []
+    with open(path) as f:
+        for number, line in enumerate(f, 1):
+            fields = line.split(";")[0].split()
+            if not fields:
+                continue
+            try:
+                start, end, kind = fields
+                start, end = int(start, 0), int(end, 0)
+            except ValueError:
+                raise ValueError(f"{path}:{number}: expected START END TYPE")
+            if kind not in DEVICES:
+                raise ValueError(f"{path}:{number}: unknown device type {kind}")
+            if not 0 <= start <= end <= 0xffff:
+                raise ValueError(f"{path}:{number}: 0x{start:04X}-0x{end:04X} is not a valid range")
+            for other, (other_start, other_end, other_kind) in zip(lines, memory_map):
+                if start <= other_end and other_start <= end:
+                    raise ValueError(f"{path}:{number}: 0x{start:04X}-0x{end:04X} overlaps {other_kind} "
+                                     f"0x{other_start:04X}-0x{other_end:04X} on line {other}")
+            lines.append(number)
+            memory_map.append((start, end, kind))
+    return memory_map
+
+
+def populate(cpu, memory_map, romfile, serial):
+    for start, end, kind in memory_map:
+        cpu.map(start, end, DEVICES[kind](cpu, end - start + 1, romfile, serial))
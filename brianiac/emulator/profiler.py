@@ -0,0 +1,101 @@
+# Copyright 2022 Brian Johnson
+#
+# This file is part of brianiac
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, see <http://www.gnu.org/licenses/>.
+
+from collections import Counter
+from brianiac.emulator.symbols import SymbolTable
+
+
+class Frame(object):
+    __slots__ = ("entry", "ret", "start")
+
+    def __init__(self, entry, ret, start):
+        self.entry = entry
+        self.ret = ret
+        self.start = start
+
+
+# Subroutines that save R15 on a software stack before calling others, like
+# printstring, still return through RET to the address their CALL left in R15,
+# so frames are popped by matching that return address rather than by tracking
+# R15 itself. A RET that matches no frame is treated as a plain jump.
+class Profiler(object):
+    def __init__(self, cpu):
+        self.cpu = cpu
+        self.count = 0
+        self.mark = 0
+        self.stack = [Frame(cpu.registers.pc, None, 0)]
+        self.active = Counter({cpu.registers.pc: 1})
+        self.calls = Counter()
+        self.edges = Counter()
+        self.inclusive = Counter()
+        self.exclusive = Counter()
+
+    def before(self, pc, name, opcode, imm):
+        pass
+
+    def after(self, pc, name, opcode, imm):
+        self.count += 1
+        if name == "CALL":
+            self._flush()
+            regs = self.cpu.registers
+            caller = self.stack[-1].entry
+            self.stack.append(Frame(regs.pc, regs.r[15], self.count))
+            self.active[regs.pc] += 1
+            self.calls[regs.pc] += 1
+            self.edges[(caller, regs.pc)] += 1
+        elif name == "RET":
+            target = self.cpu.registers.pc
+            for index in range(len(self.stack) - 1, 0, -1):
+                if self.stack[index].ret == target:
+                    self._flush()
+                    while len(self.stack) > index:
+                        self._leave(self.stack.pop())
+                    break
+
+    def _flush(self):
+        self.exclusive[self.stack[-1].entry] += self.count - self.mark
+        self.mark = self.count
+
+    def _leave(self, frame):
+        self.active[frame.entry] -= 1
+        if not self.active[frame.entry]:
+            self.inclusive[frame.entry] += self.count - frame.start
+
+    def totals(self):
+        inclusive = Counter(self.inclusive)
+        exclusive = Counter(self.exclusive)
+        exclusive[self.stack[-1].entry] += self.count - self.mark
+        seen = set()
+        for frame in self.stack:
+            if frame.entry not in seen:
+                seen.add(frame.entry)
+                inclusive[frame.entry] += self.count - frame.start
+        return inclusive, exclusive
+
+    def report(self, symbols=None):
+        symbols = symbols or SymbolTable()
+        inclusive, exclusive = self.totals()
+        total = max(self.count, 1)
+        lines = [f"{'Routine':<24} {'Calls':>10} {'Inclusive':>12} {'%':>6} {'Exclusive':>12} {'%':>6}"]
+        for entry, count in sorted(inclusive.items(), key=lambda item: (-item[1], item[0])):
+            lines.append(f"{symbols.describe(entry):<24} {self.calls[entry]:>10} {count:>12} "
+                         f"{100 * count / total:>6.1f} {exclusive[entry]:>12} {100 * exclusive[entry] / total:>6.1f}")
+        lines.append("")
+        lines.append(f"{'Caller':<24} {'Callee':<24} {'Calls':>10}")
+        for (caller, callee), count in sorted(self.edges.items(), key=lambda item: (-item[1], item[0])):
+            lines.append(f"{symbols.describe(caller):<24} {symbols.describe(callee):<24} {count:>10}")
+        return "\n".join(lines)
@@ -15,9 +15,18 @@
 # You should have received a copy of the GNU General Public License
 # along with this program; if not, see <http://www.gnu.org/licenses/>.
 
-class RAM(object):
+import struct
+from brianiac.emulator.device import Device
+
+_word = struct.Struct(">H")
+
+
+class RAM(Device):
+    buffered = True
+
     def __init__(self, size):
-        self._memory = [0 for _ in range(size)]
+        self._memory = bytearray(size)
+        self._pack_word = _word.pack_into
 
     def readu8(self, offset):
         return self._memory[offset]
@@ -29,5 +38,15 @@ class RAM(object):
         self._memory[offset] = value & 0xff
 
     def writeu16(self, offset, value):
-        self._memory[offset] = (value >> 8) & 0xff
-        self._memory[offset+1] = value & 0xff
+        self._pack_word(self._memory, offset, value & 0xffff)
+
+    def buffer(self, offset, length):
+        return memoryview(self._memory)[offset:offset+length]
+
+    def snapshot(self):
+        return bytes(self._memory)
+
+    def restore(self, data):
+        if len(data) != len(self._memory):
+            raise ValueError(f"RAM image is {len(data)} bytes, expected {len(self._memory)}")
+        self._memory[:] = data
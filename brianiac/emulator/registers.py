@@ -16,7 +16,8 @@
 # along with this program; if not, see <http://www.gnu.org/licenses/>.
 
 class Registers(object):
-    def __init__(self):
+    def __init__(self, alu):
+        self.alu = alu
         self.reset()
 
     def reset(self):
@@ -25,6 +26,14 @@ class Registers(object):
         self.status = 0
         self.immediate = 0
 
+    @property
+    def status(self):
+        return self.alu.status
+
+    @status.setter
+    def status(self, value):
+        self.alu.status = value
+
     def get(self, index):
         return self.r[index]
 
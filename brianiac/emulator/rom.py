@@ -15,14 +15,26 @@
 # You should have received a copy of the GNU General Public License
 # along with this program; if not, see <http://www.gnu.org/licenses/>.
 
-class ROM(object):
+from brianiac.emulator.device import Device
+
+
+# The image is copied in rather than mapped from the file, so rebuilding or
+# truncating the ROM file while the emulator runs cannot fault it. A short
+# file leaves the rest of the ROM zero.
+class ROM(Device):
+    read_only = True
+    buffered = True
+
     def __init__(self, size, file):
+        self._memory = bytearray(size)
         with open(file, "rb") as f:
-            data = list(f.read())
-            self._memory = data[:size] + [0] * (size - len(data))
+            f.readinto(memoryview(self._memory))
 
     def readu8(self, offset):
         return self._memory[offset]
 
     def readu16(self, offset):
         return (self._memory[offset] << 8) | self._memory[offset+1]
+
+    def buffer(self, offset, length):
+        return memoryview(self._memory)[offset:offset+length].toreadonly()
@@ -18,29 +18,116 @@
 import pty
 import os
 import select
+import threading
+import time
+import tty
+from collections import deque
+from brianiac.emulator.device import Device
 
+RX_BUFFER_SIZE = 4096
+TX_BUFFER_SIZE = 256
+FLUSH_INTERVAL = 0.01
 
-class Serial(object):
-    def __init__(self):
-        (master, slave) = pty.openpty()
-        self.poll = select.poll()
-        self.poll.register(master, select.POLLIN | select.POLLHUP)
-        slavename = os.ttyname(slave)
-        os.close(slave)
-        self.fd = master
-        print(f"Slave PTY: {slavename}")
+
+class Serial(Device):
+    widths = (8,)
+    read_effects = (1,)
+
+    def __init__(self, rx=None, tx=None):
+        self.pty = rx is None and tx is None
+        if self.pty:
+            (master, slave) = pty.openpty()
+            slavename = os.ttyname(slave)
+            tty.setraw(slave)
+            os.close(slave)
+            rx = tx = master
+            print(f"Slave PTY: {slavename}")
+        self.rx = rx
+        self.tx = tx
+        self.eof = rx is None
+        self._rx = deque()
+        self._rx_ready = threading.Condition()
+        self._tx = bytearray()
+        self._tx_lock = threading.Lock()
+        if rx is not None:
+            self.poll = select.poll()
+            self.poll.register(rx, select.POLLIN | select.POLLHUP)
+            self._reader = threading.Thread(target=self._receive, name="serial-rx", daemon=True)
+            self._reader.start()
+
+    def _receive(self):
+        while True:
+            if len(self._rx) >= RX_BUFFER_SIZE:
+                events = ()
+                time.sleep(FLUSH_INTERVAL)
+            else:
+                events = self.poll.poll(FLUSH_INTERVAL * 1000)
+            self.flush()
+            for fd, event in events:
+                data = b""
+                if event & (select.POLLIN | select.POLLHUP):
+                    try:
+                        data = os.read(self.rx, RX_BUFFER_SIZE - len(self._rx))
+                    except OSError:
+                        pass
+                if data:
+                    with self._rx_ready:
+                        self._rx.extend(data)
+                        self._rx_ready.notify_all()
+                elif not self.pty:
+                    with self._rx_ready:
+                        self.eof = True
+                        self._rx_ready.notify_all()
+                    return
+                else:
+                    time.sleep(FLUSH_INTERVAL)
+
+    def flush(self):
+        # Taking the buffer and writing it out happen under one lock, so a
+        # flush from the reader thread cannot overtake one from the CPU.
+        if self._tx:
+            with self._tx_lock:
+                data = bytes(self._tx)
+                self._tx.clear()
+                while data and self.tx is not None:
+                    data = data[os.write(self.tx, data):]
 
     def readu8(self, offset):
         if offset == 0:
-            for event in self.poll.poll(1):
-                if event[0] == self.fd and (event[1] & select.POLLIN):
-                    return 1
+            if self._rx:
+                return 1
+            self.flush()
             return 0
         elif offset == 1:
-            data = os.read(self.fd, 1)
-            return ord(data)
+            if self._rx:
+                return self._rx.popleft()
+            return 0
         return 0xff
 
+    def wait(self, offset, timeout):
+        if offset == 0:
+            self.flush()
+            with self._rx_ready:
+                if not self._rx:
+                    if self.eof:
+                        return False
+                    self._rx_ready.wait(timeout)
+        return True
+
     def writeu8(self, offset, value):
         if offset == 1:
-            os.write(self.fd, (value & 0xff).to_bytes(1, 'big'))
+            with self._tx_lock:
+                self._tx.append(value & 0xff)
+            if value & 0xff == 0x0a or len(self._tx) >= TX_BUFFER_SIZE:
+                self.flush()
+
+    def snapshot(self):
+        self.flush()
+        with self._rx_ready:
+            return bytes(self._rx)
+
+    def restore(self, data):
+        with self._rx_ready:
+            self._rx.clear()
+            self._rx.extend(data)
+            self._rx_ready.notify_all()
@@ -0,0 +1,123 @@
+# Copyright 2022 Brian Johnson
+#
+# This file is part of brianiac
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, see <http://www.gnu.org/licenses/>.
+
+import mmap
+import struct
+
+MAGIC = b"BRSN"
+VERSION = 1
+
+_header = struct.Struct(">4sHH")
+_section = struct.Struct(">4sHI")
+_cpu = struct.Struct(">16HHHHQ")
+
+
+class SnapshotError(Exception):
+    pass
+
+
+def _sections(cpu):
+    regs = cpu.registers
+    yield (b"CPU ", 0, _cpu.pack(*regs.r, regs.pc, regs.status, regs.immediate, cpu.instructions))
+    for r, device in sorted(cpu.memory_map.items(), key=lambda item: item[0].start):
+        data = device.snapshot()
+        if data is not None:
+            yield (b"DEV ", r.start, data)
+
+
+def dumps(cpu):
+    sections = list(_sections(cpu))
+    parts = [_header.pack(MAGIC, VERSION, len(sections))]
+    for tag, address, data in sections:
+        parts.append(_section.pack(tag, address, len(data)))
+        parts.append(data)
+    return b"".join(parts)
+
+
+def save(cpu, path):
+    with open(path, "wb") as f:
+        f.write(dumps(cpu))
+
+
+def _parse(view, name, stateful):
+    """Returns (tag, address, start, end) for each section, after checking they all fit and can be restored."""
+    if view[:len(MAGIC)] != MAGIC:
+        raise SnapshotError(f"{name} is not a snapshot")
+    try:
+        magic, version, count = _header.unpack_from(view, 0)
+        if version != VERSION:
+            raise SnapshotError(f"{name} is not a version {VERSION} snapshot")
+        offset = _header.size
+        sections = []
+        for _ in range(count):
+            tag, address, length = _section.unpack_from(view, offset)
+            offset += _section.size
+            if offset + length > len(view):
+                raise SnapshotError(f"{name} is truncated")
+            if tag == b"CPU ":
+                if length != _cpu.size:
+                    raise SnapshotError(f"{name} has a {length} byte CPU section, expected {_cpu.size}")
+            elif tag == b"DEV ":
+                if address not in stateful:
+                    raise SnapshotError(f"no device at 0x{address:04X} to restore")
+            else:
+                raise SnapshotError(f"unknown section {tag!r}")
+            sections.append((tag, address, offset, offset + length))
+            offset += length
+    except struct.error:
+        raise SnapshotError(f"{name} is truncated")
+    return sections
+
+
+def _restore(cpu, devices, tag, address, payload):
+    if tag == b"CPU ":
+        values = _cpu.unpack(payload)
+        cpu.registers.r[:] = values[:16]
+        cpu.registers.pc, cpu.registers.status, cpu.registers.immediate, cpu.instructions = values[16:]
+    else:
+        devices[address].restore(payload)
+
+
+def loads(cpu, data, name="snapshot"):
+    # Every section is checked before anything is restored, and the state
+    # saved here is put back if a device still rejects its section, so a bad
+    # snapshot never leaves the machine half loaded.
+    devices = {r.start: device for r, device in cpu.memory_map.items()}
+    previous = list(_sections(cpu))
+    stateful = {address for tag, address, payload in previous if tag == b"DEV "}
+    with memoryview(data) as view:
+        sections = _parse(view, name, stateful)
+        try:
+            for tag, address, start, end in sections:
+                with view[start:end] as payload:
+                    _restore(cpu, devices, tag, address, payload)
+        except (ValueError, struct.error) as e:
+            for section in previous:
+                _restore(cpu, devices, *section)
+            raise SnapshotError(f"{name} does not fit this machine: {e}")
+    if cpu.translator is not None:
+        cpu.translator.flush()
+
+
+def load(cpu, path):
+    with open(path, "rb") as f:
+        try:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            raise SnapshotError(f"{path} is empty")
+    with data:
+        loads(cpu, data, path)
@@ -0,0 +1,70 @@
+# Copyright 2022 Brian Johnson
+#
+# This file is part of brianiac
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, see <http://www.gnu.org/licenses/>.
+
+import bisect
+import os
+
+
+class SymbolTable(object):
+    def __init__(self, symbols=None):
+        self.names = {}
+        self.addresses = {}
+        self._sorted = None
+        for name, address in (symbols or {}).items():
+            self.add(name, address)
+
+    @classmethod
+    def load(cls, path):
+        table = cls()
+        with open(path) as f:
+            for number, line in enumerate(f, 1):
+                fields = line.split()
+                if not fields:
+                    continue
+                if len(fields) != 2:
+                    raise ValueError(f"{path}:{number}: expected an address and a name")
+                table.add(fields[1], int(fields[0], 0))
+        return table
+
+    @classmethod
+    def for_rom(cls, romfile):
+        path = os.path.splitext(romfile)[0] + ".sym"
+        return cls.load(path) if os.path.exists(path) else cls()
+
+    def add(self, name, address):
+        self.names[name] = address
+        self.addresses.setdefault(address, name)
+        self._sorted = None
+
+    def __len__(self):
+        return len(self.names)
+
+    def lookup(self, name):
+        return self.names.get(name)
+
+    def name(self, address):
+        return self.addresses.get(address)
+
+    def describe(self, address):
+        if self._sorted is None:
+            self._sorted = sorted(self.addresses)
+        index = bisect.bisect_right(self._sorted, address) - 1
+        if index < 0:
+            return f"0x{address:04X}"
+        base = self._sorted[index]
+        name = self.addresses[base]
+        return name if base == address else f"{name}+0x{address - base:X}"
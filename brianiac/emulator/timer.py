@@ -0,0 +1,125 @@
+# Copyright 2022 Brian Johnson
+#
+# This file is part of brianiac
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, see <http://www.gnu.org/licenses/>.
+
+import struct
+from brianiac.emulator.device import Device
+
+COUNT = 0
+PRESCALE = 1
+COMPARE = 2
+STATUS = 3
+
+EXPIRED = 1
+
+_state = struct.Struct(">IqHq")
+
+
+# Counter driven by the CPU cycle count rather than wall time, so a program
+# sees the same timings on every run however fast the host is. The registers
+# are big-endian words:
+#   +0 COUNT     ticks since reset, wrapping at 16 bits; writing sets it
+#   +2 PRESCALE  cycles per tick, 0 meaning 65536; writing keeps the count
+#   +4 COMPARE   writing arms the timer to expire when COUNT next equals it
+#   +6 STATUS    reads 1 once the armed timer has expired; writing clears it
+#                and disarms the timer
+# Nothing is stored per tick. The count is worked out from the cycle count
+# when it is read, and an armed timer just remembers the cycle it expires on,
+# which next_change hands to the translator so loops polling STATUS or COUNT
+# jump straight there.
+class Timer(Device):
+    def __init__(self, cpu):
+        self.cpu = cpu
+        self.prescale = 1
+        self.origin = 0
+        self.compare = 0
+        self.deadline = None
+
+    def ticks(self, cycles):
+        return (cycles - self.origin) // self.prescale
+
+    def _expired(self, cycles):
+        return self.deadline is not None and cycles >= self.deadline
+
+    def _arm(self, cycles):
+        ticks = self.ticks(cycles)
+        delta = (self.compare - ticks) & 0xffff or 0x10000
+        self.deadline = self.origin + (ticks + delta) * self.prescale
+
+    def readu16(self, offset):
+        cycles = self.cpu.cycles
+        index = offset >> 1
+        if index == COUNT:
+            return self.ticks(cycles) & 0xffff
+        if index == PRESCALE:
+            return self.prescale & 0xffff
+        if index == COMPARE:
+            return self.compare
+        if index == STATUS:
+            return EXPIRED if self._expired(cycles) else 0
+        return 0
+
+    def readu8(self, offset):
+        value = self.readu16(offset & ~1)
+        return value & 0xff if offset & 1 else value >> 8
+
+    def writeu16(self, offset, value):
+        cycles = self.cpu.cycles
+        index = offset >> 1
+        value &= 0xffff
+        armed = self.deadline is not None and not self._expired(cycles)
+        if index == COUNT:
+            self.origin = cycles - value * self.prescale
+        elif index == PRESCALE:
+            ticks = self.ticks(cycles)
+            self.prescale = value or 0x10000
+            self.origin = cycles - ticks * self.prescale
+        elif index == COMPARE:
+            self.compare = value
+            armed = True
+        elif index == STATUS:
+            self.deadline = None
+            return
+        else:
+            return
+        if armed:
+            self._arm(cycles)
+
+    def writeu8(self, offset, value):
+        current = self.readu16(offset & ~1)
+        if offset & 1:
+            value = (current & 0xff00) | (value & 0xff)
+        else:
+            value = (current & 0x00ff) | ((value & 0xff) << 8)
+        self.writeu16(offset & ~1, value)
+
+    def next_change(self, offset, size, cycles):
+        index = offset >> 1
+        low = size == 16 or offset & 1
+        if index == STATUS and low:
+            return None if self._expired(cycles) else self.deadline
+        if index == COUNT:
+            step = 1 if low else 0x100
+            return self.origin + (self.ticks(cycles) // step + 1) * step * self.prescale
+        return None
+
+    def snapshot(self):
+        deadline = -1 if self.deadline is None else self.deadline
+        return _state.pack(self.prescale, self.origin, self.compare, deadline)
+
+    def restore(self, data):
+        self.prescale, self.origin, self.compare, deadline = _state.unpack(data)
+        self.deadline = None if deadline < 0 else deadline
@@ -0,0 +1,53 @@
+# Copyright 2022 Brian Johnson
+#
+# This file is part of brianiac
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, see <http://www.gnu.org/licenses/>.
+
+import time
+
+# Timing taken from the Control circuit in logisim/brianiac.circ. The T-state
+# counter there is a free running 2 bit counter cleared only by RESET, and the
+# control lines are multiplexed on it:
+#   T0  IRload, PCen                  fetch the instruction word
+#   T1  IMMload, PCen when IR bit 8   fetch the immediate word
+#   T2  ADDRsel, DOUTenable, ByteEn   memory access for loads and stores
+#   T3  REGWrite, STload, PCload      write back registers, status and PC
+# so every instruction takes four clocks and an immediate is fetched in T1,
+# which instructions without one leave idle, rather than in an extra cycle.
+CYCLES_PER_INSTRUCTION = 4
+THROTTLE_SLICE = 0.01
+MAX_LAG = 0.1
+
+
+class Throttle(object):
+    def __init__(self, frequency):
+        self.frequency = frequency
+        self.start = None
+        self.cycles = 0
+
+    def slice(self):
+        return max(1, int(self.frequency * THROTTLE_SLICE) // CYCLES_PER_INSTRUCTION)
+
+    def begin(self, cycles):
+        self.start = time.monotonic()
+        self.cycles = cycles
+
+    def pace(self, cycles):
+        due = self.start + (cycles - self.cycles) / self.frequency
+        delay = due - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        elif delay < -MAX_LAG:
+            self.begin(cycles)
@@ -0,0 +1,208 @@
+# Copyright 2022 Brian Johnson
+#
+# This file is part of brianiac
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, see <http://www.gnu.org/licenses/>.
+
+import mmap
+import struct
+from collections import Counter
+from brianiac.emulator.decoder import decode_table
+
+MAGIC = b"BRTR"
+VERSION = 1
+BUFFER_SIZE = 1 << 20
+
+# Every executed instruction becomes one 16 byte little endian record:
+#   pc, opcode word, immediate, new register value, memory address, memory data,
+#   register index (NO_REGISTER if none changed), flag bits with the status in the top nibble
+_header = struct.Struct("<4sHH")
+_record = struct.Struct("<HHHHHHBBxx")
+
+NO_REGISTER = 0xff
+IMMEDIATE = 1
+REGISTER = 2
+READ = 4
+WRITE = 8
+
+
+class TraceError(Exception):
+    pass
+
+
+class Record(object):
+    __slots__ = ("pc", "word", "imm", "value", "address", "data", "reg", "flags")
+
+    def __init__(self, pc, word, imm, value, address, data, reg, flags):
+        self.pc = pc
+        self.word = word
+        self.imm = imm if flags & IMMEDIATE else None
+        self.value = value
+        self.address = address
+        self.data = data
+        self.reg = reg if flags & REGISTER else None
+        self.flags = flags
+
+    @property
+    def name(self):
+        return decode_table().names[self.word]
+
+    @property
+    def status(self):
+        return self.flags >> 4
+
+    @property
+    def read(self):
+        return bool(self.flags & READ)
+
+    @property
+    def write(self):
+        return bool(self.flags & WRITE)
+
+    def __str__(self):
+        imm = f"{self.imm:04X}" if self.imm is not None else "    "
+        text = f"{self.pc:04X}: {self.word:04X} {imm}  {self.name:<4}"
+        if self.reg is not None:
+            text += f"  R{self.reg}={self.value:04X}"
+        if self.read:
+            text += f"  [{self.address:04X}] -> {self.data:04X}"
+        if self.write:
+            text += f"  [{self.address:04X}] <- {self.data:04X}"
+        return text
+
+
+class Tracer(object):
+    def __init__(self, cpu, path, buffer_size=BUFFER_SIZE):
+        self.cpu = cpu
+        self.path = path
+        self.file = open(path, "wb")
+        self.file.write(_header.pack(MAGIC, VERSION, _record.size))
+        self.records = buffer_size // _record.size
+        self.buffer = bytearray(self.records * _record.size)
+        self.used = 0
+        self.count = 0
+
+    def before(self, pc, name, opcode, imm):
+        r = self.cpu.registers.r
+        flags = 0
+        reg = NO_REGISTER
+        address = data = 0
+        if imm is not None:
+            flags |= IMMEDIATE
+        if opcode._grp == 0b001:
+            if name not in ("CP", "TEST"):
+                reg = opcode.rn
+        elif name in ("MOV", "LDW", "LDB"):
+            reg = opcode.rn
+            if name != "MOV":
+                flags |= READ
+                address = imm if imm is not None else r[opcode.rm]
+        elif name == "CALL":
+            reg = 15
+        elif name in ("STW", "STB"):
+            flags |= WRITE
+            address = imm if imm is not None else r[opcode.rn]
+            data = r[opcode.rm] & (0xffff if name == "STW" else 0xff)
+        if reg != NO_REGISTER:
+            flags |= REGISTER
+        self._pending = (pc, opcode.word, imm or 0, address, data, reg, flags)
+
+    def after(self, pc, name, opcode, imm):
+        pc, word, imm, address, data, reg, flags = self._pending
+        value = 0
+        if reg != NO_REGISTER:
+            value = self.cpu.registers.r[reg]
+            if flags & READ:
+                data = value
+        flags |= self.cpu.alu.status << 4
+        _record.pack_into(self.buffer, self.used * _record.size, pc, word, imm, value, address, data, reg, flags)
+        self.used += 1
+        self.count += 1
+        if self.used == self.records:
+            self.flush()
+
+    def flush(self):
+        with memoryview(self.buffer) as view:
+            self.file.write(view[:self.used * _record.size])
+        self.file.flush()
+        self.used = 0
+
+    def close(self):
+        self.flush()
+        self.file.close()
+
+
+class TraceReader(object):
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            try:
+                self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                raise TraceError(f"{path} is empty")
+        if self.data[:len(MAGIC)] != MAGIC or len(self.data) < _header.size:
+            self.data.close()
+            raise TraceError(f"{path} is not a trace")
+        magic, version, size = _header.unpack_from(self.data, 0)
+        if version != VERSION or size != _record.size:
+            self.data.close()
+            raise TraceError(f"{path} is not a version {VERSION} trace")
+
+    def __len__(self):
+        return (len(self.data) - _header.size) // _record.size
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.data.close()
+
+    def raw(self):
+        end = _header.size + len(self) * _record.size
+        with memoryview(self.data) as view, view[_header.size:end] as records:
+            yield from _record.iter_unpack(records)
+
+    def records(self, pcs=None, addresses=None):
+        for fields in self.raw():
+            if pcs is not None and fields[0] not in pcs:
+                continue
+            if addresses is not None and (not fields[7] & (READ | WRITE) or fields[4] not in addresses):
+                continue
+            yield Record(*fields)
+
+    def statistics(self, pcs=None, addresses=None):
+        names = decode_table().names
+        count = 0
+        pc_counts = Counter()
+        opcode_counts = Counter()
+        reads = Counter()
+        writes = Counter()
+        for fields in self.raw():
+            pc, word, address, flags = fields[0], fields[1], fields[4], fields[7]
+            if pcs is not None and pc not in pcs:
+                continue
+            if addresses is not None and (not flags & (READ | WRITE) or address not in addresses):
+                continue
+            count += 1
+            pc_counts[pc] += 1
+            opcode_counts[names[word]] += 1
+            if flags & READ:
+                reads[address] += 1
+            elif flags & WRITE:
+                writes[address] += 1
+        return {"instructions": count, "pcs": pc_counts, "opcodes": opcode_counts,
+                "reads": reads, "writes": writes}
@@ -0,0 +1,486 @@
+# Copyright 2022 Brian Johnson
+#
+# This file is part of brianiac
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, see <http://www.gnu.org/licenses/>.
+
+from brianiac.emulator.alu import flags
+from brianiac.emulator.decoder import decode_table
+from brianiac.emulator.timing import CYCLES_PER_INSTRUCTION
+
+MAX_BLOCK_LENGTH = 64
+IDLE_TIMEOUT = 0.1
+
+BRANCHES = ("BRA", "BZ", "BNZ", "BC", "BNC", "CALL", "RET")
+FLAG_READERS = ("ADD", "SUB", "BZ", "BNZ", "BC", "BNC")
+MEMORY = ("LDW", "LDB", "STW", "STB")
+
+ALU_EXPRESSIONS = {
+    "ADD": "{a} + {b} + (st & 1)",
+    "SUB": "{a} - {b} - (st & 1)",
+    "AND": "{a} & {b}",
+    "OR": "{a} | {b}",
+    "XOR": "{a} ^ {b}",
+    "NOT": "~{a}",
+    "SHR": "{a} >> 1",
+    "SHL": "{a} << 1",
+    "CP": "{a} - {b}",
+    "TEST": "{a} & {b}",
+}
+
+CONDITIONS = {
+    "BZ": "st & 2",
+    "BNZ": "not (st & 2)",
+    "BC": "st & 1",
+    "BNC": "not (st & 1)",
+}
+
+
+def _accesses(name, opcode, imm):
+    """Returns the registers, with "st" for the flags, an instruction reads and writes."""
+    reads = []
+    writes = []
+    if opcode._grp == 0b001:
+        reads.append(opcode.rn)
+        if imm is None and name not in ("NOT", "SHR", "SHL"):
+            reads.append(opcode.rm)
+        if name not in ("CP", "TEST"):
+            writes.append(opcode.rn)
+        writes.append("st")
+    elif name == "MOV":
+        if imm is None:
+            reads.append(opcode.rm)
+        writes.append(opcode.rn)
+    elif name in ("LDB", "LDW"):
+        writes.append(opcode.rn)
+    if name in FLAG_READERS:
+        reads.append("st")
+    return reads, writes
+
+
+def _repeatable(instructions):
+    """True if running the block again leaves the same registers and flags, given the same loads."""
+    accesses = [_accesses(name, opcode, imm) for pc, name, opcode, imm, next_pc in instructions]
+    written = {register for reads, writes in accesses for register in writes}
+    defined = set()
+    for reads, writes in accesses:
+        if any(register in written and register not in defined for register in reads):
+            return False
+        defined.update(writes)
+    return True
+
+
+# Idle hooks for translated loops that branch back to their own start. The
+# run loop calls block.idle(remaining) each time round and gets back the
+# number of extra instructions it accounted for, or None if the loop can
+# never exit. A breakpoint on the loop turns them off, so the run stops there
+# instead.
+class Halt(object):
+    __slots__ = ("translator", "start")
+
+    def __init__(self, translator, start):
+        self.translator = translator
+        self.start = start
+
+    def __call__(self, remaining):
+        return 0 if self.start in self.translator.boundaries else None
+
+
+class Wait(object):
+    __slots__ = ("translator", "start", "wait", "offset")
+
+    def __init__(self, translator, start, wait, offset):
+        self.translator = translator
+        self.start = start
+        self.wait = wait
+        self.offset = offset
+
+    def __call__(self, remaining):
+        if self.start in self.translator.boundaries:
+            return 0
+        return 0 if self.wait(self.offset, IDLE_TIMEOUT) else None
+
+
+# A loop that rereads a device register and otherwise recomputes the same
+# registers every time round can only take a different path once the value
+# read changes. The device says at which cycle that can first happen, so the
+# iterations before it are retired in one go: the instruction count, the
+# block's run and branch counts and the read count all come out as if they
+# had been executed, and the device reads the same values at the same cycles.
+class FastForward(object):
+    __slots__ = ("translator", "next_change", "offset", "size", "page", "region", "start", "count", "index", "counts")
+
+    def __init__(self, translator, next_change, offset, size, page, region, start, count, index, counts):
+        self.translator = translator
+        self.next_change = next_change
+        self.offset = offset
+        self.size = size
+        self.page = page
+        self.region = region
+        self.start = start
+        self.count = count
+        self.index = index
+        self.counts = counts
+
+    def __call__(self, remaining):
+        if self.start in self.translator.boundaries:
+            return 0
+        cpu = self.translator.cpu
+        # The load in the run just finished happened after
+        # cpu.instructions - count + index instructions, and the one in the
+        # n-th run from now happens n * count instructions after that.
+        last = cpu.instructions - self.count + self.index
+        change = self.next_change(self.offset, self.size, last * CYCLES_PER_INSTRUCTION)
+        if change is None:
+            return None
+        due = -(-change // CYCLES_PER_INSTRUCTION) - last - self.count
+        runs = min(-(-due // self.count), remaining // self.count)
+        if runs <= 0:
+            return 0
+        self.counts[0] += runs
+        self.counts[1] += runs
+        cpu.counters.reads[self.page] += runs
+        if self.region is not None:
+            cpu.counters.device_reads[self.region] += runs
+        cpu.instructions += runs * self.count
+        return runs * self.count
+
+
+class Block(object):
+    __slots__ = ("start", "end", "count", "pages", "function", "source", "idle", "words", "counts")
+
+    def __init__(self, start, end, count, function, source, idle=None, words=(), counts=None):
+        self.start = start
+        self.end = end
+        self.count = count
+        self.pages = range(start >> 8, ((end - 1) >> 8) + 1)
+        self.function = function
+        self.source = source
+        self.idle = idle
+        self.words = words
+        self.counts = [0, 0] if counts is None else counts
+
+    def address(self, index):
+        """Returns the address of the instruction index places into the block."""
+        opcodes = decode_table().opcodes
+        pc = self.start
+        for word in self.words[:index]:
+            pc += 4 if opcodes[word].immediate else 2
+        return pc & 0xffff
+
+
+class Translator(object):
+    def __init__(self, cpu):
+        self.cpu = cpu
+        self.blocks = {}
+        self.boundaries = frozenset()
+        self.watched = ((), ())
+        self.generation = 0
+        self._page_blocks = {}
+
+    def lookup(self, pc):
+        block = self.blocks.get(pc)
+        if block is None:
+            block = self.translate(pc)
+        return block
+
+    def set_boundaries(self, addresses):
+        addresses = frozenset(addresses)
+        changed = addresses.symmetric_difference(self.boundaries)
+        self.boundaries = addresses
+        if changed:
+            for block in list(self.blocks.values()):
+                if any(block.start < address < block.end for address in changed):
+                    self._discard(block)
+
+    def set_watched(self, reads, writes):
+        watched = (tuple(sorted(reads)), tuple(sorted(writes)))
+        if watched != self.watched:
+            self.watched = watched
+            self.flush()
+
+    def _hits_watch(self, name, imm):
+        """Returns whether a load or store may touch a watched range, which any indirect access may."""
+        ranges = self.watched[name in ("STW", "STB")]
+        if imm is None or not ranges:
+            return bool(ranges)
+        last = imm + (1 if name in ("LDW", "STW") else 0)
+        return any(start <= last and imm <= end for start, end in ranges)
+
+    def flush(self):
+        for block in list(self.blocks.values()):
+            self._discard(block)
+
+    def _discard(self, block):
+        del self.blocks[block.start]
+        self.generation += 1
+        self.cpu.counters.retire(block)
+        for page in block.pages:
+            starts = self._page_blocks.get(page)
+            if starts is not None:
+                starts.discard(block.start)
+                if not starts:
+                    del self._page_blocks[page]
+                    self.cpu.remove_write_hook(page, self._invalidate)
+
+    def _invalidate(self, address, size=1, value=None):
+        end = address + size
+        for start in list(self._page_blocks.get(address >> 8, ())):
+            block = self.blocks[start]
+            if block.start < end and address < block.end:
+                self._discard(block)
+
+    def _decode(self, pc):
+        table = decode_table()
+        instructions = []
+        while len(instructions) < MAX_BLOCK_LENGTH:
+            if pc & 1 or (instructions and pc in self.boundaries):
+                break
+            word = self.cpu.peeku16(pc)
+            name = table.names[word]
+            if name is None:
+                break
+            opcode = table.opcodes[word]
+            imm = None
+            next_pc = (pc + 2) & 0xffff
+            if opcode.immediate:
+                imm = self.cpu.peeku16(next_pc)
+                next_pc = (next_pc + 2) & 0xffff
+            instructions.append((pc, name, opcode, imm, next_pc))
+            if name in BRANCHES or next_pc < pc:
+                break
+            if name in MEMORY and self._hits_watch(name, imm):
+                break
+            pc = next_pc
+        return instructions
+
+    def _polled(self, instructions):
+        """Returns (index, address, size) of the one load in a loop that only polls memory, or None."""
+        start = instructions[0][0]
+        name, opcode, imm = instructions[-1][1:4]
+        if name not in CONDITIONS or imm != start:
+            return None
+        polled = []
+        for index, (pc, name, opcode, imm, next_pc) in enumerate(instructions[:-1]):
+            if name in ("LDB", "LDW") and imm is not None:
+                polled.append((index, imm, 16 if name == "LDW" else 8))
+            elif opcode._grp != 0b001 and name not in ("NOP", "MOV"):
+                return None
+        if len(polled) != 1:
+            return None
+        return polled[0]
+
+    def _idle(self, instructions, counts):
+        start = instructions[0][0]
+        name, opcode, imm = instructions[-1][1:4]
+        if name == "BRA" and imm == start:
+            for pc, name, opcode, imm, next_pc in instructions[:-1]:
+                if opcode._grp != 0b001 and name not in ("NOP", "MOV"):
+                    return None
+            return Halt(self, start)
+        polled = self._polled(instructions)
+        if polled is None:
+            return None
+        index, address, size = polled
+        device, offset = self.cpu.device_at(address)
+        if device is None:
+            return None
+        if device.wait is not None:
+            return Wait(self, start, device.wait, offset)
+        if device.next_change is not None and _repeatable(instructions):
+            region = None
+            if self.cpu.counters.shared(address >> 8):
+                region = next(r for r in self.cpu.memory_map if address in r)
+            return FastForward(self, device.next_change, offset, size, address >> 8, region, start, len(instructions),
+                               index, counts)
+        return None
+
+    def idle_at(self, pc):
+        """Returns the idle hook of a loop starting at pc and the address of its branch back, without translating it."""
+        instructions = self._decode(pc)
+        if not instructions:
+            return None, None
+        return self._idle(instructions, [0, 0]), instructions[-1][0]
+
+    def translate(self, pc):
+        instructions = self._decode(pc)
+        if not instructions:
+            return None
+
+        live = [False] * len(instructions)
+        last_writer = None
+        needed = False
+        for index in range(len(instructions) - 1, -1, -1):
+            name, opcode = instructions[index][1:3]
+            if opcode._grp == 0b001:
+                live[index] = needed
+                needed = False
+                if last_writer is None:
+                    last_writer = index
+            if name in FLAG_READERS:
+                needed = True
+        # A store can discard the running block, by patching its own code or
+        # through a device such as DMA, so the block checks the generation
+        # after each store that is not its last instruction and leaves early
+        # if it changed. The ALU op before such a store keeps its flags so
+        # that the early exit leaves them as stepping would. A word access
+        # that may be unaligned can raise MemoryAccessError, so the flags are
+        # also written back to the ALU before it.
+        checked = [name in ("STW", "STB") for pc_, name, opcode, imm, next_pc in instructions[:-1]] + [False]
+        faulting = [name in ("LDW", "STW") and (imm is None or imm & 1)
+                    for pc_, name, opcode, imm, next_pc in instructions]
+        saved = [False] * len(instructions)
+        previous = None
+        for index, (pc_, name, opcode, imm, next_pc) in enumerate(instructions):
+            if opcode._grp == 0b001:
+                previous = index
+            elif (checked[index] or faulting[index]) and previous is not None:
+                saved[previous] = True
+        load_status = False
+        for pc_, name, opcode, imm, next_pc in instructions:
+            if name in FLAG_READERS:
+                load_status = True
+                break
+            if opcode._grp == 0b001:
+                break
+
+        lines = ["counts[0] += 1", "regs = cpu.registers", "r = regs.r", "alu = cpu.alu"]
+        if load_status:
+            lines.append("p = alu.pending")
+            lines.append("st = alu._status if p is None else flags(*p)")
+        accessors = set()
+        writes_status = False
+        immediate = None
+        end_pc = instructions[-1][4]
+        # Devices may read the cycle count, so memory accesses see the
+        # instructions retired before them just as they would when stepping.
+        timed = any(name in MEMORY for pc_, name, opcode, imm, next_pc in instructions)
+        if timed:
+            lines.append("i = cpu.instructions")
+        if any(checked):
+            lines.append("g = translator.generation")
+        flags_pending = False
+        for index, (pc_, name, opcode, imm, next_pc) in enumerate(instructions):
+            n = opcode.rn
+            src = f"0x{imm:04X}" if imm is not None else f"r[{opcode.rm}]"
+            if imm is not None:
+                immediate = imm
+            if index and name in MEMORY:
+                lines.append(f"cpu.instructions = i + {index}")
+            if faulting[index] and flags_pending:
+                lines.append("alu._status = st")
+                lines.append("alu.pending = None")
+                flags_pending = False
+            if opcode._grp == 0b001:
+                expression = ALU_EXPRESSIONS[name]
+                writes = name not in ("CP", "TEST")
+                if live[index] or index == last_writer or saved[index]:
+                    lines.append(f"a = r[{n}]")
+                    lines.append(f"b = {src}")
+                    lines.append(f"v = {expression.format(a='a', b='b')}")
+                    if writes:
+                        lines.append(f"r[{n}] = v & 0xFFFF")
+                    if live[index]:
+                        writes_status = writes_status or index == last_writer
+                        lines.append(f"st = flags({opcode._func}, a, b, v)")
+                    else:
+                        lines.append(f"alu.pending = ({opcode._func}, a, b, v)")
+                    flags_pending = live[index]
+                elif writes:
+                    lines.append(f"r[{n}] = ({expression.format(a=f'r[{n}]', b=src)}) & 0xFFFF")
+            elif name == "MOV":
+                lines.append(f"r[{n}] = {src}")
+            elif name in ("LDW", "LDB"):
+                accessor = "readu16" if name == "LDW" else "readu8"
+                accessors.add(accessor)
+                if imm is None:
+                    lines.append(f"m = {src}")
+                    src = "m"
+                    lines.append("reads[m >> 8] += 1")
+                else:
+                    lines.append(f"reads[0x{imm >> 8:02X}] += 1")
+                lines.append(f"r[{n}] = {accessor}({src})")
+            elif name in ("STW", "STB"):
+                if imm is None:
+                    lines.append(f"m = r[{n}]")
+                    dst = "m"
+                    lines.append("writes[m >> 8] += 1")
+                else:
+                    dst = f"0x{imm:04X}"
+                    lines.append(f"writes[0x{imm >> 8:02X}] += 1")
+                if name == "STW":
+                    accessors.add("writeu16")
+                    lines.append(f"writeu16({dst}, r[{opcode.rm}])")
+                else:
+                    accessors.add("writeu8")
+                    lines.append(f"writeu8({dst}, r[{opcode.rm}] & 0xFF)")
+                if checked[index]:
+                    lines.append("if translator.generation != g:")
+                    lines.append(f"    regs.pc = 0x{next_pc:04X}")
+                    if flags_pending:
+                        lines.append("    alu._status = st")
+                        lines.append("    alu.pending = None")
+                    if immediate is not None:
+                        lines.append(f"    regs.immediate = 0x{immediate:04X}")
+                    lines.append(f"    cpu.instructions = i + {index + 1}")
+                    lines.append(f"    return {index + 1}")
+            elif name == "BRA":
+                lines.append(f"regs.pc = {src}")
+            elif name in CONDITIONS:
+                lines.append(f"if {CONDITIONS[name]}:")
+                lines.append(f"    regs.pc = {src}")
+                lines.append("    counts[1] += 1")
+                lines.append("else:")
+                lines.append(f"    regs.pc = 0x{next_pc:04X}")
+            elif name == "CALL":
+                lines.append(f"t = {src}")
+                lines.append(f"r[15] = 0x{next_pc:04X}")
+                lines.append("regs.pc = t")
+            elif name == "RET":
+                lines.append("regs.pc = r[15]")
+        if instructions[-1][1] not in BRANCHES:
+            lines.append(f"regs.pc = 0x{end_pc:04X}")
+        if writes_status:
+            lines.append("alu._status = st")
+            lines.append("alu.pending = None")
+        if immediate is not None:
+            lines.append(f"regs.immediate = 0x{immediate:04X}")
+        if timed:
+            lines.append(f"cpu.instructions = i + {len(instructions)}")
+        else:
+            lines.append(f"cpu.instructions += {len(instructions)}")
+        lines.append(f"return {len(instructions)}")
+        for accessor in sorted(accessors):
+            lines.insert(3, f"{accessor} = cpu.{accessor}")
+
+        start = instructions[0][0]
+        end = instructions[-1][0] + (4 if instructions[-1][3] is not None else 2)
+        source = f"def block_{start:04X}(cpu):\n" + "".join(f"    {line}\n" for line in lines)
+        counters = self.cpu.counters
+        words = tuple(opcode.word for pc_, name, opcode, imm, next_pc in instructions)
+        counts = [0, 0]
+        namespace = {"flags": flags, "counts": counts, "reads": counters.reads, "writes": counters.writes,
+                     "translator": self}
+        exec(compile(source, f"<block 0x{start:04X}>", "exec"), namespace)
+        block = Block(start, end, len(instructions), namespace[f"block_{start:04X}"], source,
+                      self._idle(instructions, counts), words, counts)
+        self.blocks[start] = block
+        for page in block.pages:
+            if not self.cpu.writable(page):
+                continue
+            if page not in self._page_blocks:
+                self._page_blocks[page] = set()
+                self.cpu.add_write_hook(page, self._invalidate)
+            self._page_blocks[page].add(start)
+        return block
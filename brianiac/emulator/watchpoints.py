@@ -0,0 +1,134 @@
+# Copyright 2022 Brian Johnson
+#
+# This file is part of brianiac
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, see <http://www.gnu.org/licenses/>.
+
+from brianiac.emulator.cpu import PAGE_SHIFT, StopReason
+
+READ = 1
+WRITE = 2
+ACCESS = READ | WRITE
+
+KINDS = {"read": READ, "write": WRITE, "access": ACCESS}
+
+
+class Watchpoint(object):
+    __slots__ = ("start", "end", "kind")
+
+    def __init__(self, start, end, kind):
+        self.start = start
+        self.end = end
+        self.kind = kind
+
+    @property
+    def pages(self):
+        return range(self.start >> PAGE_SHIFT, (self.end >> PAGE_SHIFT) + 1)
+
+    def __str__(self):
+        name = {v: k for k, v in KINDS.items()}[self.kind]
+        if self.start == self.end:
+            return f"{name} {self.start:04X}"
+        return f"{name} {self.start:04X}-{self.end:04X}"
+
+
+class Hit(object):
+    __slots__ = ("watchpoint", "kind", "address", "size", "value")
+
+    def __init__(self, watchpoint, kind, address, size, value):
+        self.watchpoint = watchpoint
+        self.kind = kind
+        self.address = address
+        self.size = size
+        self.value = value
+
+    def __str__(self):
+        arrow = "->" if self.kind == READ else "<-"
+        width = 4 if self.size == 2 else 2
+        return f"Watchpoint {self.watchpoint}: [{self.address:04X}] {arrow} {self.value:0{width}X}"
+
+
+# Only pages covered by a watchpoint get read or write hooks, every other page
+# keeps the plain handlers in the CPU page tables. The translator also ends
+# blocks after loads and stores that may touch a watched range, so a run stops
+# right after the instruction that hit, while loops that never do, such as one
+# polling a device, still translate whole and idle as usual.
+class Watchpoints(object):
+    def __init__(self, cpu):
+        self.cpu = cpu
+        self.watchpoints = []
+        self.hit = None
+        self._read_pages = set()
+        self._write_pages = set()
+
+    def __iter__(self):
+        return iter(self.watchpoints)
+
+    def __len__(self):
+        return len(self.watchpoints)
+
+    def add(self, start, end=None, kind=WRITE):
+        end = start if end is None else end
+        if end < start:
+            raise ValueError("watchpoint range ends before it starts")
+        self.watchpoints.append(Watchpoint(start, end, kind))
+        self._update()
+
+    def remove(self, start, end=None):
+        end = start if end is None else end
+        count = len(self.watchpoints)
+        self.watchpoints = [w for w in self.watchpoints if (w.start, w.end) != (start, end)]
+        self._update()
+        return len(self.watchpoints) != count
+
+    def clear(self):
+        self.watchpoints = []
+        self._update()
+
+    def _update(self):
+        read_pages = set()
+        write_pages = set()
+        for watchpoint in self.watchpoints:
+            if watchpoint.kind & READ:
+                read_pages.update(watchpoint.pages)
+            if watchpoint.kind & WRITE:
+                write_pages.update(watchpoint.pages)
+        for page in self._read_pages - read_pages:
+            self.cpu.remove_read_hook(page, self._read)
+        for page in read_pages - self._read_pages:
+            self.cpu.add_read_hook(page, self._read)
+        for page in self._write_pages - write_pages:
+            self.cpu.remove_write_hook(page, self._write)
+        for page in write_pages - self._write_pages:
+            self.cpu.add_write_hook(page, self._write)
+        self._read_pages = read_pages
+        self._write_pages = write_pages
+        if self.cpu.translator is not None:
+            self.cpu.translator.set_watched([(w.start, w.end) for w in self.watchpoints if w.kind & READ],
+                                            [(w.start, w.end) for w in self.watchpoints if w.kind & WRITE])
+
+    def _check(self, kind, address, size, value):
+        last = address + size - 1
+        for watchpoint in self.watchpoints:
+            if watchpoint.kind & kind and watchpoint.start <= last and address <= watchpoint.end:
+                if self.hit is None:
+                    self.hit = Hit(watchpoint, kind, address, size, value)
+                self.cpu.request_stop(StopReason.WATCHPOINT)
+                return
+
+    def _read(self, address, size, value):
+        self._check(READ, address, size, value)
+
+    def _write(self, address, size, value):
+        self._check(WRITE, address, size, value)
@@ -31,7 +31,7 @@ setup(name='brianiac',
       author='Brian Johnson',
       author_email='brijohn@gmail.com',
       license='GPLv2',
-      packages=['brianiac.assembler', 'brianiac.emulator'],
+      packages=['brianiac.assembler', 'brianiac.benchmark', 'brianiac.emulator'],
       install_requires=[
           'rply',
           'click',
@@ -39,6 +39,8 @@ setup(name='brianiac',
       ],
       entry_points={
           'console_scripts': ['brianiac-emu=brianiac.emulator.__main__:main',
-                              'brianiac-asm=brianiac.assembler.__main__:main'],
+                              'brianiac-asm=brianiac.assembler.__main__:main',
+                              'brianiac-disasm=brianiac.emulator.__main__:disassemble',
+                              'brianiac-bench=brianiac.benchmark.__main__:main'],
       },
       zip_safe=False)
@@ -0,0 +1,173 @@
+# Copyright 2022 Brian Johnson
+#
+# This file is part of brianiac
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, see <http://www.gnu.org/licenses/>.
+
+import contextlib
+import io
+import unittest
+from brianiac.assembler.__main__ import assemble
+from brianiac.emulator.cpu import CPU, StopReason
+from brianiac.emulator.dma import DMA
+from brianiac.emulator.ram import RAM
+from brianiac.emulator.timer import Timer
+from brianiac.emulator.watchpoints import WRITE, Watchpoints
+
+
+def build(source, translate):
+    with contextlib.redirect_stdout(io.StringIO()):
+        image = assemble(source).eval()
+    cpu = CPU(translate=translate)
+    cpu.map(0x0000, 0xefff, RAM(0xf000))
+    cpu.map(0xf010, 0xf01f, DMA(cpu))
+    cpu.write_block(0, image)
+    return cpu
+
+
+def state(cpu):
+    return list(cpu.registers.r), cpu.registers.pc, cpu.registers.status, cpu.instructions, \
+        cpu.counters.snapshot()["opcodes"]
+
+
+class SelfModifyingCodeTest(unittest.TestCase):
+    def compare(self, source, instructions):
+        interpreted = build(source, False)
+        interpreted.run(instructions)
+        translated = build(source, True)
+        translated.run(instructions)
+        self.assertEqual(state(translated), state(interpreted))
+        return translated
+
+    def test_store_patches_later_instruction_in_block(self):
+        cpu = self.compare("""
+            mov r0, 0
+            stw patch, r0
+            patch:
+            mov r1, 5
+            mov r2, 7
+            """, 4)
+        self.assertEqual(cpu.registers.r[1], 0)
+
+    def test_flags_survive_early_exit(self):
+        self.compare("""
+            mov r0, 0
+            mov r3, 0xffff
+            and r3, r3
+            add r3, 1
+            stw patch, r0
+            patch:
+            mov r1, 5
+            add r4, 0
+            """, 7)
+
+    def test_dma_copy_over_running_block(self):
+        cpu = self.compare("""
+            mov r0, 0x1000
+            stw 0xf010, r0
+            mov r0, patch
+            stw 0xf012, r0
+            mov r0, 4
+            stw 0xf014, r0
+            mov r0, 1
+            stw 0xf018, r0
+            patch:
+            mov r4, 9
+            mov r5, 1
+            bra done
+            done:
+            bra done
+            """, 12)
+        self.assertEqual(cpu.registers.r[4], 0)
+
+    def test_flags_survive_fault(self):
+        source = """
+            mov r2, 0x1001
+            mov r0, 1
+            cp r0, 1
+            ldw r1, @r2
+            bz done
+            done:
+            bra done
+            """
+        states = []
+        for translate in (False, True):
+            cpu = build(source, translate)
+            self.assertEqual(cpu.run(10), StopReason.FAULT)
+            states.append(state(cpu))
+        self.assertEqual(states[1], states[0])
+
+    def test_store_beside_code_keeps_block(self):
+        cpu = self.compare("""
+            mov r0, 0
+            mov r1, 100
+            loop:
+            and r0, r0
+            add r0, 1
+            stw counter, r0
+            cp r0, r1
+            bnz loop
+            done:
+            bra done
+            counter:
+            """, 402)
+        self.assertEqual(cpu.registers.r[0], 80)
+        self.assertLess(cpu.translator.generation, 5)
+
+
+class WatchpointTest(unittest.TestCase):
+    def test_unwatched_poll_loop_still_idles(self):
+        cpu = build("""
+            mov r0, 0x8000
+            stw 0xf024, r0
+            loop:
+            ldw r0, 0xf026
+            and r0, r0
+            bz loop
+            done:
+            bra done
+            """, True)
+        cpu.map(0xf020, 0xf027, Timer(cpu))
+        Watchpoints(cpu).add(0xf020, kind=WRITE)
+        self.assertIsNotNone(cpu.translator.idle_at(0x0008)[0])
+        self.assertEqual(cpu.run(10000), StopReason.HALT)
+
+
+class CountersTest(unittest.TestCase):
+    def test_devices_sharing_a_page_are_counted_apart(self):
+        source = """
+            mov r0, 0
+            stw 0xf010, r0
+            mov r0, 0x400
+            stw 0xf024, r0
+            loop:
+            ldw r0, 0xf026
+            and r0, r0
+            bz loop
+            done:
+            bra done
+            """
+        devices = []
+        for translate in (False, True):
+            cpu = build(source, translate)
+            cpu.map(0xf020, 0xf027, Timer(cpu))
+            cpu.run(1000)
+            devices.append(cpu.counters.snapshot()["devices"])
+        self.assertEqual(devices[1], devices[0])
+        self.assertEqual(devices[0]["writes"], {"DMA F010-F01F": 1, "Timer F020-F027": 1})
+        self.assertGreater(devices[0]["reads"]["Timer F020-F027"], 1)
+
+
+if __name__ == "__main__":
+    unittest.main()